@@ -4,7 +4,9 @@ num_cpus=30
 subword_bpe_merge_ops=600
 
 # preprocess pre-train train data
-fairseq-preprocess \
+# writes the same .bin/.idx and dict files as fairseq-preprocess, in one pass over newline-aligned ranges of the
+# files; add --codes to binarize text that has not been segmented with bpe yet
+PYTHONPATH=${PROJECT_ROOT}/preprocess python -m tools.subword.scripts.bpe.binarize \
         --source-lang src --target-lang trg \
         --srcdict ${PROJECT_ROOT}/experiments/toy/vocab/vocab.bpe.${subword_bpe_merge_ops} \
         --tgtdict ${PROJECT_ROOT}/experiments/toy/vocab/vocab.bpe.${subword_bpe_merge_ops} \
@@ -0,0 +1,179 @@
+from itertools import repeat
+
+import numpy as np
+
+_GOLDEN = np.uint64(0x9e3779b97f4a7c15)
+_MIX1 = np.uint64(0xbf58476d1ce4e5b9)
+_MIX2 = np.uint64(0x94d049bb133111eb)
+
+
+def splitmix64(x):
+    """The finalizer of SplitMix64, maps uint64 counters to well mixed uint64 values."""
+    with np.errstate(over='ignore'):
+        z = x + _GOLDEN
+        z = (z ^ (z >> np.uint64(30))) * _MIX1
+        z = (z ^ (z >> np.uint64(27))) * _MIX2
+        return z ^ (z >> np.uint64(31))
+
+
+def line_uniform(line_keys, stream, positions):
+    """
+    Counter-based uniform random numbers: the value only depends on the key of the line, the stream and the
+    position, so that the substitutions of a line do not depend on how the corpus is split into blocks or shards.
+
+    :param line_keys: uint64 keys of the lines, see `BatchRAS.line_keys`
+    :param stream: index of the random stream, different for each kind of draw
+    :param positions: positions inside the lines
+    :return: floats in [0, 1)
+    """
+    with np.errstate(over='ignore'):
+        z = splitmix64(splitmix64(line_keys ^ np.uint64(stream)) + positions.astype(np.uint64))
+    return (z >> np.uint64(11)).astype(np.float64) * (1.0 / (1 << 53))
+
+
+class BatchRAS(object):
+    """
+    Random Aligned Substitution over blocks of sentences.
+
+    Tokens are mapped to integer ids against the dictionaries once, and the candidates of every
+    (language, source word) are stored as slices of one flat array. The Bernoulli masks and the
+    candidate choices for a whole block of sentences are then drawn with NumPy instead of calling
+    `random.random()` for every token.
+
+    The random numbers of a sentence are derived from (seed, line number), so the output is the same
+    whatever the block size and the number of workers.
+    """
+
+    def __init__(self, dictionaries, langs, replace_prob=0.15, num_repeat=1, seed=1):
+        """
+
+        :param dictionaries: a dictionary of dictionaries as returned by `load_dicts`, keyed by "en-x"
+        :param langs: languages that we apply RAS, each of them must have an "en-x" dictionary
+        :param replace_prob: the probability of substituting a token that is found in the dictionary
+        :param num_repeat: number of copies of each sentence, each copy uses a different language
+        :param seed: the global seed, combined with the line numbers
+        """
+        assert num_repeat <= len(langs), ("num_repeat {} is larger than the number of languages {}"
+                                          .format(num_repeat, len(langs)))
+        self.langs = list(langs)
+        self.replace_prob = replace_prob
+        self.num_repeat = num_repeat
+        self.seed_key = splitmix64(np.uint64(seed))
+        self.next_line = 0
+
+        # intern source words and target words
+        self.src_vocab = {}
+        self.tgt_words = []
+        tgt_vocab = {}
+        for lang in self.langs:
+            dict_name = "en-" + lang
+            assert dict_name in dictionaries, ("{} not in dictionaries!".format(dict_name))
+            for src_word in dictionaries[dict_name]:
+                if src_word not in self.src_vocab:
+                    self.src_vocab[src_word] = len(self.src_vocab)
+
+        # replacement table: candidates of word `i` in language `l` are
+        # candidates[start[l, i]: start[l, i] + count[l, i]]
+        self.start = np.zeros((len(self.langs), len(self.src_vocab)), dtype=np.int64)
+        self.count = np.zeros((len(self.langs), len(self.src_vocab)), dtype=np.int64)
+        candidates = []
+        for l, lang in enumerate(self.langs):
+            for src_word, tgt_words in dictionaries["en-" + lang].items():
+                i = self.src_vocab[src_word]
+                self.start[l, i] = len(candidates)
+                self.count[l, i] = len(tgt_words)
+                for tgt_word in tgt_words:
+                    if tgt_word not in tgt_vocab:
+                        tgt_vocab[tgt_word] = len(self.tgt_words)
+                        self.tgt_words.append(tgt_word)
+                    candidates.append(tgt_vocab[tgt_word])
+        self.candidates = np.array(candidates, dtype=np.int64)
+
+    def encode(self, tokens):
+        """
+
+        :param tokens: list of tokens
+        :return: an array of source word ids, -1 for tokens that are not in any dictionary
+        """
+        return np.fromiter(map(self.src_vocab.get, tokens, repeat(-1)), dtype=np.int64, count=len(tokens))
+
+    def line_keys(self, line_numbers):
+        """
+
+        :param line_numbers: array of line numbers in the corpus
+        :return: uint64 keys of the lines, derived from (seed, line number)
+        """
+        return splitmix64(self.seed_key ^ line_numbers.astype(np.uint64))
+
+    def replace_block(self, sentences, first_line=None, metrics=None, src_langs=None):
+        """
+        Create `num_repeat` copies for each sentence of the block, as `replace_sent` does.
+
+        :param sentences: list of sentences, each of them is a list of tokens
+        :param first_line: line number of the first sentence, continue after the previous block if None
+        :param metrics: if provided, a `RASMetrics` that records the counts of the block
+        :param src_langs: the language of each sentence, only used by `metrics`
+        :return: a list with the replaced copies (lists of tokens) of each sentence, copies without any
+            substitution are dropped
+        """
+        if first_line is None:
+            first_line = self.next_line
+        n_sent = len(sentences)
+        self.next_line = first_line + n_sent
+        keys = self.line_keys(np.arange(first_line, first_line + n_sent))
+        lengths = np.fromiter((len(sent) for sent in sentences), dtype=np.int64, count=n_sent)
+        offsets = np.concatenate([[0], np.cumsum(lengths)])
+        flat = [token for sent in sentences for token in sent]
+        ids = self.encode(flat)
+        known = np.flatnonzero(ids >= 0)
+        sent_index = np.repeat(np.arange(n_sent), lengths)
+        known_keys = keys[sent_index[known]]
+        known_positions = known - offsets[sent_index[known]]
+        offsets = offsets.tolist()
+
+        # randomly select `num_repeat` different languages for each sentence
+        n_langs = len(self.langs)
+        lang_uniform = line_uniform(np.repeat(keys, n_langs), 0, np.tile(np.arange(n_langs), n_sent))
+        selected_langs = np.argsort(lang_uniform.reshape(n_sent, n_langs), axis=1)[:, :self.num_repeat]
+
+        replaced_sents = [[] for _ in range(n_sent)]
+        for r in range(self.num_repeat):
+            token_lang = selected_langs[sent_index[known], r]
+            num_candidates = self.count[token_lang, ids[known]]
+            hit = (num_candidates > 0) & \
+                (line_uniform(known_keys, 2 * r + 1, known_positions) < self.replace_prob)
+            pos = known[hit]
+            choice = self.start[token_lang[hit], ids[pos]] + \
+                (line_uniform(known_keys[hit], 2 * r + 2, known_positions[hit]) *
+                 num_candidates[hit]).astype(np.int64)
+
+            new_flat = list(flat)
+            tgt_words = self.tgt_words
+            for p, c in zip(pos.tolist(), self.candidates[choice].tolist()):
+                new_flat[p] = tgt_words[c]
+            replace_cnt = np.bincount(sent_index[pos], minlength=n_sent)
+            for i in np.flatnonzero(replace_cnt).tolist():
+                replaced_sents[i].append(new_flat[offsets[i]:offsets[i + 1]])
+
+            if metrics is not None:
+                self._record(metrics, token_lang[hit], replace_cnt, len(flat), int(np.sum(num_candidates > 0)),
+                             src_langs)
+
+        return replaced_sents
+
+    def _record(self, metrics, replaced_lang, replace_cnt, num_tokens, num_covered, src_langs):
+        """Record the counts of one copy of all sentences of a block."""
+        tgt_lang_replaced = np.bincount(replaced_lang, minlength=len(self.langs))
+        src_lang_replaced = {}
+        if src_langs is not None:
+            for src_lang, cnt in zip(src_langs, replace_cnt.tolist()):
+                src_lang_replaced[src_lang] = src_lang_replaced.get(src_lang, 0) + cnt
+        histogram = np.bincount(replace_cnt)
+        metrics.add_block(copies=len(replace_cnt),
+                          dropped=int(np.sum(replace_cnt == 0)),
+                          tokens=num_tokens,
+                          covered=num_covered,
+                          src_lang_replaced=src_lang_replaced,
+                          tgt_lang_replaced=dict((self.langs[l], int(c)) for l, c in enumerate(tgt_lang_replaced)
+                                                 if c > 0),
+                          histogram=dict((k, int(c)) for k, c in enumerate(histogram) if c > 0))
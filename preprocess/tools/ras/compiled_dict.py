@@ -0,0 +1,434 @@
+"""Compile the RAS dictionaries into one binary file that is memory-mapped at load time.
+
+Both the multi-way dictionary (`dict.merge_depN.txt`, see `multi_way_word_graph.py`) and the MUSE
+`en-xx.txt` dictionaries are stored in the same layout:
+
+* a string table (utf-8 blob + offsets) of interned words, each word id has a language column;
+* the source entries (word ids), grouped by language, with a CSR index into the candidate arrays;
+* the candidate arrays: word id, depth and language of each candidate;
+* the source entries that are phrases;
+* an open-addressing hash table from (language, word) to source entry.
+
+The header also has the range of source entries of each language and their number per target language.
+
+The RAS scripts `mmap` the file, so that loading is near-instant and the pages are shared between workers: the
+tables of the words and the phrase automatons are only built from the entries they need.
+"""
+import os
+import json
+import mmap
+import time
+import zlib
+import struct
+import argparse
+from abc import ABCMeta, abstractmethod
+from collections import OrderedDict
+
+import numpy as np
+
+from .sampler import AliasTable
+
+MAGIC = b"RASDICT\0"
+VERSION = 2
+ALIGNMENT = 64
+# clear the lookup caches when they grow larger than this
+MAX_CACHE_SIZE = 4000000
+
+
+def _key(lang, word):
+    return (lang + "\t" + word).encode("utf-8")
+
+
+class DictBuilder(object):
+    """Collect source words and their candidates, and write them in the compiled format."""
+
+    def __init__(self, vocab_size=None):
+        """
+
+        :param vocab_size: the `vocab_size` the MUSE dictionaries were cut to, checked by `replace_word.py`
+        """
+        self.vocab_size = vocab_size
+        self.langs = []
+        self.lang_ids = {}
+        self.word_ids = {}
+        self.words = []
+        self.word_langs = []
+        self.src_words = []
+        self.src_entries = {}
+        self.candidates = []
+
+    def _lang_id(self, lang):
+        if lang not in self.lang_ids:
+            self.lang_ids[lang] = len(self.langs)
+            self.langs.append(lang)
+        return self.lang_ids[lang]
+
+    def _word_id(self, lang, word):
+        key = (lang, word)
+        if key not in self.word_ids:
+            self.word_ids[key] = len(self.words)
+            self.words.append(word)
+            self.word_langs.append(self._lang_id(lang))
+        return self.word_ids[key]
+
+    def add(self, src_lang, src_word, candidates):
+        """
+
+        :param src_lang: language of the source word
+        :param src_word: the source word
+        :param candidates: list of (word, lang, depth)
+        """
+        word_id = self._word_id(src_lang, src_word)
+        if word_id not in self.src_entries:
+            self.src_entries[word_id] = len(self.src_words)
+            self.src_words.append(word_id)
+            self.candidates.append([])
+        entry = self.src_entries[word_id]
+        for word, lang, depth in candidates:
+            self.candidates[entry].append((self._word_id(lang, word), self.lang_ids[lang], depth))
+
+    def _entry_order(self):
+        # the source entries of each language are contiguous, in the order they were added
+        return sorted(range(len(self.src_words)), key=lambda entry: self.word_langs[self.src_words[entry]])
+
+    def arrays(self):
+        order = self._entry_order()
+        src_words = [self.src_words[entry] for entry in order]
+        candidates = [self.candidates[entry] for entry in order]
+        encoded = [word.encode("utf-8") for word in self.words]
+        string_offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(w) for w in encoded], out=string_offsets[1:])
+        cand_indptr = np.zeros(len(src_words) + 1, dtype=np.int64)
+        np.cumsum([len(c) for c in candidates], out=cand_indptr[1:])
+        flat = [c for cands in candidates for c in cands]
+        # the entries that are phrases, for the `PhraseMatcher`s
+        phrase_entries = [entry for entry, word_id in enumerate(src_words) if len(self.words[word_id].split()) > 1]
+
+        # open addressing with linear probing, at most half full
+        num_slots = 1
+        while num_slots < 2 * len(src_words):
+            num_slots *= 2
+        hash_slots = np.full(num_slots, -1, dtype=np.int64)
+        for entry, word_id in enumerate(src_words):
+            slot = zlib.crc32(_key(self.langs[self.word_langs[word_id]], self.words[word_id])) & (num_slots - 1)
+            while hash_slots[slot] >= 0:
+                slot = (slot + 1) & (num_slots - 1)
+            hash_slots[slot] = entry
+
+        return OrderedDict([
+            ("string_data", np.frombuffer(b"".join(encoded), dtype=np.uint8)),
+            ("string_offsets", string_offsets),
+            ("word_lang", np.array(self.word_langs, dtype=np.uint16)),
+            ("src_word", np.array(src_words, dtype=np.int32)),
+            ("cand_indptr", cand_indptr),
+            ("cand_word", np.array([c[0] for c in flat], dtype=np.int32)),
+            ("cand_lang", np.array([c[1] for c in flat], dtype=np.uint16)),
+            ("cand_depth", np.array([c[2] for c in flat], dtype=np.uint8)),
+            ("phrase_entry", np.array(phrase_entries, dtype=np.int64)),
+            ("hash_slots", hash_slots),
+        ])
+
+    def index(self):
+        """
+
+        :return: {src_lang: [first entry, end entry, {target lang: number of entries with candidates in it}]}, so
+            that the sizes of the dictionaries are known without reading the arrays
+        """
+        index = OrderedDict()
+        for entry, src_entry in enumerate(self._entry_order()):
+            src_lang = self.langs[self.word_langs[self.src_words[src_entry]]]
+            if src_lang not in index:
+                index[src_lang] = [entry, entry, {}]
+            index[src_lang][1] = entry + 1
+            counts = index[src_lang][2]
+            for lang_id in set(c[1] for c in self.candidates[src_entry]):
+                counts[self.langs[lang_id]] = counts.get(self.langs[lang_id], 0) + 1
+        return index
+
+    def save(self, output_path):
+        arrays = self.arrays()
+        header = {"langs": self.langs, "vocab_size": self.vocab_size, "index": self.index(), "arrays": OrderedDict()}
+        # the offsets are relative to the end of the header, which is padded to ALIGNMENT
+        offset = 0
+        for name, array in arrays.items():
+            header["arrays"][name] = [array.dtype.str, len(array), offset]
+            offset += -(-array.nbytes // ALIGNMENT) * ALIGNMENT
+        header_bytes = json.dumps(header).encode("utf-8")
+        prefix_len = len(MAGIC) + 8 + len(header_bytes)
+        header_bytes += b" " * (-prefix_len % ALIGNMENT)
+        with open(output_path, "wb") as fw:
+            fw.write(MAGIC)
+            fw.write(struct.pack("<II", VERSION, len(header_bytes)))
+            fw.write(header_bytes)
+            for array in arrays.values():
+                fw.write(array.tobytes())
+                fw.write(b"\0" * (-array.nbytes % ALIGNMENT))
+
+
+def build_multi_dict(dictionary_path):
+    """
+
+    :param dictionary_path: the path of the multi-way dictionary, in the format read by `load_multi_dict`
+    :return: a `DictBuilder` with all source words of all languages
+    """
+    builder = DictBuilder()
+    with open(dictionary_path) as f:
+        for _line in f:
+            fields = _line.strip().split("\t")
+            source = fields[0]
+            candidates = [(word_str[4:-3], word_str[:2].lower(), int(word_str[-1])) for word_str in fields[1:]]
+            builder.add(source[:2].lower(), source[4:], candidates)
+    return builder
+
+
+def build_muse_dicts(dictionary_path, languages, vocab_size):
+    """
+
+    :param dictionary_path: the path of the root of MUSE dictionaries
+    :param languages: en-x dictionaries will be used for all x in `languages`
+    :param vocab_size: only keep the first `vocab_size` word pairs of each dictionary, as `load_dicts` does
+    :return: a `DictBuilder` where the candidates of an English word in language x come from en-x.txt, with depth 1
+    """
+    builder = DictBuilder(vocab_size)
+    for lang in languages:
+        pair_name = "en-" + lang
+        file_name = os.path.join(dictionary_path, pair_name + ".txt")
+        if not os.path.isfile(file_name):
+            raise FileNotFoundError("{} not exists!".format(file_name))
+        builder._lang_id(lang)
+        with open(file_name) as f:
+            for i, _line in enumerate(f):
+                # tab separated lines may contain phrases
+                bi_text = _line.strip().split("\t") if "\t" in _line else _line.strip().split()
+                assert len(bi_text) == 2, ("in file {}, line index {} has an invalid number of columns {}"
+                                           .format(file_name, i, len(bi_text)))
+                builder.add("en", bi_text[0], [(bi_text[1], lang, 1)])
+                if i >= vocab_size:
+                    # only keep first `vocab_size` word pairs
+                    break
+    return builder
+
+
+class CompiledDict(object):
+    """A memory-mapped dictionary written by `DictBuilder.save`."""
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._mmap[:len(MAGIC)] != MAGIC:
+            raise ValueError("{} is not a compiled RAS dictionary".format(path))
+        version, header_len = struct.unpack_from("<II", self._mmap, len(MAGIC))
+        if version != VERSION:
+            raise ValueError("{} has version {}, expected {}".format(path, version, VERSION))
+        data_start = len(MAGIC) + 8 + header_len
+        header = json.loads(self._mmap[len(MAGIC) + 8:data_start].decode("utf-8"))
+        self.langs = header["langs"]
+        self.vocab_size = header["vocab_size"]
+        self.index = header["index"]
+        self.lang_ids = dict((lang, i) for i, lang in enumerate(self.langs))
+        for name, (dtype, length, offset) in header["arrays"].items():
+            setattr(self, name, np.frombuffer(self._mmap, dtype=dtype, count=length, offset=data_start + offset))
+        self._strings = memoryview(self._mmap)[data_start + header["arrays"]["string_data"][2]:]
+        self._mask = len(self.hash_slots) - 1
+
+    @staticmethod
+    def is_compiled(path):
+        if not os.path.isfile(path):
+            return False
+        with open(path, "rb") as f:
+            return f.read(len(MAGIC)) == MAGIC
+
+    def __len__(self):
+        return len(self.src_word)
+
+    def num_entries(self, lang, target_lang=None):
+        """
+
+        :return: the number of source entries of language `lang`, with candidates in `target_lang` if it is given
+        """
+        if lang not in self.index:
+            return 0
+        start, end, counts = self.index[lang]
+        return end - start if target_lang is None else counts.get(target_lang, 0)
+
+    def word(self, word_id):
+        return bytes(self._strings[self.string_offsets[word_id]:self.string_offsets[word_id + 1]]).decode("utf-8")
+
+    def lookup(self, lang, word):
+        """
+
+        :return: the source entry of `word` in language `lang`, -1 if it is not in the dictionary
+        """
+        if lang not in self.lang_ids:
+            return -1
+        key = _key(lang, word)
+        slot = zlib.crc32(key) & self._mask
+        while True:
+            entry = self.hash_slots[slot]
+            if entry < 0:
+                return -1
+            word_id = self.src_word[entry]
+            if self.word_lang[word_id] == self.lang_ids[lang] and \
+                    self._strings[self.string_offsets[word_id]:self.string_offsets[word_id + 1]] == key[len(lang) + 1:]:
+                return int(entry)
+            slot = (slot + 1) & self._mask
+
+    def entries(self, lang):
+        """
+
+        :return: the source entries of language `lang`
+        """
+        if lang not in self.index:
+            return np.zeros(0, dtype=np.int64)
+        start, end, _ = self.index[lang]
+        return np.arange(start, end)
+
+    def phrase_entries(self, lang):
+        """
+
+        :return: the source entries of language `lang` that are phrases
+        """
+        if lang not in self.index:
+            return np.zeros(0, dtype=np.int64)
+        start, end, _ = self.index[lang]
+        return self.phrase_entry[np.searchsorted(self.phrase_entry, start):np.searchsorted(self.phrase_entry, end)]
+
+    def candidates(self, entry):
+        """
+
+        :return: word ids, language ids and depths of the candidates of a source entry
+        """
+        start, end = self.cand_indptr[entry], self.cand_indptr[entry + 1]
+        return self.cand_word[start:end], self.cand_lang[start:end], self.cand_depth[start:end]
+
+
+class _LazyTables(object, metaclass=ABCMeta):
+    """Build the table of a source word on its first lookup, and cache it (misses included)."""
+
+    def __init__(self, compiled, src_lang):
+        self.compiled = compiled
+        self.src_lang = src_lang
+        self._cache = {}
+
+    @abstractmethod
+    def _build(self, entry):
+        """
+
+        :param entry: a source entry of `src_lang`
+        :return: the table of the source word of `entry`, None if it has no candidate
+        """
+
+    def get(self, token, default=None):
+        if token in self._cache:
+            table = self._cache[token]
+        else:
+            if len(self._cache) >= MAX_CACHE_SIZE:
+                self._cache.clear()
+            entry = self.compiled.lookup(self.src_lang, token)
+            table = self._build(entry) if entry >= 0 else None
+            self._cache[token] = table
+        return default if table is None else table
+
+    def __contains__(self, token):
+        return self.get(token) is not None
+
+    def __getitem__(self, token):
+        table = self.get(token)
+        if table is None:
+            raise KeyError(token)
+        return table
+
+    def __iter__(self):
+        word_ids = self.compiled.src_word[self.compiled.entries(self.src_lang)].tolist()
+        return (self.compiled.word(word_id) for word_id in word_ids)
+
+    def __len__(self):
+        return self.compiled.num_entries(self.src_lang)
+
+    def phrases(self):
+        """
+
+        :return: the phrases that have a table, for a `PhraseMatcher`, without decoding the other entries
+        """
+        for entry in self.compiled.phrase_entries(self.src_lang).tolist():
+            phrase = self.compiled.word(self.compiled.src_word[entry])
+            if self.get(phrase) is not None:
+                yield phrase
+
+
+class CandidateTables(_LazyTables):
+    """
+    Lazy equivalent of `compile_multi_dict(...)[src_lang]`: the alias table of a source word is built from the
+    memory-mapped candidate arrays on its first lookup.
+    """
+
+    def __init__(self, compiled, src_lang, target_langs, max_dep):
+        super(CandidateTables, self).__init__(compiled, src_lang)
+        self.target_lang_ids = np.array(
+            [compiled.lang_ids[lang] for lang in target_langs if lang in compiled.lang_ids], dtype=np.uint16)
+        self.max_dep = max_dep
+
+    def _build(self, entry):
+        words, langs, depths = self.compiled.candidates(entry)
+        _max_depth = min(len(np.unique(depths)), self.max_dep)
+        # words with smaller depth has larger proba to be selected
+        keep = np.flatnonzero((depths >= 1) & (depths <= _max_depth) & np.isin(langs, self.target_lang_ids))
+        if len(keep) == 0:
+            return None
+        weights = np.left_shift(1, _max_depth - depths[keep].astype(np.int64)).tolist()
+        candidates = [(self.compiled.word(w), self.compiled.langs[l])
+                      for w, l in zip(words[keep].tolist(), langs[keep].tolist())]
+        return AliasTable(candidates, weights)
+
+
+class BilingualDict(_LazyTables):
+    """
+    Lazy equivalent of `load_dicts(...)["en-x"]` for a compiled MUSE dictionary: maps a source word to the list
+    of its translations in `target_lang`.
+    """
+
+    def __init__(self, compiled, src_lang, target_lang):
+        super(BilingualDict, self).__init__(compiled, src_lang)
+        self.target_lang = target_lang
+        self.target_lang_id = compiled.lang_ids[target_lang]
+
+    def _build(self, entry):
+        words, langs, _ = self.compiled.candidates(entry)
+        words = words[langs == self.target_lang_id].tolist()
+        return [self.compiled.word(w) for w in words] if words else None
+
+    def items(self):
+        for entry in self.compiled.entries(self.src_lang).tolist():
+            translations = self._build(entry)
+            if translations is not None:
+                yield self.compiled.word(self.compiled.src_word[entry]), translations
+
+    def __iter__(self):
+        return (word for word, _ in self.items())
+
+    def __len__(self):
+        return self.compiled.num_entries(self.src_lang, self.target_lang)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compile RAS dictionaries into a memory-mapped binary file")
+    parser.add_argument('--multi_dict_path', default=None, help="The multi-way dictionary to compile.")
+    parser.add_argument('--dict_path', default=None, help="The root of MUSE dictionaries to compile.")
+    parser.add_argument('--langs', default=None, help="Languages x of the en-x MUSE dictionaries, split by ';'.")
+    parser.add_argument('--vocab_size', type=int, default=2000,
+                        help="Only keep the first `vocab_size` word pairs of each MUSE dictionary, as "
+                             "`replace_word.py --vocab_size`, which must be the same.")
+    parser.add_argument('--output', '-o', required=True)
+    args = parser.parse_args()
+
+    start_time = time.time()
+    if args.multi_dict_path:
+        dict_builder = build_multi_dict(args.multi_dict_path)
+    else:
+        assert args.dict_path and args.langs, "--dict_path and --langs are required for MUSE dictionaries"
+        dict_builder = build_muse_dicts(args.dict_path, [l for l in args.langs.split(";") if l != "en"],
+                                        args.vocab_size)
+    dict_builder.save(args.output)
+    print("Compiled {} source words, {} candidates, {} words to {} in {} seconds".format(
+        len(dict_builder.src_words), sum(len(c) for c in dict_builder.candidates), len(dict_builder.words),
+        args.output, time.time() - start_time))
@@ -0,0 +1,113 @@
+import json
+import time
+from collections import Counter
+
+
+class RASMetrics(object):
+    """
+    Counters of a RAS run, they can be merged across blocks and workers.
+
+    A "copy" is one of the `num_repeat` replaced versions of a sentence. Copies without any
+    substitution are dropped.
+    """
+
+    def __init__(self):
+        self.lines = 0
+        self.copies = 0
+        self.dropped = 0
+        self.tokens = 0
+        self.covered = 0
+        self.replaced = 0
+        self.src_lang_replaced = Counter()
+        self.tgt_lang_replaced = Counter()
+        # number of substitutions per copy -> number of copies
+        self.histogram = Counter()
+        # seconds spent in each stage
+        self.stage_time = Counter()
+        self.start_time = time.time()
+
+    def add_copy(self, src_lang, num_tokens, num_covered, tgt_lang_replaced):
+        """
+
+        :param src_lang: the language of the source sentence
+        :param num_tokens: number of tokens of the copy
+        :param num_covered: number of tokens of the copy that are in the dictionary
+        :param tgt_lang_replaced: a dict from target language to the number of substituted tokens
+        """
+        num_replaced = sum(tgt_lang_replaced.values())
+        self.copies += 1
+        self.dropped += num_replaced == 0
+        self.tokens += num_tokens
+        self.covered += num_covered
+        self.replaced += num_replaced
+        self.src_lang_replaced[src_lang] += num_replaced
+        self.tgt_lang_replaced.update(tgt_lang_replaced)
+        self.histogram[num_replaced] += 1
+
+    def add_block(self, copies, dropped, tokens, covered, src_lang_replaced, tgt_lang_replaced, histogram):
+        """Bulk version of `add_copy`, the last three arguments are dicts of counts."""
+        self.copies += copies
+        self.dropped += dropped
+        self.tokens += tokens
+        self.covered += covered
+        self.replaced += sum(tgt_lang_replaced.values())
+        self.src_lang_replaced.update(src_lang_replaced)
+        self.tgt_lang_replaced.update(tgt_lang_replaced)
+        self.histogram.update(histogram)
+
+    def merge(self, other):
+        self.lines += other.lines
+        self.copies += other.copies
+        self.dropped += other.dropped
+        self.tokens += other.tokens
+        self.covered += other.covered
+        self.replaced += other.replaced
+        self.src_lang_replaced.update(other.src_lang_replaced)
+        self.tgt_lang_replaced.update(other.tgt_lang_replaced)
+        self.histogram.update(other.histogram)
+        self.stage_time.update(other.stage_time)
+        self.start_time = min(self.start_time, other.start_time)
+        return self
+
+    def summary(self):
+        elapsed = time.time() - self.start_time
+        return {
+            "lines": self.lines,
+            "copies": self.copies,
+            "dropped_copies": self.dropped,
+            "tokens": self.tokens,
+            "covered_tokens": self.covered,
+            "replaced_tokens": self.replaced,
+            "coverage": self.covered / self.tokens if self.tokens else 0.0,
+            "replace_ratio": self.replaced / self.tokens if self.tokens else 0.0,
+            "src_lang_replaced": dict(self.src_lang_replaced),
+            "tgt_lang_replaced": dict(self.tgt_lang_replaced),
+            "histogram": dict((str(k), v) for k, v in sorted(self.histogram.items())),
+            "stage_seconds": dict(self.stage_time),
+            "stage_lines_per_sec": dict((stage, self.lines / t) for stage, t in self.stage_time.items() if t > 0),
+            "elapsed": elapsed,
+            "lines_per_sec": self.lines / elapsed if elapsed > 0 else 0.0,
+        }
+
+    def log(self, log_file, **extra):
+        """Append the current summary as one JSON line to `log_file`."""
+        record = self.summary()
+        record.update(extra)
+        log_file.write(json.dumps(record, sort_keys=True) + "\n")
+        log_file.flush()
+
+    def report(self, num_repeat):
+        summary = self.summary()
+        lines = [
+            "Total Tokens(with repeated times) is {}, with {} replaced.".format(self.tokens, self.replaced),
+            "With a proportion of {}% ".format(summary["replace_ratio"] * 100),
+            "The repeated times are set to {}".format(num_repeat),
+            "{} of {} copies dropped because nothing was replaced".format(self.dropped, self.copies),
+            "Dictionary coverage: {:.2f}% of tokens".format(summary["coverage"] * 100),
+            "Replaced tokens per source language: {}".format(summary["src_lang_replaced"]),
+            "Replaced tokens per target language: {}".format(summary["tgt_lang_replaced"]),
+            "Substitutions per copy: {}".format(summary["histogram"]),
+            "Lines/sec per stage: {}".format(
+                dict((k, round(v, 1)) for k, v in summary["stage_lines_per_sec"].items())),
+        ]
+        return "\n".join(lines)
@@ -1,215 +1,665 @@
 import sys
 import os
-from tqdm import tqdm
-from queue import Queue
-from multiprocessing import Pool
+import json
+import mmap
+import time
+import shutil
+import argparse
+import resource
+import tempfile
+import multiprocessing
+from array import array
 
-sys.setrecursionlimit(1000000)
+import numpy as np
+from tqdm import tqdm
 
 
 class DisjointSet:
     '''
      Disjoint Set data structure (Union–Find), is a data structure that keeps track of a
      set of elements partitioned into a number of disjoint (nonoverlapping) subsets.
+     The elements are the integer ids 0..n-1, the parents and sizes are kept in arrays and
+     `find` is iterative, so that there is no recursion limit to raise.
 
      Methods:
         find: Determine which subset a particular element is in. Takes an element of any
-        subset as an argument and returns a subset that contains our element.
+        subset as an argument and returns the root of the subset that contains our element.
 
         union: Join two subsets into a single subset. Takes two elements of any subsets
-        from disjoint_set and returns a disjoint_set with merged subsets.
+        and returns the root of the merged subset.
 
-        get: returns current disjoint set.
+        roots: returns the root of every element.
     '''
     
-    def __init__(self, init_arr):
-        self._disjoint_set = dict()
-        self._groups = dict()
-        self._set_size = dict()
-        if init_arr:
-            for item in list(set(init_arr)):
-                self._disjoint_set[item] = item
-                self._set_size[item] = 1
+    def __init__(self, size=0):
+        self._parent = array("i", range(size))
+        self._set_size = array("i", [1]) * size
+    
+    def __len__(self):
+        return len(self._parent)
+    
+    def grow(self, size):
+        """
+        Add the elements `len(self)` to `size` (excluded), each in its own subset.
+        """
+        self._parent.extend(range(len(self._parent), size))
+        self._set_size.extend(array("i", [1]) * (size - len(self._set_size)))
     
     def find(self, elem):
-        if elem in self._disjoint_set:
-            _parent = self._disjoint_set[elem]
-            if elem == _parent:
-                return _parent
-            else:
-                self._disjoint_set[elem] = self.find(_parent)
-                return self._disjoint_set[elem]
-        # init
-        self._disjoint_set[elem] = elem
-        self._set_size[elem] = 1
+        parent = self._parent
+        while parent[elem] != elem:
+            # path halving
+            parent[elem] = parent[parent[elem]]
+            elem = parent[elem]
         return elem
     
     def union(self, elem1, elem2):
         parent_elem1 = self.find(elem1)
         parent_elem2 = self.find(elem2)
-        
-        if parent_elem1 != parent_elem2:
-            if self._set_size[parent_elem1] < self._set_size[parent_elem2]:
-                self._disjoint_set[parent_elem1] = self._disjoint_set[parent_elem2]
-                self._set_size[parent_elem2] += self._set_size[parent_elem1]
-                del self._set_size[parent_elem1]
-            else:
-                self._disjoint_set[parent_elem2] = self._disjoint_set[parent_elem1]
-                self._set_size[parent_elem1] += self._set_size[parent_elem2]
-                del self._set_size[parent_elem2]
+        if parent_elem1 == parent_elem2:
+            return parent_elem1
+        if self._set_size[parent_elem1] < self._set_size[parent_elem2]:
+            parent_elem1, parent_elem2 = parent_elem2, parent_elem1
+        self._parent[parent_elem2] = parent_elem1
+        self._set_size[parent_elem1] += self._set_size[parent_elem2]
+        return parent_elem1
     
-    def get(self):
-        return self._disjoint_set
+    def roots(self):
+        """
+
+        :return: int array of the root of every element
+        """
+        for elem in range(len(self._parent)):
+            self._parent[elem] = self.find(elem)
+        return np.frombuffer(self._parent, dtype=np.int32).copy()
     
     def length(self):
-        return len(set(self._disjoint_set.values()))
-    
-    def group(self):
-        for key, parent in self._disjoint_set.items():
-            if parent not in self._groups:
-                self._groups[parent] = set()
-            self._groups[parent].add(key)
+        return int(np.count_nonzero(self.roots() == np.arange(len(self))))
     
     def max(self):
-        if len(self._groups) == 0:
-            self.group()
-        max_size = 0
-        for p in self._groups:
-            if len(self._groups[p]) > max_size:
-                max_size = len(self._groups[p])
-        return max_size
+        return max(self._set_size) if len(self) > 0 else 0
+    
+    def save(self, path):
+        np.save(os.path.join(path, "components.npy"), self.roots())
+    
+    @classmethod
+    def load(cls, path):
+        roots = np.load(os.path.join(path, "components.npy"))
+        disjoint_set = cls()
+        disjoint_set._parent = array("i", roots.astype(np.int32).tobytes())
+        disjoint_set._set_size = array("i", np.bincount(roots, minlength=len(roots)).astype(np.int32).tobytes())
+        return disjoint_set
+
+
+# frontiers of at least this many vertices are expanded with numpy
+NUMPY_FRONTIER = 256
 
 
-class Vertex:
-    def __init__(self, node):
-        self.id = node
-        self.adjacent = set()
+class StringTable:
+    """
+    The words of the graph, stored as one utf-8 buffer and the offsets of the words in it, instead of a dict of
+    Python strings.
+    """
     
-    def __str__(self):
-        return str(self.id) + ' adjacent: ' + str([x.id for x in self.adjacent])
+    def __init__(self, data, offsets):
+        """
+
+        :param data: the concatenated utf-8 encoded words
+        :param offsets: int64 array, word `i` is `data[offsets[i]:offsets[i + 1]]`
+        """
+        self.data = data
+        self.offsets = offsets
+    
+    @classmethod
+    def from_list(cls, words):
+        encoded = [w.encode("utf-8") for w in words]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(w) for w in encoded], out=offsets[1:])
+        return cls(b"".join(encoded), offsets)
+    
+    def __len__(self):
+        return len(self.offsets) - 1
     
-    def add_neighbor(self, neighbor):
-        self.adjacent.add(neighbor)
+    def __getitem__(self, i):
+        return self.data[self.offsets[i]:self.offsets[i + 1]].decode("utf-8")
     
-    def get_connections(self):
-        return self.adjacent
+    def nbytes(self):
+        return len(self.data) + self.offsets.nbytes
     
-    def get_id(self):
-        return self.id
+    def save(self, path):
+        with open(os.path.join(path, "strings.bin"), "wb") as f:
+            f.write(self.data)
+        np.save(os.path.join(path, "string_offsets.npy"), self.offsets)
+    
+    @classmethod
+    def load(cls, path):
+        """
+        Map the table saved by `save` in memory, the pages are shared by all processes that load it.
+        """
+        with open(os.path.join(path, "strings.bin"), "rb") as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.path.getsize(f.name) > 0 else b""
+        return cls(data, np.load(os.path.join(path, "string_offsets.npy"), mmap_mode="r"))
 
 
-class Graph:
-    def __init__(self):
-        self.vert_dict = {}
-        self.num_vertices = 0
-    
-    def __iter__(self):
-        return iter(self.vert_dict.values())
+class GraphBuilder:
+    """
+    Collect the edges of the word graph as pairs of integer ids, see `freeze`.
+    """
     
-    def add_vertex(self, node):
-        self.num_vertices = self.num_vertices + 1
-        new_vertex = Vertex(node)
-        self.vert_dict[node] = new_vertex
-        return new_vertex
+    def __init__(self, words=()):
+        """
+
+        :param words: the words of an existing graph, that keep their ids
+        """
+        self.words = list(words)
+        self.str2id = dict((word, _id) for _id, word in enumerate(self.words))
+        self.src_ids = array("i")
+        self.tgt_ids = array("i")
     
-    def get_vertex(self, n):
-        if n in self.vert_dict:
-            return self.vert_dict[n]
-        else:
-            return None
+    def word_id(self, word):
+        _id = self.str2id.get(word)
+        if _id is None:
+            _id = self.str2id[word] = len(self.words)
+            self.words.append(word)
+        return _id
     
     def add_edge(self, frm, to):
-        if frm not in self.vert_dict:
-            self.add_vertex(frm)
-        if to not in self.vert_dict:
-            self.add_vertex(to)
-        
-        self.vert_dict[frm].add_neighbor(self.vert_dict[to])
-        self.vert_dict[to].add_neighbor(self.vert_dict[frm])
-    
-    def get_vertices(self):
-        return self.vert_dict.keys()
-
-
-def get_adjacent_words(word_vertex, depth=3):
-    # print("-----{}-----".format(id2str[v.get_id()]))
-    curr_visited = set()
-    _q = Queue()
-    _q.put(word_vertex)
-    curr_visited.add(word_vertex.get_id())
-    visited_depth = dict()
-    _ls = []
-    _depth = 0
-    while _depth < depth:
-        _depth += 1
-        _num = 0
-        _adj_num = _q.qsize()
-        while _num < _adj_num:
-            _curr = _q.get()
-            for _v in _curr.get_connections():
-                if _v.get_id() not in curr_visited:
-                    curr_visited.add(_v.get_id())
-                    visited_depth[_v.get_id()] = _depth
-                    _q.put(_v)
-            _num += 1
-    _ls.append(id2str[word_vertex.get_id()])
-    for vid in curr_visited:
-        if vid != word_vertex.get_id():
-            _ls.append(id2str[vid] + "__" + str(visited_depth[vid]))
+        self.src_ids.append(self.word_id(frm))
+        self.tgt_ids.append(self.word_id(to))
+    
+    def add_edges(self, words, src_ids, tgt_ids):
+        """
+        Add the edges of a dictionary parsed with its own vocabulary, see `parse_dictionary`.
+
+        :param words: the local vocabulary
+        :param src_ids: int array of the local ids of the sources of the edges
+        :param tgt_ids: int array of the local ids of the targets of the edges
+        """
+        local2global = np.array([self.word_id(word) for word in words], dtype=np.int32)
+        self.src_ids.frombytes(local2global[src_ids].tobytes())
+        self.tgt_ids.frombytes(local2global[tgt_ids].tobytes())
+    
+    def edges(self):
+        return np.frombuffer(self.src_ids, dtype=np.int32), np.frombuffer(self.tgt_ids, dtype=np.int32)
+    
+    def freeze(self, base=None):
+        """
+
+        :param base: the `CSRGraph` of the words given to the constructor, whose edges are added to the new ones
+        :return: the `CSRGraph` of the edges and the `StringTable` of the words, the ids being the order in which
+            the words were first seen
+        """
+        src_ids, tgt_ids = self.edges()
+        if base is not None:
+            base_src_ids, base_tgt_ids = base.edges()
+            src_ids, tgt_ids = np.concatenate([base_src_ids, src_ids]), np.concatenate([base_tgt_ids, tgt_ids])
+        graph = CSRGraph.from_edges(src_ids, tgt_ids, len(self.words))
+        return graph, StringTable.from_list(self.words)
+
+
+class CSRGraph:
+    """
+    Undirected graph in compressed sparse row format: the neighbors of vertex `v` are
+    `indices[indptr[v]:indptr[v + 1]]`, sorted and without duplicates.
+    """
+    
+    def __init__(self, indptr, indices):
+        self.indptr = indptr
+        self.indices = indices
+        self.num_vertices = len(indptr) - 1
+        self._memoryviews = None
+    
+    @classmethod
+    def from_edges(cls, src_ids, tgt_ids, num_vertices):
+        # both directions, without self loops and duplicated edges
+        rows = np.concatenate([src_ids, tgt_ids]).astype(np.int64)
+        cols = np.concatenate([tgt_ids, src_ids]).astype(np.int64)
+        keep = rows != cols
+        keys = np.unique(rows[keep] * num_vertices + cols[keep])
+        rows, cols = np.divmod(keys, num_vertices)
+        indptr = np.zeros(num_vertices + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=num_vertices), out=indptr[1:])
+        return cls(indptr, cols.astype(np.int32))
+    
+    def edges(self):
+        """
+
+        :return: arrays (src, tgt) of the edges, each one once
+        """
+        rows = np.repeat(np.arange(self.num_vertices, dtype=np.int32), np.diff(self.indptr))
+        keep = rows < self.indices
+        return rows[keep], np.asarray(self.indices)[keep]
+    
+    @property
+    def num_edges(self):
+        return len(self.indices) // 2
+    
+    def nbytes(self):
+        return self.indptr.nbytes + self.indices.nbytes
+    
+    def save(self, path):
+        np.save(os.path.join(path, "indptr.npy"), self.indptr)
+        np.save(os.path.join(path, "indices.npy"), self.indices)
+    
+    @classmethod
+    def load(cls, path):
+        """
+        Map the arrays saved by `save` in memory, the pages are shared by all processes that load them.
+        """
+        return cls(np.load(os.path.join(path, "indptr.npy"), mmap_mode="r"),
+                   np.load(os.path.join(path, "indices.npy"), mmap_mode="r"))
+    
+    def neighbors(self, vertices):
+        """
+
+        :param vertices: array of vertex ids
+        :return: the concatenated neighbors of `vertices`
+        """
+        starts = self.indptr[vertices]
+        lens = self.indptr[vertices + 1] - starts
+        total = int(lens.sum())
+        if total == 0:
+            return np.zeros(0, dtype=self.indices.dtype)
+        # position of each neighbor in `indices`: the start of its vertex + its rank among the neighbors of the vertex
+        ends = np.cumsum(lens)
+        positions = np.arange(total) + np.repeat(starts - (ends - lens), lens)
+        return self.indices[positions]
+    
+    def bfs(self, vertex, depth, _visited=None):
+        """
+        Breadth-first search from `vertex`, level by level. Small frontiers, the common case for a dictionary
+        graph, are expanded in Python over memoryviews of the arrays, large ones with numpy.
+
+        :param _visited: a bytearray of `num_vertices` zeros, reused between calls to save allocations
+        :return: list of (depth, sorted list of the ids of the vertices first reached at that depth)
+        """
+        visited = bytearray(self.num_vertices) if _visited is None else _visited
+        indptr, indices = self._views()
+        visited[vertex] = 1
+        frontier = [vertex]
+        levels = []
+        for _depth in range(1, depth + 1):
+            if len(frontier) < NUMPY_FRONTIER:
+                reached = set()
+                for u in frontier:
+                    reached.update(indices[indptr[u]:indptr[u + 1]])
+                frontier = sorted(w for w in reached if not visited[w])
+            else:
+                candidates = np.unique(self.neighbors(np.array(frontier, dtype=np.int64)))
+                seen = np.frombuffer(visited, dtype=np.uint8)[candidates]
+                frontier = candidates[seen == 0].tolist()
+            if not frontier:
+                break
+            for w in frontier:
+                visited[w] = 1
+            levels.append((_depth, frontier))
+        # clean up for the next call
+        visited[vertex] = 0
+        for _, vertices in levels:
+            for w in vertices:
+                visited[w] = 0
+        return levels
+    
+    def _views(self):
+        if self._memoryviews is None:
+            self._memoryviews = (memoryview(self.indptr), memoryview(self.indices))
+        return self._memoryviews
+
+
+def get_adjacent_words(graph, id2str, vertex, depth=3, _visited=None):
+    """
+
+    :param graph: the `CSRGraph`
+    :param id2str: the `StringTable` of the words
+    :param vertex: the id of the source word
+    :param depth: the maximum depth of the neighbors
+    :return: the source word followed by its neighbors within `depth`, as "word__depth", ordered by depth
+    """
+    _ls = [id2str[vertex]]
+    for _depth, vertices in graph.bfs(vertex, depth, _visited):
+        suffix = "__" + str(_depth)
+        _ls.extend(id2str[vid] + suffix for vid in vertices)
     return _ls
 
 
-if __name__ == "__main__":
-    dict_path = sys.argv[1]
-    if len(sys.argv) > 2:
-        d = int(sys.argv[2])
-    else:
-        d = 3
-    myset = DisjointSet([])
-    count = 0
-    str2id = dict()
-    _len = 0
-    g = Graph()
-    for filename in tqdm(os.listdir(dict_path)):
-        # for line in tqdm(sys.stdin):
-        src, tgt = filename.split(".")[0].split("-")
-        count += 1
-        if count > 100:
+def write_adjacent_words(graph, id2str, depth, fw, vertices=None):
+    """
+    Write the line of `get_adjacent_words` of `vertices` (all by default) to `fw`, in order.
+    """
+    vertices = range(graph.num_vertices) if vertices is None else vertices
+    visited = bytearray(graph.num_vertices)
+    for v in vertices:
+        fw.write("\t".join(get_adjacent_words(graph, id2str, v, depth, visited)) + "\n")
+
+
+def _write_block(block):
+    graph_path, output_path, depth, block_id, vertices = block
+    # the arrays are mapped, not copied, in each worker
+    g, id2str = CSRGraph.load(graph_path), StringTable.load(graph_path)
+    shard_path = output_path + ".shard{}".format(block_id)
+    with open(shard_path, "w") as fw:
+        write_adjacent_words(g, id2str, depth, fw, vertices)
+    return shard_path
+
+
+def write_adjacent_words_parallel(graph, id2str, depth, output_path, workers, vertices=None, blocks_per_worker=4):
+    """
+    Write the neighbors of `vertices` (all by default) to `output_path` with `workers` processes. The graph is saved next to
+    the output and mapped by the workers, each of which expands a contiguous block of source vertices into an
+    output shard. The shards are concatenated in order, so the output is the same as with a single process.
+
+    :param blocks_per_worker: more blocks than workers, so that the blocks of hub words do not hold up the
+        others
+    """
+    graph_path = tempfile.mkdtemp(prefix=os.path.basename(output_path) + ".graph.",
+                                  dir=os.path.dirname(os.path.abspath(output_path)))
+    try:
+        graph.save(graph_path)
+        id2str.save(graph_path)
+        vertices = range(graph.num_vertices) if vertices is None else vertices
+        num_blocks = min(len(vertices), workers * blocks_per_worker) or 1
+        bounds = np.linspace(0, len(vertices), num_blocks + 1).astype(np.int64).tolist()
+        blocks = [(graph_path, output_path, depth, i, vertices[bounds[i]:bounds[i + 1]]) for i in range(num_blocks)]
+        with multiprocessing.Pool(workers) as pool, open(output_path, "wb") as fw:
+            # imap keeps the order of the blocks, each shard is appended once its block and all before are done
+            for shard_path in tqdm(pool.imap(_write_block, blocks, chunksize=1), total=num_blocks):
+                with open(shard_path, "rb") as f:
+                    shutil.copyfileobj(f, fw)
+                os.remove(shard_path)
+    finally:
+        shutil.rmtree(graph_path)
+
+
+def top_neighbors(graph, depth, top_k, vertices):
+    """
+    The neighborhoods of `vertices` in bulk, with sparse matrix products instead of one BFS per vertex.
+    Row `i` of the frontier `F_k` holds the vertices at depth `k` from vertex `vertices[i]`,
+    as in `CSRGraph.bfs`, with the number of shortest paths to them: `F_k` is `F_(k-1) @ A` without the
+    vertices already reached.
+
+    :param top_k: per vertex and depth, keep only the `top_k` neighbors with the most shortest paths (ties broken
+        by id), 0 keeps all of them. The paths are counted before the cut, so the ranking does not depend on it.
+    :return: arrays (row, depth, col), sorted by row, depth, number of paths (descending) and col
+    """
+    try:
+        import scipy.sparse as sp
+    except ImportError:
+        raise ImportError("Please install scipy with: pip install scipy")
+    n = graph.num_vertices
+    adjacency = sp.csr_matrix((np.ones(len(graph.indices)), graph.indices, graph.indptr), shape=(n, n))
+    num_rows = len(vertices)
+    frontier = adjacency[vertices]
+    # the vertices already reached by each row, starting with the source itself
+    reached = sp.csr_matrix((np.ones(num_rows, dtype=bool), (np.arange(num_rows), vertices)), shape=(num_rows, n))
+    rows, depths, counts, cols = [], [], [], []
+    for _depth in range(1, depth + 1):
+        if _depth > 1:
+            frontier = frontier @ adjacency
+        frontier = frontier - frontier.multiply(reached)
+        frontier.eliminate_zeros()
+        if frontier.nnz == 0:
             break
-        # print("==={}2{}===".format(src, tgt))
-        with open(os.path.join(dict_path, filename), "r") as f:
-            for line in f:
-                try:
-                    src_word, tgt_word = line.strip().split(" ")
-                except:
-                    src_word, tgt_word = line.strip().split("\t")
-                # src
-                src_final_word = src.upper() + "__" + src_word
-                if src_final_word not in str2id:
-                    str2id[src_final_word] = _len
-                    _len += 1
-                _src_id = str2id[src_final_word]
-                
-                # tgt
-                tgt_final_word = tgt.upper() + "__" + tgt_word
-                if tgt_final_word not in str2id:
-                    str2id[tgt_final_word] = _len
-                    _len += 1
-                _tgt_id = str2id[tgt_final_word]
-                
-                # myset.union(src_final_word, tgt_final_word)
-                g.add_edge(_src_id, _tgt_id)
-    id2str = dict([(v, k) for k, v in str2id.items()])
-    
-    # pool = Pool(10)
-    
-    with open("dict.merge_dep{}.txt".format(str(d)), "w") as fw:
-        for v in tqdm(g.vert_dict.values()):
-        # for _id in tqdm(range(1000)):
-        #     v = g.get_vertex(_id)
-            _ls = get_adjacent_words(v, d)
-            #     sys.stdout.write("\t".join(_ls)+"\n")
-            # for _ls in list(tqdm(pool.imap(get_adjacent_words, g.vert_dict.values()))):
+        if _depth < depth:
+            reached = reached + frontier.astype(bool)
+        frontier.sort_indices()
+        if top_k > 0:
+            _rows, _counts, _cols = _top_k_per_row(frontier, top_k)
+        else:
+            new = frontier.tocoo()
+            _rows, _counts, _cols = new.row, new.data, new.col
+        rows.append(_rows)
+        depths.append(np.full(len(_rows), _depth))
+        counts.append(_counts)
+        cols.append(_cols)
+    if not rows:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    rows, depths, counts, cols = [np.concatenate(x) for x in (rows, depths, counts, cols)]
+    order = np.lexsort((cols, -counts, depths, rows))
+    return rows[order], depths[order], cols[order]
+
+
+def _top_k_per_row(matrix, top_k):
+    """
+
+    :param matrix: a csr matrix with sorted indices
+    :return: arrays (row, value, col) of the `top_k` entries with the largest values of each row, ties broken by col
+    """
+    keep = []
+    indptr, data = matrix.indptr, matrix.data
+    for row in np.nonzero(np.diff(indptr) > top_k)[0].tolist():
+        start, end = indptr[row], indptr[row + 1]
+        values = data[start:end]
+        # the entries at least as large as the k-th largest, then the order among them
+        candidates = np.nonzero(values >= np.partition(values, len(values) - top_k)[len(values) - top_k])[0]
+        if len(candidates) > top_k:
+            candidates = candidates[np.argsort(-values[candidates], kind="stable")[:top_k]]
+        keep.append(start + candidates)
+    short = np.diff(indptr) <= top_k
+    keep.append(np.nonzero(np.repeat(short, np.diff(indptr)))[0])
+    keep = np.concatenate(keep)
+    rows = np.repeat(np.arange(matrix.shape[0]), np.diff(indptr))
+    return rows[keep], data[keep], matrix.indices[keep]
+
+
+def write_top_neighbors(graph, id2str, depth, top_k, fw, block_size=1024, vertices=None):
+    """
+    Write the neighbors of `vertices` (all by default) found by `top_neighbors`, in the format of
+    `write_adjacent_words`, `block_size` source vertices at a time to bound the size of the products.
+    """
+    vertices = np.arange(graph.num_vertices) if vertices is None else np.asarray(vertices)
+    for first in tqdm(range(0, len(vertices), block_size)):
+        block = vertices[first:first + block_size]
+        rows, depths, cols = top_neighbors(graph, depth, top_k, block)
+        bounds = np.searchsorted(rows, np.arange(len(block) + 1)).tolist()
+        depths, cols = depths.tolist(), cols.tolist()
+        for i, v in enumerate(block.tolist()):
+            _ls = [id2str[v]]
+            _ls.extend(id2str[cols[j]] + "__" + str(depths[j]) for j in range(bounds[i], bounds[i + 1]))
             fw.write("\t".join(_ls) + "\n")
+
+
+def parse_dictionary(dict_path, filename):
+    """
+    Parse the dictionary `filename` (xx-yy.txt), with one word pair per line separated by a space or a tab, into
+    integer edges over a vocabulary of its own, so that dictionaries can be parsed in parallel.
+
+    :return: dict of the `filename`, the local vocabulary `words`, the deduplicated edges `src_ids` and `tgt_ids`
+        over it, the number of `lines` and `malformed` lines (skipped) and the `seconds` it took
+    """
+    start_time = time.time()
+    src, tgt = filename.split(".")[0].split("-")
+    src_prefix, tgt_prefix = src.upper() + "__", tgt.upper() + "__"
+    str2id = dict()
+    src_ids, tgt_ids = array("i"), array("i")
+    num_lines = num_malformed = 0
+    with open(os.path.join(dict_path, filename), "r") as f:
+        for line in f:
+            num_lines += 1
+            pair = line.strip().split(" ")
+            if len(pair) != 2:
+                pair = line.strip().split("\t")
+            if len(pair) != 2 or not pair[0] or not pair[1]:
+                num_malformed += 1
+                continue
+            src_ids.append(str2id.setdefault(src_prefix + pair[0], len(str2id)))
+            tgt_ids.append(str2id.setdefault(tgt_prefix + pair[1], len(str2id)))
+    edges = np.unique(np.frombuffer(src_ids, dtype=np.int32).astype(np.int64) * max(len(str2id), 1) +
+                      np.frombuffer(tgt_ids, dtype=np.int32))
+    src_ids, tgt_ids = np.divmod(edges, max(len(str2id), 1))
+    return {"filename": filename, "words": list(str2id), "src_ids": src_ids.astype(np.int32),
+            "tgt_ids": tgt_ids.astype(np.int32), "lines": num_lines, "malformed": num_malformed,
+            "seconds": time.time() - start_time}
+
+
+def _parse_dictionary(arg):
+    return parse_dictionary(*arg)
+
+
+def read_dictionaries(builder, dict_path, filenames, workers=0):
+    """
+    Parse the dictionaries `filenames`, with `workers` processes if > 0, and add their edges to `builder` in the
+    order of `filenames`, so that the word ids do not depend on the number of workers.
+    """
+    args = [(dict_path, filename) for filename in filenames]
+    pool = multiprocessing.Pool(workers) if workers > 0 and len(filenames) > 1 else None
+    try:
+        results = pool.imap(_parse_dictionary, args) if pool is not None else map(_parse_dictionary, args)
+        for result in tqdm(results, total=len(filenames)):
+            builder.add_edges(result["words"], result["src_ids"], result["tgt_ids"])
+            tqdm.write("{}: {} lines, {} pairs, {} words, {} malformed lines, {:.2f} seconds".format(
+                result["filename"], result["lines"], len(result["src_ids"]), len(result["words"]),
+                result["malformed"], result["seconds"]))
+    finally:
+        if pool is not None:
+            pool.close()
+
+
+def list_dictionaries(dict_path):
+    """
+
+    :return: the names of the dictionaries xx-yy.txt in `dict_path`, sorted
+    """
+    return sorted(filename for filename in os.listdir(dict_path)
+                  if filename.endswith(".txt") and len(filename[:-len(".txt")].split("-")) == 2)
+
+
+def write_neighbors(args, graph, id2str, output_path, vertices=None):
+    """
+    Write the neighbors of `vertices` (all by default) to `output_path` with the engine of `args`.
+    """
+    if args.engine == "sparse":
+        with open(output_path, "w") as fw:
+            write_top_neighbors(graph, id2str, args.depth, args.top_k, fw, args.block_size, vertices)
+    elif args.workers > 0:
+        write_adjacent_words_parallel(graph, id2str, args.depth, output_path, args.workers, vertices)
+    else:
+        with open(output_path, "w") as fw:
+            write_adjacent_words(graph, id2str, args.depth, fw, vertices)
+
+
+def patch_output(output_path, patch_path, num_vertices, affected):
+    """
+    Replace the lines of the `affected` vertices in `output_path` with the lines of `patch_path`, which has one
+    line per affected vertex in order. Vertices after the last line of `output_path` are new, hence affected.
+    """
+    is_affected = np.zeros(num_vertices, dtype=bool)
+    is_affected[affected] = True
+    with open(output_path, "rb") as old, open(patch_path, "rb") as patch, open(output_path + ".tmp", "wb") as fw:
+        for v in range(num_vertices):
+            old_line = old.readline()
+            fw.write(patch.readline() if is_affected[v] else old_line)
+    os.replace(output_path + ".tmp", output_path)
+    os.remove(patch_path)
+
+
+# the settings that the output of an incremental build must share with the saved graph
+STATE_SETTINGS = ("depth", "engine", "top_k")
+
+
+def save_state(graph_dir, graph, id2str, components, files, args):
+    """
+    Save the graph, its words and components and the dictionaries it was built from to `graph_dir`, for
+    `--incremental`. The directory is replaced at once, so that it is never left half written.
+    """
+    tmp_dir = graph_dir.rstrip("/") + ".tmp"
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+    graph.save(tmp_dir)
+    id2str.save(tmp_dir)
+    components.save(tmp_dir)
+    state = dict((name, getattr(args, name)) for name in STATE_SETTINGS)
+    state["files"] = files
+    with open(os.path.join(tmp_dir, "state.json"), "w") as f:
+        json.dump(state, f, indent=1)
+    if os.path.exists(graph_dir):
+        shutil.rmtree(graph_dir)
+    os.rename(tmp_dir, graph_dir)
+
+
+def load_state(graph_dir, args):
+    """
+
+    :return: the graph, words, components and the dictionaries saved by `save_state`
+    """
+    with open(os.path.join(graph_dir, "state.json"), "r") as f:
+        state = json.load(f)
+    for name in STATE_SETTINGS:
+        if state[name] != getattr(args, name):
+            raise ValueError("{} was built with {} {}, not {}".format(graph_dir, name, state[name],
+                                                                         getattr(args, name)))
+    return CSRGraph.load(graph_dir), StringTable.load(graph_dir), DisjointSet.load(graph_dir), state["files"]
+
+
+def peak_memory():
+    """
+
+    :return: the peak resident memory of the process in MB
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('dict_path', help="The directory of the bilingual dictionaries xx-yy.txt.")
+    parser.add_argument('depth', nargs='?', type=int, default=3, help="The maximum depth of the neighbors.")
+    parser.add_argument('--workers', type=int, default=0,
+                        help="Parse the dictionaries and expand the neighbors (bfs engine) with this many "
+                             "processes, that share the graph by mmap.")
+    parser.add_argument('--engine', choices=['bfs', 'sparse'], default='bfs',
+                        help="bfs: one breadth-first search per word. sparse: all neighborhoods in blocks of "
+                             "sparse matrix products, with --top_k.")
+    parser.add_argument('--top_k', type=int, default=0,
+                        help="sparse engine: keep the top k neighbors per word and depth by number of paths, "
+                             "0 keeps all.")
+    parser.add_argument('--block_size', type=int, default=1024,
+                        help="sparse engine: the number of words per block of matrix products.")
+    parser.add_argument('--graph_dir', default=None,
+                        help="Save the graph and its components to this directory, for --incremental.")
+    parser.add_argument('--incremental', action='store_true',
+                        help="Add the dictionaries of dict_path that are not yet in --graph_dir to the graph, and "
+                             "only rewrite the lines of the words whose components they touch in the output.")
+    args = parser.parse_args()
+    dict_path = args.dict_path
+    d = args.depth
+    output_path = "dict.merge_dep{}.txt".format(str(d))
+    if args.incremental and (args.graph_dir is None or not os.path.exists(output_path)):
+        raise ValueError("--incremental needs the --graph_dir and the {} of a previous build".format(output_path))
+    
+    start_time = time.time()
+    if args.incremental:
+        old_graph, old_id2str, components, files = load_state(args.graph_dir, args)
+        new_files = [filename for filename in list_dictionaries(dict_path) if filename not in files]
+        builder = GraphBuilder(old_id2str[i] for i in range(len(old_id2str)))
+    else:
+        old_graph, components, files = None, DisjointSet(), []
+        new_files = list_dictionaries(dict_path)
+        builder = GraphBuilder()
+    read_dictionaries(builder, dict_path, new_files, args.workers)
+    g, id2str = builder.freeze(old_graph)
+    
+    # the components touched by the new edges
+    components.grow(g.num_vertices)
+    src_ids, tgt_ids = builder.edges()
+    for src_id, tgt_id in zip(src_ids.tolist(), tgt_ids.tolist()):
+        components.union(src_id, tgt_id)
+    roots = components.roots()
+    affected = np.nonzero(np.isin(roots, roots[src_ids]))[0]
+    del builder, old_graph
+    print("Graph built in {:.1f} seconds: {} vertices, {} edges, {} components (largest {}), {:.1f} MB of arrays, "
+          "peak memory {:.1f} MB".format(time.time() - start_time, g.num_vertices, g.num_edges, components.length(),
+                                         components.max(), (g.nbytes() + id2str.nbytes()) / 1024 / 1024,
+                                         peak_memory()))
+    
+    start_time = time.time()
+    if args.incremental:
+        print("{} new dictionaries, {} of {} words to update".format(len(new_files), len(affected), g.num_vertices))
+        write_neighbors(args, g, id2str, output_path + ".patch", affected)
+        patch_output(output_path, output_path + ".patch", g.num_vertices, affected)
+    else:
+        write_neighbors(args, g, id2str, output_path)
+    if args.graph_dir is not None:
+        save_state(args.graph_dir, g, id2str, components, files + new_files, args)
     
+    print("Neighbors written in {:.1f} seconds, peak memory {:.1f} MB".format(time.time() - start_time, peak_memory()))
     print("finished")
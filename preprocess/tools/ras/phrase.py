@@ -0,0 +1,59 @@
+from bisect import bisect_left
+from itertools import accumulate
+
+import ahocorasick as ahc
+
+
+def _key(tokens):
+    # each token is enclosed in a space and a tab, that cannot be part of a token, so that a match always starts
+    # and ends at token boundaries, and two adjacent tokens do not share a delimiter
+    return " " + "\t ".join(tokens) + "\t"
+
+
+class PhraseMatcher(object):
+    """
+    One Aho-Corasick automaton over the multi-word entries ("new york") of a dictionary, so that the phrases of
+    a sentence are found in a single linear pass.
+
+    Single-token entries are left to the dictionary lookups of the callers: a phrase always wins over the single
+    tokens it overlaps under the leftmost-longest rule, so the matches are the same as with an automaton over
+    all entries, and the sentences without any phrase cost no more than the token-level lookups.
+    """
+
+    def __init__(self, entries):
+        """
+
+        :param entries: the entries of the dictionaries, only the phrases are kept. A compiled dictionary (see
+            `compiled_dict`) only gives its phrases, without decoding its other entries.
+        """
+        if hasattr(entries, "phrases"):
+            entries = entries.phrases()
+        self.automaton = ahc.Automaton()
+        for entry in entries:
+            tokens = entry.split()
+            if len(tokens) > 1:
+                self.automaton.add_word(_key(tokens), (len(tokens), entry))
+        self.automaton.make_automaton()
+
+    def __len__(self):
+        return len(self.automaton)
+
+    def match(self, tokens):
+        """
+        Find the leftmost-longest non-overlapping phrases in `tokens`.
+
+        :param tokens: list of tokens
+        :return: list of (start, end, entry), `tokens[start:end]` is `entry`
+        """
+        if len(self.automaton) == 0 or len(tokens) < 2:
+            return []
+        matches = list(self.automaton.iter_long(_key(tokens)))
+        if not matches:
+            return []
+        # the end of each token in the key
+        token_ends = list(accumulate(len(token) + 2 for token in tokens))
+        result = []
+        for char_end, (length, entry) in matches:
+            end = bisect_left(token_ends, char_end + 1) + 1
+            result.append((end - length, end, entry))
+        return result
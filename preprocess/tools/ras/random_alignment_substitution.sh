@@ -6,7 +6,7 @@ dict_path_basename=`basename ${ras_dict_path}`
 # get MUSE dictionaries
 echo "Down load MUSE dictionaries ... ..."
 cd ${dict_path_root}
-if [[ ! -d ${dict_path_basename} ]]; then
+if [[ ! -d ${dict_path_basename} && ! -f ${dict_path_basename} ]]; then
     if [[ ! -f dictionaries.tar.gz ]]; then
         wget https://dl.fbaipublicfiles.com/arrival/dictionaries.tar.gz
     fi
@@ -23,23 +23,22 @@ cd ${repo_dir}
 
 command=""
 
-for varname in dict_path replace_prob num_repeat vocab_size
+for varname in dict_path replace_prob num_repeat vocab_size batch_size workers seed metrics_log space checkpoint_interval
 do
     ras_varname=ras_${varname}
     if [[ ${!ras_varname} ]]; then
      command=${command}" --${varname} ${!ras_varname}"
     fi
 done
+# continue an interrupted run from its checkpoint
+[[ ${ras_resume} == "true" ]] && command=${command}" --resume"
 
 # use default if `ras_target_languages` is not set
 [[ -z ${ras_target_languages} ]] && langs=${languages} || langs=${ras_target_languages}
 
 codes_file=${final_vocab_path}/codes.bpe.${subword_bpe_merge_ops}
-python -m tools.ras.replace_word --langs ${langs} ${command} --data_path ${merged_output_path}
-cat ${merged_output_path}/expanded_train.src | mulitprocess_pipeline "subword-nmt apply-bpe -c ${codes_file}" ${num_cpus} > ${merged_output_path}/expanded_train_bpe.src
-paste -d ' ' ${merged_output_path}/lang_indicator.src ${merged_output_path}/expanded_train_bpe.src > ${merged_output_path}/expanded_train_final.src
-rm ${merged_output_path}/lang_indicator.src ${merged_output_path}/expanded_train_bpe.src ${merged_output_path}/expanded_train.src
-mv ${merged_output_path}/expanded_train_final.src ${merged_output_path}/expanded_train.src
+# remove bpe, replace and re-apply bpe in one pass, expanded_train.src contains the final lines
+python -m tools.ras.replace_word --langs ${langs} ${command} --codes ${codes_file} --data_path ${merged_output_path}
 if [[ ${mono} == "true" ]]; then
     cat ${merged_output_path}/expanded_train.src > ${merged_output_path}/train.src
     cat ${merged_output_path}/expanded_train.trg > ${merged_output_path}/train.trg
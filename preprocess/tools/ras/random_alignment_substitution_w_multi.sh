@@ -4,13 +4,15 @@ cd ${repo_dir}
 
 command=""
 
-for varname in multi_dict_path replace_prob num_repeat vocab_size max_dep
+for varname in multi_dict_path replace_prob num_repeat vocab_size max_dep workers seed metrics_log space checkpoint_interval
 do
     ras_varname=ras_${varname}
     if [[ ${!ras_varname} ]]; then
      command=${command}" --${varname} ${!ras_varname}"
     fi
 done
+# continue an interrupted run from its checkpoint
+[[ ${ras_resume} == "true" ]] && command=${command}" --resume"
 
 # use default if `ras_languages` and `ras_target_languages` is not set
 [[ -z ${ras_languages} ]] && langs=${languages} || langs=${ras_languages}
@@ -18,11 +20,8 @@ done
 
 codes_file=${final_vocab_path}/codes.bpe.${subword_bpe_merge_ops}
 echo "--langs ${languages} --target-langs ${languages} ${command} --data_path ${merged_output_path}"
-python -m tools.ras.replace_word_w_multi --langs ${langs} --target-langs ${target_langs} ${command} --data_path ${merged_output_path}
-cat ${merged_output_path}/expanded_train.src | mulitprocess_pipeline "subword-nmt apply-bpe -c ${codes_file}" ${num_cpus} > ${merged_output_path}/expanded_train_bpe.src
-paste -d ' ' ${merged_output_path}/lang_indicator.src ${merged_output_path}/expanded_train_bpe.src > ${merged_output_path}/expanded_train_final.src
-rm ${merged_output_path}/lang_indicator.src ${merged_output_path}/expanded_train_bpe.src ${merged_output_path}/expanded_train.src
-mv ${merged_output_path}/expanded_train_final.src ${merged_output_path}/expanded_train.src
+# remove bpe, replace and re-apply bpe in one pass, expanded_train.src contains the final lines
+python -m tools.ras.replace_word_w_multi --langs ${langs} --target-langs ${target_langs} ${command} --codes ${codes_file} --data_path ${merged_output_path}
 if [[ ${mono} == "true" ]]; then
     cat ${merged_output_path}/expanded_train.src > ${merged_output_path}/train.src
     cat ${merged_output_path}/expanded_train.trg > ${merged_output_path}/train.trg
@@ -5,16 +5,43 @@ import argparse
 from pprint import pprint
 import time
 
+from ..subword.scripts.bpe.bpe import BPE
+from .batch_ras import BatchRAS
+from .compiled_dict import CompiledDict, BilingualDict
+from .phrase import PhraseMatcher
+from .stream import CHECKPOINT_INTERVAL, replace_corpus, line_seed
+from .subword import GluedSubwords, segment_muse_dicts
+
 random.seed(1)
 
 parser = argparse.ArgumentParser()
 parser.add_argument('--langs', required=True, help="The iso 639-2 code of languages that we apply RAS."
                                                    " We use MUSE dictionary for each en-x pair.")
-parser.add_argument('--dict_path', required=True)
+parser.add_argument('--dict_path', required=True,
+                    help="The root of MUSE dictionaries, or their compiled version (see `tools.ras.compiled_dict`).")
 parser.add_argument('--data_path', required=True)
 parser.add_argument('--num_repeat', type=int, default=1)
 parser.add_argument('--replace_prob', type=float, default=0.15)
 parser.add_argument('--vocab_size', type=int, default=2000)
+parser.add_argument('--batch_size', type=int, default=0,
+                    help="Number of sentences replaced together by the vectorized engine, 0 to replace token by token. "
+                         "The vectorized engine only replaces single tokens, not the multi-word entries.")
+parser.add_argument('--codes', default=None,
+                    help="BPE codes. If provided, bpe is re-applied in-process and the final lines with language "
+                         "token are written to expanded_train.src in one pass.")
+parser.add_argument('--workers', type=int, default=0,
+                    help="Number of processes. If > 0, each line uses a random seed derived from (seed, line number) "
+                         "and the output is the same for any number of workers.")
+parser.add_argument('--seed', type=int, default=1)
+parser.add_argument('--resume', action='store_true',
+                    help="Continue from the checkpoint of the last interrupted run with the same arguments.")
+parser.add_argument('--checkpoint_interval', type=int, default=CHECKPOINT_INTERVAL,
+                    help="Save a checkpoint, and sync the outputs to the disk, every N lines.")
+parser.add_argument('--space', choices=["word", "subword"], default="word",
+                    help="In the subword space, the dictionaries are segmented with --codes once, and the words are "
+                         "replaced on the bpe-ed corpus without removing and re-applying bpe.")
+parser.add_argument('--metrics_log', default=None,
+                    help="If provided, the RAS metrics are appended to this file as JSON lines while running.")
 args = parser.parse_args()
 pprint(args)
 
@@ -23,19 +50,6 @@ dict_path = args.dict_path
 data_path = args.data_path
 
 
-# remove bpe
-def remove_bpe(input_sentence, bpe_symbol="@@ "):
-    """
-    
-    :param input_sentence: the input sentence that is processed by bpe sub-word operation.
-    :param bpe_symbol: the bpe indicator(default: '@@ '), which will be removed after the `remove_bpe` function
-    :return: the output sentence that is recovered from  sub-word operation.
-    """
-    _sentence = input_sentence.replace("\n", '')
-    _sentence = (_sentence + ' ').replace(bpe_symbol, '').rstrip()
-    return _sentence + "\n"
-
-
 # read dictionaries
 def load_dicts(dictionary_path, languages):
     """
@@ -54,7 +68,8 @@ def load_dicts(dictionary_path, languages):
         with open(os.path.join(dictionary_path, pair_name+".txt")) as f:
             i = 0
             for _line in f:
-                bi_text = _line.strip().split()
+                # tab separated lines may contain phrases
+                bi_text = _line.strip().split("\t") if "\t" in _line else _line.strip().split()
                 assert len(bi_text) == 2, ("in file {}/{}, line index {} has an invalid number of columns {}"
                                            .format(dictionary_path, pair_name, i, len(bi_text)))
                 x2y_dict[bi_text[0]].append(bi_text[1])
@@ -67,109 +82,157 @@ def load_dicts(dictionary_path, languages):
     return dict_of_dict
 
 
+# replace single tokens
+def replace_tokens(tokens, dictionary, rng, new_tokens):
+    """
+
+    :param new_tokens: the list where the new tokens are appended
+    :return: the number of substituted tokens and the number of tokens in the dictionary
+    """
+    cnt = 0
+    covered = 0
+    for token in tokens:
+        candidates = dictionary.get(token)
+        if candidates is None:
+            new_tokens.append(token)
+            continue
+        covered += 1
+        if rng.random() < args.replace_prob:
+            # a candidate can be a phrase
+            new_tokens.extend(rng.choice(candidates).split())
+            cnt += 1
+        else:
+            new_tokens.append(token)
+    return cnt, covered
+
+
 # replace tokens in one sentence
-def replace_one_sent(tokens, dictionary):
+def replace_one_sent(tokens, dictionary, rng=random, phrases=()):
     """
 
     :param tokens:
     :param dict: is a default dict with list as key
-    :return:
+    :param rng: the random generator, the global one of `random` by default
+    :param phrases: the phrases of `dictionary` found in `tokens` by its `PhraseMatcher`, they are replaced as
+        a whole
+    :return: the new tokens, the number of substituted entries and the number of tokens in the dictionary
     """
     cnt = 0
+    covered = 0
     new_tokens = []
-    for token in tokens:
-        if token in dictionary and random.random() < args.replace_prob:
-            new_tokens.append(random.choice(dictionary[token]))
+    last = 0
+    for start, end, phrase in phrases:
+        candidates = dictionary.get(phrase)
+        if candidates is None:
+            # no candidate, its tokens are looked up one by one
+            continue
+        _cnt, _covered = replace_tokens(tokens[last:start], dictionary, rng, new_tokens)
+        cnt += _cnt
+        covered += _covered + end - start
+        if rng.random() < args.replace_prob:
+            new_tokens.extend(rng.choice(candidates).split())
             cnt += 1
         else:
-            new_tokens.append(token)
+            new_tokens.extend(tokens[start:end])
+        last = end
+    _cnt, _covered = replace_tokens(tokens[last:], dictionary, rng, new_tokens)
 
-    return new_tokens, cnt
+    return new_tokens, cnt + _cnt, covered + _covered
 
 
 # from one sentence we get several copies
-def replace_sent(sentence, dictionaries):
+def replace_sent(sentence, dictionaries, rng=random, metrics=None, src_lang=None):
     """
 
     :param sentence: list of token in the sentence
     :param dictionaries: all dictionaries
-    :param langs: all languages involved
-    :return:
+    :param rng: the random generator, the global one of `random` by default
+    :param metrics: if provided, a `RASMetrics` where each copy is recorded
+    :param src_lang: the language of the sentence, for `metrics`
+    :return: the replaced copies
     """
-    replace_cnt = 0
-    total_token = 0
     replaced_sents = []
-    selected_langs = random.sample(langs, args.num_repeat)
+    selected_langs = rng.sample(langs, args.num_repeat)
     # randomly select `num_repeat` languages from the list, create `num_repeat` copies for each sentence
     for _lang in selected_langs:
         dict_name = "en-" + _lang
         assert dict_name in dictionaries, ("{} not in dictionaries!".format(dict_name))
         selected_dict = dictionaries[dict_name]
-        new_sent, cnt = replace_one_sent(sentence, selected_dict)
+        # the longest phrases of this dictionary: a longer phrase of another dictionary must not hide them
+        phrases = matchers[dict_name].match(sentence) if matchers is not None else ()
+        new_sent, cnt, covered = replace_one_sent(sentence, selected_dict, rng, phrases)
         if cnt > 0:
             replaced_sents.append(new_sent)
-        replace_cnt += cnt
-        total_token += len(new_sent)
+        if metrics is not None:
+            metrics.add_copy(src_lang, len(new_sent), covered, {_lang: cnt} if cnt > 0 else {})
+
+    return replaced_sents
 
-    return replaced_sents, replace_cnt, total_token
+
+# replace a block of sentences
+def replace_block(block, first_line, metrics):
+    """
+
+    :param block: list of (source tokens with language token, target line)
+    :param first_line: the line number of the first sentence of the block
+    :param metrics: the `RASMetrics` where the counts are recorded
+    :return: the replaced copies of each sentence
+    """
+    sents = [src_sent[1:] for src_sent, _ in block]  # remove language token
+    src_langs = [src_sent[0][9:].lower() for src_sent, _ in block]
+    if engine is not None:
+        return engine.replace_block(sents, first_line, metrics, src_langs)
+    replaced_sents = []
+    for i, sent in enumerate(sents):
+        rng = random
+        if args.workers > 0:
+            rng = random.Random(line_seed(args.seed, first_line + i))
+        replaced_sents.append(replace_sent(sent, dicts, rng, metrics, src_langs[i]))
+    return replaced_sents
 
 
 if __name__ == "__main__":
-    # 1. remove-bpe
-    with open(os.path.join(data_path, "train.src"), 'r') as f, \
-            open(os.path.join(data_path, "removed_bpe_file.src"), 'w+') as fw:
-        for line in f:
-            new_line = remove_bpe(line, "@@ ")
-            fw.write(new_line)
-    
-    print("======[Remove bpe Finished]======")
-    
-    # 2. load dictionaries
-    dicts = load_dicts(dict_path, langs)
+    # 1. load dictionaries
+    if CompiledDict.is_compiled(dict_path):
+        # memory-mapped, `vocab_size` is applied when compiling
+        compiled = CompiledDict(dict_path)
+        if compiled.vocab_size != args.vocab_size:
+            raise ValueError("{} was compiled with --vocab_size {}, not {}, compile it again".format(
+                dict_path, compiled.vocab_size, args.vocab_size))
+        dicts = dict(("en-" + lang, BilingualDict(compiled, "en", lang)) for lang in langs)
+    else:
+        dicts = load_dicts(dict_path, langs)
     print(dicts.keys())
     
     for dict_name in dicts:
         print("The length of dict {dict_name} is {len}".format(dict_name=dict_name, len=len(dicts[dict_name])))
     print("======[Dicts Loaded]======")
+
+    bpe = None
+    if args.codes:
+        bpe = BPE(args.codes)
+    if args.space == "subword":
+        assert bpe is not None, "--codes is required in the subword space"
+        bpe = GluedSubwords(bpe)
+        segment_start = time.time()
+        dicts = segment_muse_dicts(dicts, bpe)
+        print("Dicts segmented in {} seconds".format(time.time() - segment_start))
+
+    random.seed(args.seed)
+    engine = None
+    matchers = None
+    if args.batch_size > 0:
+        engine = BatchRAS(dicts, langs, args.replace_prob, args.num_repeat, args.seed)
+    else:
+        # one automaton over the phrases of each en-x dictionary, they are replaced as a whole
+        matchers = dict((dict_name, PhraseMatcher(dictionary)) for dict_name, dictionary in dicts.items())
     
     start_time = time.time()
-    # 3. replace
-    with open(os.path.join(data_path, 'removed_bpe_file.src'), 'r') as src_file_read, \
-            open(os.path.join(data_path, 'expanded_train.src'), 'w+') as src_file_write, \
-            open(os.path.join(data_path, "train.trg"), 'r') as trg_file_read, \
-            open(os.path.join(data_path, "expanded_train.trg"), 'w+') as trg_file_write, \
-            open(os.path.join(data_path, "lang_indicator.src"), 'w+') as lang_indic_write:
-        total_replace, total_token = 0, 0
-        src_sent = src_file_read.readline()
-        trg_sent = trg_file_read.readline()
-        while src_sent and trg_sent:
-            src_sent = src_sent.strip().split()
-            sent = src_sent[1:]  # remove language token
-            
-            replaced_sents, replace_cnt, sent_token = replace_sent(sent, dicts)
-            total_replace += replace_cnt
-            total_token += sent_token
-            replaced_sents = [sent for sent in replaced_sents]
-            replaced_sents = [" ".join(sent) + "\n" for sent in replaced_sents]
-    
-            # write every sent so to save memory
-            for r_sent in replaced_sents:
-                src_file_write.write(r_sent)
-    
-            for _ in range(len(replaced_sents)):
-                trg_file_write.write(trg_sent)
-                lang_indic_write.write(src_sent[0]+"\n")
-    
-            src_sent = src_file_read.readline()
-            trg_sent = trg_file_read.readline()
-    
-    print("======[Replaced with dict Finished]======")
-    print("Done in {} seconds".format(time.time() - start_time))
-    
-    print("Total Tokens(with repeated times) is {total_token}, with {replaced_token} replaced.\n"
-          "With a proportion of {proportion}% \n"
-          "The repeated times are set to {num_repeat}"
-          .format(total_token=total_token, replaced_token=total_replace, num_repeat=args.num_repeat,
-                  proportion=total_replace / total_token * 100))
+    # 2. remove bpe, replace (and re-apply bpe)
+    metrics = replace_corpus(data_path, replace_block, bpe, args.batch_size or 10000, args.workers,
+                             args.metrics_log, args.resume, args.checkpoint_interval)
 
-    os.system("rm {}".format(os.path.join(data_path, 'removed_bpe_file.src')))
+    print("======[Replaced with dict Finished]======")
+    elapsed = time.time() - start_time
+    print("Done in {} seconds, {:.1f} lines/sec".format(elapsed, metrics.lines / max(elapsed, 1e-6)))
+    print(metrics.report(args.num_repeat))
@@ -2,41 +2,52 @@ import os
 import random
 from collections import OrderedDict
 from collections import defaultdict
+from collections import Counter
 import argparse
 from pprint import pprint
 import time
-from tqdm import tqdm
+
+from ..subword.scripts.bpe.bpe import BPE
+from .compiled_dict import CompiledDict, CandidateTables
+from .phrase import PhraseMatcher
+from .sampler import compile_multi_dict
+from .stream import CHECKPOINT_INTERVAL, replace_corpus, line_seed
+from .subword import GluedSubwords, segment_candidate_tables
 
 random.seed(1)
 
 parser = argparse.ArgumentParser()
 parser.add_argument('--langs', required=True, help="The iso 639-2 code of languages that we apply RAS.")
 parser.add_argument('--target-langs', required=True, help="The RAS target languages")
-parser.add_argument('--multi_dict_path', required=True)
+parser.add_argument('--multi_dict_path', required=True,
+                    help="The multi-way dictionary, or its compiled version (see `tools.ras.compiled_dict`).")
 parser.add_argument('--data_path', required=True)
 parser.add_argument('--num_repeat', type=int, default=1)
 parser.add_argument('--max_dep', type=int, default=1)
 parser.add_argument('--replace_prob', type=float, default=0.15)
 parser.add_argument('--vocab_size', type=int, default=100000000)
 parser.add_argument('--delimiter', type=str, default="__")
+parser.add_argument('--codes', default=None,
+                    help="BPE codes. If provided, bpe is re-applied in-process and the final lines with language "
+                         "token are written to expanded_train.src in one pass.")
+parser.add_argument('--workers', type=int, default=0,
+                    help="Number of processes. If > 0, each line uses a random seed derived from (seed, line number) "
+                         "and the output is the same for any number of workers.")
+parser.add_argument('--seed', type=int, default=1)
+parser.add_argument('--resume', action='store_true',
+                    help="Continue from the checkpoint of the last interrupted run with the same arguments.")
+parser.add_argument('--checkpoint_interval', type=int, default=CHECKPOINT_INTERVAL,
+                    help="Save a checkpoint, and sync the outputs to the disk, every N lines.")
+parser.add_argument('--space', choices=["word", "subword"], default="word",
+                    help="In the subword space, the dictionaries are segmented with --codes once, and the words are "
+                         "replaced on the bpe-ed corpus without removing and re-applying bpe.")
+parser.add_argument('--metrics_log', default=None,
+                    help="If provided, the RAS metrics are appended to this file as JSON lines while running.")
 
 args = parser.parse_args()
 pprint(args)
 
 
-# remove bpe
-def remove_bpe(input_sentence, bpe_symbol="@@ "):
-    """
-
-    :param input_sentence: the input sentence that is processed by bpe sub-word operation.
-    :param bpe_symbol: the bpe indicator(default: '@@ '), which will be removed after the `remove_bpe` function
-    :return: the output sentence that is recovered from  sub-word operation.
-    """
-    _sentence = input_sentence.replace("\n", '')
-    _sentence = (_sentence + ' ').replace(bpe_symbol, '').rstrip()
-    return _sentence + "\n"
-
-
 # read dictionaries
 def load_multi_dict(dictionary_path, languages):
     """
@@ -75,61 +86,114 @@ def load_multi_dict(dictionary_path, languages):
     return word_dict
 
 
+# replace single tokens
+def replace_tokens(tokens, dictionary, rng, new_tokens, lang_cnt):
+    """
+
+    :param new_tokens: the list where the new tokens are appended
+    :param lang_cnt: the Counter of substituted tokens per target language to update
+    :return: the number of tokens in the dictionary
+    """
+    covered = 0
+    for token in tokens:
+        table = dictionary.get(token)
+        if table is None:
+            new_tokens.append(token)
+            continue
+        covered += 1
+        if rng.random() < args.replace_prob:
+            word, lang = table.sample(rng)
+            # a candidate can be a phrase
+            new_tokens.extend(word.split())
+            lang_cnt[lang] += 1
+        else:
+            new_tokens.append(token)
+    return covered
+
+
 # replace tokens in one sentence
-def replace_one_sent(tokens, dictionary, target_langs):
+def replace_one_sent(tokens, dictionary, target_langs, rng=random, phrases=()):
     """
 
     :param tokens:
-    :param dict: is a default dict with list as key
-    :return:
+    :param dictionary: the candidate tables of a source language, see `compile_multi_dict`
+    :param target_langs: the RAS target languages, already applied by `compile_multi_dict`
+    :param rng: the random generator, the global one of `random` by default
+    :param phrases: the phrases of the dictionary found in `tokens` by `PhraseMatcher.match`, they are
+        replaced as a whole
+    :return: the new tokens, the number of substituted entries per target language and the number of tokens
+        in the dictionary
     """
-    cnt = 0
+    lang_cnt = Counter()
+    covered = 0
     new_tokens = []
-    for token in tokens:
-        _rep_token = None
-        if token in dictionary:
-            _dict = dictionary[token]
-            _max_depth = min(len(_dict), args.max_dep)
-            _candidates = []
-            for dep in range(1, _max_depth + 1):
-                # words with smaller depth has larger proba to be selected
-                _candidates.extend(_dict[dep] * pow(2, _max_depth - dep))
-            if random.random() < args.replace_prob:
-                _iter = 0
-                while _rep_token is None and _iter < 999:
-                    _choice = random.choice(_candidates)
-                    if _choice[1] in args.target_langs:
-                        _rep_token = _choice[0]
-                        cnt += 1
-                    _iter += 1
-        if _rep_token:
-            new_tokens.append(_rep_token)
+    last = 0
+    for start, end, phrase in phrases:
+        table = dictionary.get(phrase)
+        if table is None:
+            # no candidate in `target_langs`, its tokens are looked up one by one
+            continue
+        covered += replace_tokens(tokens[last:start], dictionary, rng, new_tokens, lang_cnt) + end - start
+        if rng.random() < args.replace_prob:
+            word, lang = table.sample(rng)
+            new_tokens.extend(word.split())
+            lang_cnt[lang] += 1
         else:
-            new_tokens.append(token)
+            new_tokens.extend(tokens[start:end])
+        last = end
+    covered += replace_tokens(tokens[last:], dictionary, rng, new_tokens, lang_cnt)
     
-    return new_tokens, cnt
+    return new_tokens, lang_cnt, covered
 
 
 # from one sentence we get several copies
-def replace_sent(sentence, dictionary, target_langs):
+def replace_sent(sentence, dictionary, target_langs, rng=random, metrics=None, src_lang=None, matcher=None):
     """
 
     :param sentence: list of token in the sentence
     :param dictionary: dictionary of a certain language
-    :return:
+    :param rng: the random generator, the global one of `random` by default
+    :param metrics: if provided, a `RASMetrics` where each copy is recorded
+    :param src_lang: the language of the sentence, for `metrics`
+    :param matcher: the `PhraseMatcher` of the dictionary
+    :return: the replaced copies
     """
-    replace_cnt = 0
-    total_token = 0
     replaced_sents = []
+    # the phrases are matched once for all copies
+    phrases = matcher.match(sentence) if matcher is not None else ()
     # randomly select `num_repeat` languages from the list, create `num_repeat` copies for each sentence
     for _ in range(args.num_repeat):
-        new_sent, cnt = replace_one_sent(sentence, dictionary, target_langs)
-        if cnt > 0:
+        new_sent, lang_cnt, covered = replace_one_sent(sentence, dictionary, target_langs, rng, phrases)
+        if lang_cnt:
             replaced_sents.append(new_sent)
-        replace_cnt += cnt
-        total_token += len(new_sent)
+        if metrics is not None:
+            metrics.add_copy(src_lang, len(new_sent), covered, lang_cnt)
     
-    return replaced_sents, replace_cnt, total_token
+    return replaced_sents
+
+
+# replace a block of sentences
+def replace_block(block, first_line, metrics):
+    """
+
+    :param block: list of (source tokens with language token, target line)
+    :param first_line: the line number of the first sentence of the block
+    :param metrics: the `RASMetrics` where the counts are recorded
+    :return: the replaced copies of each sentence
+    """
+    replaced_block = []
+    for i, (src_sent, _) in enumerate(block):
+        sent = src_sent[1:]  # remove language token
+        src_lang = src_sent[0][9:].lower()
+        replaced_sents = []
+        if src_lang in langs and src_lang in dicts:
+            rng = random
+            if args.workers > 0:
+                rng = random.Random(line_seed(args.seed, first_line + i))
+            replaced_sents = replace_sent(sent, dicts[src_lang], target_langs, rng, metrics, src_lang,
+                                          matchers[src_lang])
+        replaced_block.append(replaced_sents)
+    return replaced_block
 
 
 if __name__ == "__main__":
@@ -139,62 +203,44 @@ if __name__ == "__main__":
     multi_dict_path = args.multi_dict_path
     data_path = args.data_path
     
-    # 1. remove-bpe
-    with open(os.path.join(data_path, "train.src"), 'r') as f, \
-            open(os.path.join(data_path, "removed_bpe_file.src"), 'w+') as fw:
-        for line in tqdm(f):
-            new_line = remove_bpe(line, "@@ ")
-            fw.write(new_line)
+    # 1. load dictionaries
+    if CompiledDict.is_compiled(multi_dict_path):
+        # memory-mapped, the candidate tables are built on the first lookup of each word
+        compiled = CompiledDict(multi_dict_path)
+        dicts = dict((lang, CandidateTables(compiled, lang, target_langs, args.max_dep)) for lang in langs
+                     if compiled.num_entries(lang) > 0)
+        print(dicts.keys())
+    else:
+        dicts = load_multi_dict(multi_dict_path, langs)
+        print(dicts.keys())
+        compile_start = time.time()
+        dicts = compile_multi_dict(dicts, target_langs, args.max_dep)
+        print("Candidate tables compiled in {} seconds".format(time.time() - compile_start))
     
-    print("======[Remove bpe Finished]======")
+    bpe = None
+    if args.codes:
+        bpe = BPE(args.codes)
+    if args.space == "subword":
+        assert bpe is not None, "--codes is required in the subword space"
+        bpe = GluedSubwords(bpe)
+        segment_start = time.time()
+        dicts = dict((lang, segment_candidate_tables(tables, bpe)) for lang, tables in dicts.items())
+        print("Dicts segmented in {} seconds".format(time.time() - segment_start))
     
-    # 2. load dictionaries
-    dicts = load_multi_dict(multi_dict_path, langs)
-    print(dicts.keys())
+    # one automaton over the phrases of each language, they are replaced as a whole
+    matchers = dict((lang, PhraseMatcher(dicts[lang])) for lang in dicts)
     
     for dict_name in dicts:
         print("The length of dict {dict_name} is {len}".format(dict_name=dict_name, len=len(dicts[dict_name])))
     print("======[Dicts Loaded]======")
-    
+
+    random.seed(args.seed)
     start_time = time.time()
-    # 3. replace
-    with open(os.path.join(data_path, 'removed_bpe_file.src'), 'r') as src_file_read, \
-            open(os.path.join(data_path, 'expanded_train.src'), 'w+') as src_file_write, \
-            open(os.path.join(data_path, "train.trg"), 'r') as trg_file_read, \
-            open(os.path.join(data_path, "expanded_train.trg"), 'w+') as trg_file_write, \
-            open(os.path.join(data_path, "lang_indicator.src"), 'w+') as lang_indic_write:
-        total_replace, total_token = 0, 0
-        src_sent = src_file_read.readline()
-        trg_sent = trg_file_read.readline()
-        while src_sent and trg_sent:
-            src_sent = src_sent.strip().split()
-            sent = src_sent[1:]  # remove language token
-            src_lang = src_sent[0][9:].lower()
-            if src_lang in langs and src_lang in dicts:
-                replaced_sents, replace_cnt, sent_token = replace_sent(sent, dicts[src_lang], target_langs)
-                total_replace += replace_cnt
-                total_token += sent_token
-                replaced_sents = [sent for sent in replaced_sents]
-                replaced_sents = [" ".join(sent) + "\n" for sent in replaced_sents]
-                
-                # write every sent so to save memory
-                for r_sent in replaced_sents:
-                    src_file_write.write(r_sent)
-                
-                for _ in range(len(replaced_sents)):
-                    trg_file_write.write(trg_sent)
-                    lang_indic_write.write(src_sent[0] + "\n")
-            
-            src_sent = src_file_read.readline()
-            trg_sent = trg_file_read.readline()
+    # 2. remove bpe, replace (and re-apply bpe)
+    metrics = replace_corpus(data_path, replace_block, bpe, 10000, args.workers, args.metrics_log, args.resume,
+                             args.checkpoint_interval)
     
     print("======[Replaced with dict Finished]======")
-    print("Done in {} seconds".format(time.time() - start_time))
-    
-    print("Total Tokens(with repeated times) is {total_token}, with {replaced_token} replaced.\n"
-          "With a proportion of {proportion}% \n"
-          "The repeated times are set to {num_repeat}"
-          .format(total_token=total_token, replaced_token=total_replace, num_repeat=args.num_repeat,
-                  proportion=total_replace / total_token * 100))
-    
-    os.system("rm {}".format(os.path.join(data_path, 'removed_bpe_file.src')))
+    elapsed = time.time() - start_time
+    print("Done in {} seconds, {:.1f} lines/sec".format(elapsed, metrics.lines / max(elapsed, 1e-6)))
+    print(metrics.report(args.num_repeat))
@@ -0,0 +1,90 @@
+class AliasTable(object):
+    """
+    Walker's alias method: after an O(n) construction, drawing one of n weighted items costs one
+    random number, whatever the number of items and the distribution of the weights.
+    """
+    __slots__ = ["items", "prob", "alias"]
+
+    def __init__(self, items, weights):
+        """
+
+        :param items: the items to sample from
+        :param weights: the positive weight of each item, need not to be normalized
+        """
+        n = len(items)
+        assert n > 0 and n == len(weights)
+        total = float(sum(weights))
+        scaled = [w * n / total for w in weights]
+        self.items = list(items)
+        self.prob = [1.0] * n
+        self.alias = list(range(n))
+        small = [i for i, p in enumerate(scaled) if p < 1.0]
+        large = [i for i, p in enumerate(scaled) if p >= 1.0]
+        while small and large:
+            s, l = small.pop(), large.pop()
+            self.prob[s] = scaled[s]
+            self.alias[s] = l
+            scaled[l] -= 1.0 - scaled[s]
+            if scaled[l] < 1.0:
+                small.append(l)
+            else:
+                large.append(l)
+        # the remaining ones are 1 up to rounding errors
+
+    def __len__(self):
+        return len(self.items)
+
+    def map(self, fn):
+        """
+
+        :return: a table that draws `fn(item)` whenever this one draws `item`, without building it again
+        """
+        table = AliasTable.__new__(AliasTable)
+        table.items = [fn(item) for item in self.items]
+        table.prob = self.prob
+        table.alias = self.alias
+        return table
+
+    def sample(self, rng):
+        """
+
+        :param rng: the random generator, e.g. the `random` module or a `random.Random`
+        :return: an item drawn with a probability proportional to its weight
+        """
+        n = len(self.items)
+        u = rng.random() * n
+        i = min(int(u), n - 1)
+        if u - i < self.prob[i]:
+            return self.items[i]
+        return self.items[self.alias[i]]
+
+
+def compile_multi_dict(word_dict, target_langs, max_dep):
+    """
+    Build the candidate tables of the multi-way dictionary once, instead of rebuilding and rejection-sampling
+    the candidate list on every token occurrence. A candidate of depth `dep` keeps the weight
+    2 ^ (max_depth - dep) it has in `replace_one_sent`, and only candidates in `target_langs` are kept.
+
+    :param word_dict: dictionary returned by `load_multi_dict`, {src_lang: {word: {depth: [(word, lang)]}}}
+    :param target_langs: the RAS target languages
+    :param max_dep: the maximum depth of the candidates
+    :return: {src_lang: {word: AliasTable of (target word, target lang)}}, words without any candidate in
+        `target_langs` are left out
+    """
+    target_langs = set(target_langs)
+    compiled = {}
+    for src_lang, words in word_dict.items():
+        tables = {}
+        for src_word, depth_dict in words.items():
+            _max_depth = min(len(depth_dict), max_dep)
+            candidates, weights = [], []
+            for dep in range(1, _max_depth + 1):
+                # words with smaller depth has larger proba to be selected
+                for word, lang in depth_dict.get(dep, []):
+                    if lang in target_langs:
+                        candidates.append((word, lang))
+                        weights.append(pow(2, _max_depth - dep))
+            if candidates:
+                tables[src_word] = AliasTable(candidates, weights)
+        compiled[src_lang] = tables
+    return compiled
@@ -0,0 +1,457 @@
+import os
+import pickle
+import random
+import re
+import shutil
+import time
+import multiprocessing
+from itertools import islice
+
+from .metrics import RASMetrics
+from .subword import GluedSubwords
+
+
+def remove_bpe(input_sentence, bpe_symbol="@@ "):
+    """
+
+    :param input_sentence: the input sentence that is processed by bpe sub-word operation.
+    :param bpe_symbol: the bpe indicator(default: '@@ '), which will be removed after the `remove_bpe` function
+    :return: the output sentence that is recovered from  sub-word operation, without line break.
+    """
+    return (input_sentence.rstrip("\n") + ' ').replace(bpe_symbol, '').rstrip()
+
+
+def iter_blocks(src_file, trg_file, block_size, bpe_symbol="@@ ", subwords=None):
+    """
+    Read the parallel corpus block by block, the bpe of the source side is removed in memory.
+
+    :param src_file: the source file, each line starts with a language token
+    :param trg_file: the target file
+    :param block_size: number of lines in each block
+    :param subwords: if provided, a `GluedSubwords` that glues the subwords of each word instead of removing bpe
+    :return: an iterator of blocks, each block is a list of (source tokens with language token, target line)
+    """
+    block = []
+    for src_sent, trg_sent in zip(src_file, trg_file):
+        if subwords is not None:
+            block.append((subwords.glue(src_sent), trg_sent))
+        else:
+            block.append((remove_bpe(src_sent, bpe_symbol).split(), trg_sent))
+        if len(block) >= block_size:
+            yield block
+            block = []
+    if block:
+        yield block
+
+
+class ExpandedWriter(object):
+    """
+    Write the replaced copies of the source sentences to `expanded_train.src` / `expanded_train.trg`.
+
+    Without `bpe`, the source copies are written without bpe and language token, and the language tokens
+    go to `lang_indicator.src`, so that the caller can apply bpe and `paste` them back.
+    With `bpe` (an instance of `BPE`, or a `GluedSubwords` in the subword space), bpe is re-applied in-process
+    and the final `LANG_TOK_xx`-prefixed lines are written in one pass.
+    """
+
+    def __init__(self, data_path, bpe=None, suffix="", offsets=None):
+        """
+
+        :param offsets: if provided, the byte offsets returned by `offsets` at a checkpoint, the files are
+            truncated to them and appended to, instead of being created
+        """
+        self.bpe = bpe
+        self.files = []
+        for name in self.file_names(bpe):
+            path = os.path.join(data_path, name + suffix)
+            if offsets is None:
+                self.files.append(open(path, 'w+'))
+            else:
+                # drop what was written after the checkpoint
+                os.truncate(path, offsets[name])
+                self.files.append(open(path, 'a'))
+        self.src_file, self.trg_file = self.files[:2]
+        self.lang_indic_file = self.files[2] if bpe is None else None
+
+    @staticmethod
+    def file_names(bpe=None):
+        if bpe is None:
+            return ["expanded_train.src", "expanded_train.trg", "lang_indicator.src"]
+        return ["expanded_train.src", "expanded_train.trg"]
+
+    def write_block(self, block, replaced_sents):
+        """
+
+        :param block: list of (source tokens with language token, target line)
+        :param replaced_sents: list of the replaced copies (lists of tokens) of each sentence in `block`
+        """
+        src_lines, trg_lines, lang_lines = [], [], []
+        for (src_sent, trg_sent), r_sents in zip(block, replaced_sents):
+            for r_sent in r_sents:
+                if self.bpe is None:
+                    src_lines.append(" ".join(r_sent) + "\n")
+                    lang_lines.append(src_sent[0] + "\n")
+                else:
+                    src_lines.append(src_sent[0] + " " + self.bpe.encode(r_sent, return_str=True) + "\n")
+                trg_lines.append(trg_sent)
+        # write every block so to save memory
+        self.src_file.write("".join(src_lines))
+        self.trg_file.write("".join(trg_lines))
+        if self.lang_indic_file is not None:
+            self.lang_indic_file.write("".join(lang_lines))
+
+    def offsets(self):
+        """
+
+        :return: the byte offsets of the output files, once all that was written is on the disk
+        """
+        offsets = {}
+        for name, f in zip(self.file_names(self.bpe), self.files):
+            f.flush()
+            os.fsync(f.fileno())
+            offsets[name] = f.tell()
+        return offsets
+
+    def close(self):
+        for f in self.files:
+            f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+# the line breaks of `split_lines` in bpe, as text mode with `newline=None`
+NEWLINE = re.compile(rb"\r\n|\r|\n")
+# a carriage return that ends a line by itself
+LONE_CR = re.compile(rb"\r(?!\n)")
+
+
+class LineReader(object):
+    """
+    Decode the lines of a file opened in binary mode, the line breaks (`\r\n`, `\r` or `\n`) are translated to
+    `\n` as in text mode, and `tell` returns the byte offset of the next line.
+    """
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.offset = raw.tell()
+
+    def tell(self):
+        return self.offset
+
+    def __iter__(self):
+        # a raw line ends at `\n`, so that a `\r` inside it always ends a line by itself
+        for raw_line in self.raw:
+            if b"\r" not in raw_line:
+                self.offset += len(raw_line)
+                yield raw_line.decode()
+                continue
+            start = 0
+            for match in NEWLINE.finditer(raw_line):
+                self.offset += match.end() - start
+                yield raw_line[start:match.start()].decode() + "\n"
+                start = match.end()
+            if start < len(raw_line):
+                self.offset += len(raw_line) - start
+                yield raw_line[start:].decode()
+
+
+def line_seed(seed, line_number):
+    """
+
+    :return: the seed of `random.Random` for a line, derived from the global seed and the line number
+    """
+    return (seed << 64) + line_number
+
+
+def _line_chunks(f, chunk_size):
+    """
+    Read `f` chunk by chunk, with every line break ending in `\n`: a lone `\r` is replaced by `\n`, so that
+    the byte offsets are kept.
+    """
+    for chunk in iter(lambda: f.read(chunk_size), b""):
+        # a `\r` at the end of a chunk may be followed by `\n`
+        while chunk.endswith(b"\r"):
+            next_byte = f.read(1)
+            if not next_byte:
+                break
+            chunk += next_byte
+        if b"\r" in chunk:
+            chunk = LONE_CR.sub(b"\n", chunk)
+        yield chunk
+
+
+def count_lines(path, chunk_size=1 << 24):
+    num_lines = 0
+    last = b"\n"
+    with open(path, 'rb') as f:
+        for chunk in _line_chunks(f, chunk_size):
+            num_lines += chunk.count(b"\n")
+            last = chunk[-1:]
+    # the last line has no line break
+    return num_lines + (last != b"\n")
+
+
+def line_offsets(path, line_numbers, chunk_size=1 << 24):
+    """
+
+    :param path: the file to scan
+    :param line_numbers: sorted line numbers
+    :return: the byte offset where each of `line_numbers` begins
+    """
+    offsets = []
+    targets = iter(line_numbers)
+    target = next(targets, None)
+    line, pos = 0, 0
+    with open(path, 'rb') as f:
+        chunks = _line_chunks(f, chunk_size)
+        while target is not None:
+            chunk = next(chunks, None)
+            if chunk is None:
+                break
+            i = 0
+            while target is not None and line + chunk.count(b"\n", i) >= target:
+                while line < target:
+                    i = chunk.index(b"\n", i) + 1
+                    line += 1
+                offsets.append(pos + i)
+                target = next(targets, None)
+            line += chunk.count(b"\n", i)
+            pos += len(chunk)
+    # line numbers after the end of the file
+    while len(offsets) < len(line_numbers):
+        offsets.append(pos)
+    return offsets
+
+
+# name of the checkpoint under the data path, followed by the suffix of the shard
+CHECKPOINT_NAME = "ras.ckpt"
+# number of lines between two checkpoints, each of them syncs the outputs to the disk
+CHECKPOINT_INTERVAL = 100000
+
+
+class Checkpoint(object):
+    """
+    The progress of a RAS run, saved periodically after a block: the number of lines done, the byte offsets of
+    the input and output files, the state of the global `random` generator and the metrics.
+
+    The outputs are synced to the disk before the checkpoint is (atomically) replaced, so that a run can always
+    be resumed from the last checkpoint, without duplicating or losing lines.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        """
+
+        :return: the last saved state, None if there is no checkpoint
+        """
+        if not os.path.exists(self.path):
+            return None
+        with open(self.path, 'rb') as f:
+            return pickle.load(f)
+
+    def save(self, line, src_file, trg_file, writer, metrics, **extra):
+        state = {
+            "line": line,
+            "src_offset": src_file.tell(),
+            "trg_offset": trg_file.tell(),
+            "outputs": writer.offsets(),
+            "random_state": random.getstate(),
+            "metrics": metrics,
+            "elapsed": time.time() - metrics.start_time,
+        }
+        state.update(extra)
+        with open(self.path + ".tmp", 'wb') as f:
+            pickle.dump(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(self.path + ".tmp", self.path)
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def replace_lines(src_file, trg_file, writer, replace_fn, block_size, first_line=0, num_lines=None,
+                  metrics=None, log_file=None, shard=None, checkpoint=None,
+                  checkpoint_interval=CHECKPOINT_INTERVAL):
+    """
+    Replace the lines of `src_file` / `trg_file` block by block and write the copies with `writer`.
+
+    :param src_file: the source file opened in binary mode, at the position of `first_line`
+    :param trg_file: the target file opened in binary mode, at the position of `first_line`
+    :param replace_fn: a function that takes a block (see `iter_blocks`), the line number of its first line and
+        a `RASMetrics`, records the counts of the block in the metrics and returns the replaced copies of each
+        sentence
+    :param num_lines: only replace the next `num_lines` lines, all lines if None
+    :param metrics: the `RASMetrics` to update, a new one if None
+    :param log_file: if provided, the metrics are appended to it as JSON lines after every block
+    :param shard: the id of the shard, reported in the log
+    :param checkpoint: if provided, a `Checkpoint` saved after the first block that ends `checkpoint_interval`
+        lines or more after the last one
+    :return: the metrics
+    """
+    # the files are read in binary mode, so that their positions are known at each checkpoint
+    src_file, trg_file = LineReader(src_file), LineReader(trg_file)
+    src_lines, trg_lines = iter(src_file), iter(trg_file)
+    if num_lines is not None:
+        src_lines, trg_lines = islice(src_lines, num_lines), islice(trg_lines, num_lines)
+    if metrics is None:
+        metrics = RASMetrics()
+    line = saved_line = first_line
+    # in the subword space, bpe is neither removed nor re-applied
+    subwords = writer.bpe if isinstance(writer.bpe, GluedSubwords) else None
+    blocks = iter_blocks(src_lines, trg_lines, block_size, subwords=subwords)
+    while True:
+        # read + remove bpe
+        start_time = time.time()
+        block = next(blocks, None)
+        read_end = time.time()
+        metrics.stage_time["read"] += read_end - start_time
+        if block is None:
+            break
+        replaced_sents = replace_fn(block, line, metrics)
+        replace_end = time.time()
+        metrics.stage_time["replace"] += replace_end - read_end
+        writer.write_block(block, replaced_sents)
+        metrics.stage_time["write"] += time.time() - replace_end
+        metrics.lines += len(block)
+        line += len(block)
+        if checkpoint is not None and line - saved_line >= checkpoint_interval:
+            checkpoint.save(line, src_file, trg_file, writer, metrics, shard=shard)
+            saved_line = line
+        if log_file is not None:
+            metrics.log(log_file, shard=shard, line=line)
+        if shard is None:
+            print("{} lines replaced, {:.1f} lines/sec".format(
+                metrics.lines, metrics.lines / (time.time() - metrics.start_time)))
+    return metrics
+
+
+def _resume_lines(checkpoint, resume, src_raw, trg_raw, first_line, num_lines=None):
+    """
+    Restore the state of `checkpoint` if `resume` is set and the checkpoint exists.
+
+    :return: the first line, the number of lines left (None for all), the offsets of the outputs (None to create
+        them) and the metrics (None for new ones)
+    """
+    state = checkpoint.load() if resume else None
+    if state is None:
+        return first_line, num_lines, None, None
+    if state["line"] < first_line or (num_lines is not None and state["line"] > first_line + num_lines):
+        raise ValueError("The checkpoint {} (line {}) does not belong to lines {}-{}, was the number of workers "
+                         "changed?".format(checkpoint.path, state["line"], first_line, first_line + num_lines))
+    src_raw.seek(state["src_offset"])
+    trg_raw.seek(state["trg_offset"])
+    random.setstate(state["random_state"])
+    metrics = state["metrics"]
+    metrics.start_time = time.time() - state["elapsed"]
+    if num_lines is not None:
+        num_lines -= state["line"] - first_line
+    print("Resumed from {} at line {}".format(checkpoint.path, state["line"]))
+    return state["line"], num_lines, state["outputs"], metrics
+
+
+# shared with the forked workers of `replace_corpus`
+_shard_context = None
+
+
+def _replace_shard(shard):
+    shard_id, first_line, num_lines, src_offset, trg_offset = shard
+    data_path, replace_fn, bpe, block_size, metrics_log, resume, checkpoint_interval = _shard_context
+    suffix = ".shard{}".format(shard_id)
+    checkpoint = Checkpoint(os.path.join(data_path, CHECKPOINT_NAME + suffix))
+    # append mode, so that the lines of the workers are not mixed up
+    log_file = open(metrics_log, 'a') if metrics_log else None
+    try:
+        with open(os.path.join(data_path, "train.src"), 'rb') as src_raw, \
+                open(os.path.join(data_path, "train.trg"), 'rb') as trg_raw:
+            src_raw.seek(src_offset)
+            trg_raw.seek(trg_offset)
+            line, lines_left, offsets, metrics = _resume_lines(checkpoint, resume, src_raw, trg_raw,
+                                                               first_line, num_lines)
+            with ExpandedWriter(data_path, bpe, suffix, offsets) as writer:
+                metrics = replace_lines(src_raw, trg_raw, writer, replace_fn, block_size, line, lines_left,
+                                        metrics, log_file=log_file, shard=shard_id, checkpoint=checkpoint,
+                                        checkpoint_interval=checkpoint_interval)
+    finally:
+        if log_file is not None:
+            log_file.close()
+    print("shard {} (lines {}-{}) done".format(shard_id, first_line, first_line + num_lines))
+    return metrics
+
+
+def replace_corpus(data_path, replace_fn, bpe=None, block_size=10000, workers=0, metrics_log=None, resume=False,
+                   checkpoint_interval=CHECKPOINT_INTERVAL):
+    """
+    Replace `train.src` / `train.trg` under `data_path`, see `replace_lines`.
+
+    With `workers` > 0, the corpus is split into `workers` shards of contiguous lines that are replaced by
+    forked processes, and the outputs of the shards are concatenated in order. `replace_fn` must then only
+    depend on the line numbers for its randomness, so that the output is the same for any number of workers.
+
+    A checkpoint (one per shard) is saved under `data_path` every `checkpoint_interval` lines, at the end of a
+    block, and removed once the corpus is done. With `resume`, the run continues from the checkpoints, that must
+    have been made with the same number of workers.
+
+    :param metrics_log: path of a JSON-lines file, the metrics are appended to it while running
+    :return: the `RASMetrics` of the run
+    """
+    global _shard_context
+    src_path = os.path.join(data_path, "train.src")
+    trg_path = os.path.join(data_path, "train.trg")
+    if metrics_log and not resume:
+        # start a new log
+        open(metrics_log, 'w').close()
+    if workers <= 0:
+        checkpoint = Checkpoint(os.path.join(data_path, CHECKPOINT_NAME))
+        log_file = open(metrics_log, 'a') if metrics_log else None
+        try:
+            with open(src_path, 'rb') as src_raw, open(trg_path, 'rb') as trg_raw:
+                line, _, offsets, metrics = _resume_lines(checkpoint, resume, src_raw, trg_raw, 0)
+                with ExpandedWriter(data_path, bpe, offsets=offsets) as writer:
+                    metrics = replace_lines(src_raw, trg_raw, writer, replace_fn, block_size, line,
+                                            metrics=metrics, log_file=log_file, checkpoint=checkpoint,
+                                            checkpoint_interval=checkpoint_interval)
+        finally:
+            if log_file is not None:
+                log_file.close()
+        checkpoint.remove()
+        return metrics
+
+    num_lines = min(count_lines(src_path), count_lines(trg_path))
+    bounds = [num_lines * i // workers for i in range(workers + 1)]
+    src_offsets = line_offsets(src_path, bounds[:-1])
+    trg_offsets = line_offsets(trg_path, bounds[:-1])
+    shards = [(i, bounds[i], bounds[i + 1] - bounds[i], src_offsets[i], trg_offsets[i]) for i in range(workers)]
+
+    _shard_context = (data_path, replace_fn, bpe, block_size, metrics_log, resume, checkpoint_interval)
+    pool = multiprocessing.get_context("fork").Pool(workers)
+    try:
+        results = pool.map(_replace_shard, shards, chunksize=1)
+    finally:
+        pool.terminate()
+        _shard_context = None
+
+    for name in ExpandedWriter.file_names(bpe):
+        with open(os.path.join(data_path, name), 'wb') as fw:
+            for i in range(workers):
+                with open(os.path.join(data_path, name + ".shard{}".format(i)), 'rb') as f:
+                    shutil.copyfileobj(f, fw)
+    # the shards are only removed once all outputs are complete, so that a crash before can still be resumed
+    for i in range(workers):
+        for name in ExpandedWriter.file_names(bpe):
+            os.remove(os.path.join(data_path, name + ".shard{}".format(i)))
+        Checkpoint(os.path.join(data_path, CHECKPOINT_NAME + ".shard{}".format(i))).remove()
+    metrics = RASMetrics()
+    for shard_metrics in results:
+        metrics.merge(shard_metrics)
+    if metrics_log:
+        with open(metrics_log, 'a') as log_file:
+            metrics.log(log_file, shard=None, line=num_lines)
+    return metrics
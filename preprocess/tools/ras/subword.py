@@ -0,0 +1,146 @@
+from collections import defaultdict
+
+from .compiled_dict import MAX_CACHE_SIZE, BilingualDict, CandidateTables
+
+
+class GluedSubwords(object):
+    """
+    The subword space of RAS: instead of removing bpe from the corpus and re-applying it after the substitution,
+    the subwords of each word are glued together ("P@@ le@@ ase" -> "P@@le@@ase") and split again when writing,
+    both with a plain string replacement. Only the entries of the dictionaries go through bpe, once.
+
+    An instance can be given as `bpe` to `ExpandedWriter`, `encode` splits the subwords again.
+    """
+
+    def __init__(self, bpe, separator="@@"):
+        """
+
+        :param bpe: an instance of `BPE`, with the codes that were applied to the corpus
+        """
+        self.bpe = bpe
+        self.separator = separator
+        self._cache = {}
+
+    def glue(self, sentence):
+        """
+
+        :param sentence: a line of the bpe-ed corpus
+        :return: the words of the line, with their subwords glued
+        """
+        return sentence.replace(self.separator + " ", self.separator).split()
+
+    def encode(self, words, return_str=False):
+        line = " ".join(words).replace(self.separator, self.separator + " ")
+        if return_str:
+            return line
+        return line.split()
+
+    def segment(self, entry):
+        """
+
+        :param entry: a word or a phrase of the dictionary
+        :return: the entry with bpe applied and the subwords of each word glued
+        """
+        if entry not in self._cache:
+            self._cache[entry] = " ".join("".join(self.bpe.encode([word])) for word in entry.split())
+        return self._cache[entry]
+
+
+class SegmentedTables(object):
+    """
+    Lazy equivalent of `segment_muse_dicts` and `segment_candidate_tables` for a compiled dictionary: a glued token
+    is looked up as the word that it segments, whose value is segmented on the first lookup, so that the whole
+    dictionary is neither decoded nor segmented at startup.
+    """
+
+    def __init__(self, tables, subwords, segment_value):
+        """
+
+        :param tables: a `BilingualDict` or a `CandidateTables`
+        :param subwords: a `GluedSubwords`
+        :param segment_value: returns the value of a word in `tables` with all words segmented by `subwords`
+        """
+        self.tables = tables
+        self.subwords = subwords
+        self.segment_value = segment_value
+        self._cache = {}
+
+    def get(self, token, default=None):
+        if token in self._cache:
+            value = self._cache[token]
+        else:
+            if len(self._cache) >= MAX_CACHE_SIZE:
+                self._cache.clear()
+            word = token.replace(self.subwords.separator, "")
+            value = self.tables.get(word)
+            # only the segmentation of the word itself, as in the dictionaries segmented at once
+            if value is not None and self.subwords.segment(word) == token:
+                value = self.segment_value(value)
+            else:
+                value = None
+            self._cache[token] = value
+        return default if value is None else value
+
+    def __contains__(self, token):
+        return self.get(token) is not None
+
+    def __getitem__(self, token):
+        value = self.get(token)
+        if value is None:
+            raise KeyError(token)
+        return value
+
+    def items(self):
+        for word in self.tables:
+            value = self.tables.get(word)
+            if value is not None:
+                yield self.subwords.segment(word), self.segment_value(value)
+
+    def __iter__(self):
+        return (word for word, _ in self.items())
+
+    def __len__(self):
+        return len(self.tables)
+
+    def phrases(self):
+        return (self.subwords.segment(phrase) for phrase in self.tables.phrases())
+
+
+def segment_muse_dicts(dicts, subwords):
+    """
+
+    :param dicts: the dictionaries returned by `load_dicts` or `BilingualDict`s, {"en-x": {word: [translations]}}
+    :param subwords: a `GluedSubwords`
+    :return: the same dictionaries, with all words segmented by `subwords`, a `BilingualDict` is segmented lazily
+    """
+    segmented = {}
+    for dict_name, dictionary in dicts.items():
+        if isinstance(dictionary, BilingualDict):
+            segmented[dict_name] = SegmentedTables(
+                dictionary, subwords, lambda translations: [subwords.segment(t) for t in translations])
+            continue
+        x2y_dict = defaultdict(list)
+        for word, translations in dictionary.items():
+            x2y_dict[subwords.segment(word)].extend(subwords.segment(t) for t in translations)
+        segmented[dict_name] = x2y_dict
+    return segmented
+
+
+def segment_candidate_tables(tables, subwords):
+    """
+
+    :param tables: {word: `AliasTable` of (word, lang)}, e.g. the result of `compile_multi_dict` for a source
+        language or a `CandidateTables`
+    :param subwords: a `GluedSubwords`
+    :return: the same tables, with all words segmented by `subwords`, a `CandidateTables` is segmented lazily
+    """
+    if isinstance(tables, CandidateTables):
+        return SegmentedTables(tables, subwords,
+                               lambda table: table.map(lambda item: (subwords.segment(item[0]), item[1])))
+    segmented = {}
+    for word in tables:
+        table = tables.get(word)
+        if table is None:
+            continue
+        segmented[subwords.segment(word)] = table.map(lambda item: (subwords.segment(item[0]), item[1]))
+    return segmented
@@ -5,6 +5,8 @@ output_path=$2
 
 [[ ! -d ${output_path} ]] && mkdir -p ${output_path}
 codes_file=${final_vocab_path}/codes.bpe.${subword_bpe_merge_ops}
+# one process per file: load the compiled model written next to the codes, if any
+[[ -f ${codes_file}.bin ]] && codes_file=${codes_file}.bin
 
 IFS=';' read -r -a lang_pairs <<< ${pairs}
 
@@ -25,7 +27,8 @@ do
             output_file="${output_path}/${subdir}/${base_filename}"
             # apply subword
             ## input: the original file to be encoded; output: the encoded file
-            cat ${file} | mulitprocess_pipeline "subword-nmt apply-bpe -c ${codes_file}" ${num_cpus} > ${output_file}
+            python -m tools.subword.scripts.bpe.bpe -c ${codes_file} --threads ${num_cpus} --byte_ranges \
+                    -i ${file} -o ${output_file}
         done
     fi
     echo "SUBDIR: ${subdir} done"
@@ -119,18 +119,21 @@ python -m tools.subword.scripts.multilingual_learn_joint_bpe_and_vocab -i ${all_
 echo "===== $(date "+%Y-%m-%d %H:%M:%S") ===== FINISH Learn Joint BPE and Apply =====" >&2
 
 echo "===== $(date "+%Y-%m-%d %H:%M:%S") ===== Apply BPE to original input file =====" >&2
+all_parallel_output_files=""
 for file in ${all_parallel_files}
 do
     base_filename=`basename $file`
     dirname=`dirname $file`
     subdir=`basename $dirname`
     echo "${subdir}   ${base_filename}"
-    output_file="${output_path}/${subdir}/${base_filename}"
-    # apply subword
-    ## input: the original file to be encoded
-    ## output: the encoded file
-    cat ${file} | mulitprocess_pipeline "subword-nmt apply-bpe -c ${codes_file}" ${num_cpus} > ${output_file}
+    all_parallel_output_files+="${output_path}/${subdir}/${base_filename} "
 done
+# apply subword type by type: the word types of all files are counted and segmented once, then each file is
+# rewritten with dictionary lookups. The types table is kept next to the codes and reused by the next runs.
+python -m tools.subword.scripts.bpe.bpe -c ${codes_file} --threads ${num_cpus} \
+        --type_first ${all_parallel_files} \
+        --type_first_output ${all_parallel_output_files} \
+        --types ${vocab_path}/types.bpe.${subword_bpe_merge_ops}
 echo "===== $(date "+%Y-%m-%d %H:%M:%S") ===== FINISH Apply BPE to original input file =====" >&2
 
 # Remove infrequent tokens from vocabulary
@@ -0,0 +1,165 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Benchmark `merge_symbols` against the reference `merge_symbols_naive` on long tokens: URLs, runs of words
+without spaces (as in unsegmented CJK text) and long numbers, besides the words of the input. Both segmentations
+are checked to be identical, for the end-of-word handling of versions 0.1 and 0.2.
+
+With --glossaries, also benchmark `GlossaryMatcher` against `isolate_glossaries_naive` on the same tokens. With
+--threads, also check that the `bounded_imap` pipeline of `main` returns the results in order, and raises the
+exception of a worker instead of hanging, and that `main`, `apply_file` and `apply_type_first` break the lines of a
+text with unicode line boundaries at the same places.
+
+    python -m tools.subword.scripts.bpe.benchmark -c codes.bpe.32000 -i train.en [--glossaries protected_patterns]
+"""
+from __future__ import unicode_literals, division, print_function
+
+import argparse
+import codecs
+import os
+import random
+import shutil
+import tempfile
+import time
+
+from .bpe import BPE, GlossaryMatcher, isolate_glossaries_naive, merge_symbols, merge_symbols_naive
+from .bpe import apply_file, apply_type_first, main, open_text
+from .utils import PseudoPool, bounded_imap
+
+
+def long_tokens(lines, num_tokens, rng):
+    """
+
+    :return: dict of the name of the kind of long token to a list of `num_tokens` tokens
+    """
+    words = [line.split() for line in lines]
+    words = [w for w in words if w]
+    flat = [word for ws in words for word in ws]
+    return {
+        "url": ["https://www.{}.com/{}".format(rng.choice(flat), "/".join(rng.sample(flat, rng.randint(3, 10))))
+                for _ in range(num_tokens)],
+        "no_space": ["".join(rng.choice(words))[:rng.randint(50, 300)] for _ in range(num_tokens)],
+        "number": ["".join(rng.choice("0123456789") for _ in range(rng.randint(20, 200)))
+                   for _ in range(num_tokens)],
+    }
+
+
+def symbols_of(token, version):
+    if version == (0, 1):
+        return tuple(token) + ('</w>',)
+    return tuple(token[:-1]) + (token[-1] + '</w>',)
+
+
+def run(merge_fn, tokens, version, bpe_codes):
+    start_time = time.time()
+    result = [merge_fn(symbols_of(token, version), bpe_codes) for token in tokens]
+    return result, time.time() - start_time
+
+
+def _square_or_fail(x):
+    if x < 0:
+        raise ValueError("negative input {}".format(x))
+    return x * x
+
+
+def check_bounded_imap(n_threads, num_tasks=100):
+    """ Checks that `bounded_imap` keeps the order of the tasks and raises the exception of a task. """
+    with PseudoPool(n_threads) as pool:
+        result = list(bounded_imap(pool, _square_or_fail, range(num_tasks), 2 * n_threads))
+    assert result == [x * x for x in range(num_tasks)], "bounded_imap changed the results"
+    start_time = time.time()
+    try:
+        with PseudoPool(n_threads) as pool:
+            tasks = [x if x != num_tasks // 2 else -1 for x in range(num_tasks)]
+            for _ in bounded_imap(pool, _square_or_fail, tasks, 2 * n_threads):
+                pass
+    except ValueError:
+        print("bounded_imap with {} threads: results in order, worker exception raised in {:.3f}s".format(
+            n_threads, time.time() - start_time))
+    else:
+        raise AssertionError("bounded_imap did not raise the exception of a worker")
+
+
+def check_line_breaks(codes, n_threads, lines):
+    """ Checks that `main`, `apply_file` and `apply_type_first` give the same output for `lines` joined with all
+    kinds of line breaks, with unicode line boundaries (U+2028, U+0085) inside the lines. """
+    words = [word for line in lines for word in line.split()][:1000]
+    text_lines = [" ".join(words[i:i + 10]) for i in range(0, len(words), 10)]
+    text_lines[::3] = ["{}\u2028{}\x85".format(line, line) for line in text_lines[::3]]
+    breaks = ["\n", "\r\n", "\r"]
+    text = "".join(line + breaks[i % len(breaks)] for i, line in enumerate(text_lines))
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        input_path = os.path.join(tmp_dir, "input")
+        with open(input_path, "wb") as f:
+            f.write(text.encode("utf-8"))
+        with open_text(input_path) as fin, codecs.open(os.path.join(tmp_dir, "main"), "w", encoding="utf-8") as fout:
+            main(fin, fout, codes, False, n_threads, 10)
+        apply_file(input_path, os.path.join(tmp_dir, "byte_ranges"), codes, n_threads)
+        apply_type_first([input_path], [os.path.join(tmp_dir, "type_first")], codes, n_threads)
+        outputs = {}
+        for name in ["main", "byte_ranges", "type_first"]:
+            with open(os.path.join(tmp_dir, name), "rb") as f:
+                outputs[name] = f.read()
+    finally:
+        shutil.rmtree(tmp_dir)
+    for name, output in outputs.items():
+        assert output.count(b"\n") == len(text_lines), "{} broke the lines differently".format(name)
+        assert output == outputs["main"], "{} differs from main".format(name)
+    print("main, apply_file and apply_type_first: same {} lines with unicode line boundaries".format(len(text_lines)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="benchmark the BPE merge algorithms")
+    parser.add_argument('--codes', '-c', required=True, help="BPE codes")
+    parser.add_argument('--input', '-i', required=True, help="Text to take the words and long tokens from")
+    parser.add_argument('--max_lines', type=int, default=100000, help="Read at most this many lines")
+    parser.add_argument('--num_tokens', type=int, default=1000, help="Number of long tokens of each kind")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--glossaries', default=None, help="File with one glossary per line")
+    parser.add_argument('--threads', type=int, default=0, help="Check the pipeline of `main` with this many workers")
+    args = parser.parse_args()
+
+    if args.threads:
+        check_bounded_imap(args.threads)
+
+    bpe = BPE(args.codes)
+    lines = []
+    with codecs.open(args.input, encoding="utf-8") as f:
+        for line in f:
+            lines.append(line)
+            if len(lines) >= args.max_lines:
+                break
+    if args.threads:
+        check_line_breaks(args.codes, args.threads, lines)
+    corpora = {"words": sorted(set(word for line in lines for word in line.split()))}
+    corpora.update(long_tokens(lines, args.num_tokens, random.Random(args.seed)))
+
+    print("{:10s} {:8s} {:>8s} {:>10s} {:>10s} {:>9s} {:>8s}".format(
+        "tokens", "version", "count", "naive (s)", "heap (s)", "speedup", "same"))
+    for name, tokens in sorted(corpora.items()):
+        tokens = [token for token in tokens if len(token) > 1]
+        for version in [(0, 1), (0, 2)]:
+            expected, naive_time = run(merge_symbols_naive, tokens, version, bpe.bpe_codes)
+            result, heap_time = run(merge_symbols, tokens, version, bpe.bpe_codes)
+            print("{:10s} {:8s} {:8d} {:10.3f} {:10.3f} {:8.1f}x {:>8s}".format(
+                name, ".".join(map(str, version)), len(tokens), naive_time, heap_time,
+                naive_time / max(heap_time, 1e-9), str(result == expected)))
+
+    if args.glossaries:
+        with codecs.open(args.glossaries, encoding="utf-8") as f:
+            glossaries = [line.strip() for line in f if line.strip()]
+        start_time = time.time()
+        matcher = GlossaryMatcher(glossaries)
+        print("\n{} glossaries, automaton built in {:.3f}s".format(len(glossaries), time.time() - start_time))
+        print("{:10s} {:>8s} {:>10s} {:>10s} {:>9s} {:>8s}".format(
+            "tokens", "count", "naive (s)", "matcher (s)", "speedup", "same"))
+        for name, tokens in sorted(corpora.items()):
+            start_time = time.time()
+            expected = [isolate_glossaries_naive(token, glossaries) for token in tokens]
+            naive_time = time.time() - start_time
+            start_time = time.time()
+            result = [matcher.isolate(token) for token in tokens]
+            matcher_time = time.time() - start_time
+            print("{:10s} {:8d} {:10.3f} {:10.3f} {:8.1f}x {:>8s}".format(
+                name, len(tokens), naive_time, matcher_time, naive_time / max(matcher_time, 1e-9),
+                str(result == expected)))
@@ -0,0 +1,220 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Write fairseq `mmap` indexed datasets (.bin/.idx) straight from the text, without `fairseq-preprocess`: the
+file is cut into newline-aligned byte ranges, each worker looks up the ids of its range into a shard, and the
+shards are concatenated with one index at the end. With --codes the text is segmented with BPE on the way, so
+the BPE text files do not have to be written at all.
+
+The ids are those of a fairseq `Dictionary` loaded from the vocabulary: <s>, <pad>, </s>, <unk>, then the symbols
+of the file in order. Every line ends with </s> and unknown tokens are <unk>, as in `fairseq-preprocess`.
+
+    python -m tools.subword.scripts.bpe.binarize --source-lang src --target-lang trg \
+        --srcdict vocab.bpe.32000 --tgtdict vocab.bpe.32000 --trainpref merged_data/train \
+        --validpref merged_data/dev --destdir data/pre-train --workers 30 [--codes codes.bpe.32000]
+"""
+from __future__ import unicode_literals, division
+
+from .bpe import BPE
+from .bpe import cache_path_of
+from .bpe import line_aligned_ranges
+from .bpe import split_lines
+from .utils import PseudoPool
+import argparse
+import codecs
+import mmap
+import os
+import shutil
+import struct
+import sys
+
+import numpy as np
+
+SPECIAL_SYMBOLS = [u"<s>", u"<pad>", u"</s>", u"<unk>"]
+EOS_INDEX = 2
+UNK_INDEX = 3
+
+# the layout of fairseq's `MMapIndexedDataset.Index`
+INDEX_MAGIC = b"MMIDIDX\x00\x00"
+INDEX_VERSION = 1
+DTYPE_CODES = {np.dtype(np.uint8): 1, np.dtype(np.int8): 2, np.dtype(np.int16): 3, np.dtype(np.int32): 4,
+               np.dtype(np.int64): 5, np.dtype(np.float32): 6, np.dtype(np.float64): 7, np.dtype(np.uint16): 8}
+
+
+def load_dictionary(path):
+    """ Reads a vocabulary ("symbol count" per line) into {symbol: id}, with the ids of a fairseq `Dictionary`. """
+    indices = dict((symbol, i) for i, symbol in enumerate(SPECIAL_SYMBOLS))
+    symbols = list(SPECIAL_SYMBOLS)
+    counts = [1] * len(SPECIAL_SYMBOLS)
+    with codecs.open(path, encoding="utf-8") as f:
+        for line in f:
+            fields = line.rstrip(u"\r\n").rsplit(None, 1)
+            if len(fields) != 2:
+                raise ValueError("Incorrect dictionary format, expected '<token> <cnt>': {!r}".format(line))
+            indices[fields[0]] = len(symbols)
+            symbols.append(fields[0])
+            counts.append(int(fields[1]))
+    return indices, symbols, counts
+
+
+def save_dictionary(path, symbols, counts):
+    """ Writes the dictionary as fairseq does, without the special symbols. """
+    with codecs.open(path, "w", encoding="utf-8") as f:
+        for symbol, count in zip(symbols[len(SPECIAL_SYMBOLS):], counts[len(SPECIAL_SYMBOLS):]):
+            f.write(u"{} {}\n".format(symbol, count))
+
+
+def best_fitting_dtype(vocab_size):
+    return np.dtype(np.uint16) if vocab_size < 65500 else np.dtype(np.int32)
+
+
+def write_index(path, sizes, dtype):
+    """ Writes the .idx of a dataset whose sequences of ids of `dtype` have lengths `sizes`, back to back. """
+    sizes = np.asarray(sizes, dtype=np.int32)
+    pointers = np.zeros(len(sizes), dtype=np.int64)
+    np.cumsum(sizes[:-1], dtype=np.int64, out=pointers[1:])
+    pointers *= dtype.itemsize
+    with open(path, "wb") as f:
+        f.write(INDEX_MAGIC)
+        f.write(struct.pack("<Q", INDEX_VERSION))
+        f.write(struct.pack("<B", DTYPE_CODES[dtype]))
+        f.write(struct.pack("<Q", len(sizes)))
+        f.write(sizes.tobytes(order="C"))
+        f.write(pointers.tobytes(order="C"))
+
+
+def read_dataset(prefix):
+    """ Reads back the dataset `prefix`.bin/.idx, as a list of arrays of ids. """
+    with open(prefix + ".idx", "rb") as f:
+        assert f.read(len(INDEX_MAGIC)) == INDEX_MAGIC, "not an mmap indexed dataset: {}".format(prefix)
+        version, = struct.unpack("<Q", f.read(8))
+        assert version == INDEX_VERSION
+        code, = struct.unpack("<B", f.read(1))
+        length, = struct.unpack("<Q", f.read(8))
+        sizes = np.frombuffer(f.read(4 * length), dtype=np.int32)
+        pointers = np.frombuffer(f.read(8 * length), dtype=np.int64)
+    dtype = dict((c, t) for t, c in DTYPE_CODES.items())[code]
+    data = np.fromfile(prefix + ".bin", dtype=dtype)
+    return [data[p // dtype.itemsize:p // dtype.itemsize + s] for p, s in zip(pointers, sizes)]
+
+
+_worker_indices = None
+_worker_dtype = None
+_worker_bpe = None
+
+
+def init_worker(dict_path, codes=None, separator=u'@@', cache_path=None):
+    global _worker_indices, _worker_dtype, _worker_bpe
+    _worker_indices, symbols, _ = load_dictionary(dict_path)
+    _worker_dtype = best_fitting_dtype(len(symbols))
+    _worker_bpe = BPE(codes, separator=separator) if codes else None
+    # loaded after the fork, instead of being pickled to each worker
+    if _worker_bpe is not None and cache_path:
+        _worker_bpe.load_cache(cache_path)
+
+
+def _binarize_range(args):
+    input_path, start, end, shard_path, block_size = args
+    indices, bpe = _worker_indices, _worker_bpe
+    sizes = []
+    num_tokens = num_unks = 0
+    with open(input_path, "rb") as f, open(shard_path, "wb") as fout:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            pos = start
+            while pos < end:
+                block_end = data.find(b"\n", min(pos + block_size, end) - 1, end)
+                block_end = end if block_end == -1 else block_end + 1
+                lines = split_lines(data[pos:block_end].decode("utf-8"))
+                if bpe is not None:
+                    # segmented as they would be in the BPE text file
+                    lines = [bpe.encode(line.strip(), return_str=True) for line in lines]
+                ids = []
+                for line in lines:
+                    line_ids = [indices.get(token, UNK_INDEX) for token in line.split()]
+                    line_ids.append(EOS_INDEX)
+                    sizes.append(len(line_ids))
+                    ids.extend(line_ids)
+                num_tokens += len(ids)
+                num_unks += ids.count(UNK_INDEX)
+                fout.write(np.array(ids, dtype=_worker_dtype).tobytes())
+                pos = block_end
+        finally:
+            data.close()
+    return shard_path, np.array(sizes, dtype=np.int32), num_tokens, num_unks
+
+
+def binarize(jobs, n_threads, codes=None, separator=u'@@', cache_path=None, block_size=1 << 24):
+    """
+    Binarize the text files of `jobs`, a list of (input_path, output_prefix, dict_path), into
+    `output_prefix`.bin/.idx, with `n_threads` workers over newline-aligned ranges of all files at once.
+    """
+    if not (codes and cache_path and os.path.exists(cache_path)):
+        cache_path = None
+    # one pool per dictionary, almost always a single one shared by both languages
+    for dict_path in sorted(set(job[2] for job in jobs)):
+        dict_jobs = [job for job in jobs if job[2] == dict_path]
+        dtype = best_fitting_dtype(len(load_dictionary(dict_path)[1]))
+        tasks, num_shards = [], []
+        for input_path, output_prefix, _ in dict_jobs:
+            ranges = line_aligned_ranges(input_path, n_threads)
+            num_shards.append(len(ranges))
+            tasks.extend((input_path, start, end, "{}.bin.shard{}".format(output_prefix, i), block_size)
+                         for i, (start, end) in enumerate(ranges))
+        with PseudoPool(n_threads, initializer=init_worker,
+                        initargs=(dict_path, codes, separator, cache_path)) as process_pool:
+            results = process_pool.imap(_binarize_range, tasks)
+            for (input_path, output_prefix, _), n in zip(dict_jobs, num_shards):
+                sizes, num_tokens, num_unks = [], 0, 0
+                with open(output_prefix + ".bin", "wb") as fout:
+                    for _ in range(n):
+                        shard_path, shard_sizes, shard_tokens, shard_unks = next(results)
+                        sizes.append(shard_sizes)
+                        num_tokens, num_unks = num_tokens + shard_tokens, num_unks + shard_unks
+                        with open(shard_path, "rb") as f:
+                            shutil.copyfileobj(f, fout)
+                        os.remove(shard_path)
+                sizes = np.concatenate(sizes) if sizes else np.zeros(0, dtype=np.int32)
+                write_index(output_prefix + ".idx", sizes, dtype)
+                sys.stderr.write("{}: {} sents, {} tokens, {:.3%} replaced by <unk>\n".format(
+                    input_path, len(sizes), num_tokens, num_unks / max(num_tokens, 1)))
+
+
+def preprocess(args):
+    """ The datasets and dictionaries of `fairseq-preprocess` with --srcdict and --tgtdict. """
+    if not os.path.exists(args.destdir):
+        os.makedirs(args.destdir)
+    langs = [(args.source_lang, args.srcdict), (args.target_lang, args.tgtdict)]
+    for lang, dict_path in langs:
+        _, symbols, counts = load_dictionary(dict_path)
+        save_dictionary(os.path.join(args.destdir, "dict.{}.txt".format(lang)), symbols, counts)
+    jobs = []
+    for split, pref in [("train", args.trainpref), ("valid", args.validpref), ("test", args.testpref)]:
+        if not pref:
+            continue
+        for i, pref in enumerate(pref.split(",")):
+            split_name = split if i == 0 else "{}{}".format(split, i)
+            for lang, dict_path in langs:
+                output_prefix = os.path.join(args.destdir, "{}.{}-{}.{}".format(
+                    split_name, args.source_lang, args.target_lang, lang))
+                jobs.append(("{}.{}".format(pref, lang), output_prefix, dict_path))
+    cache_path = args.cache if args.cache else (cache_path_of(args.codes) if args.codes else None)
+    binarize(jobs, args.workers, args.codes, args.separator, cache_path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="binarize text into fairseq mmap indexed datasets")
+    parser.add_argument('--source-lang', dest='source_lang', required=True)
+    parser.add_argument('--target-lang', dest='target_lang', required=True)
+    parser.add_argument('--srcdict', required=True, help="Source vocabulary, e.g. vocab.bpe.32000")
+    parser.add_argument('--tgtdict', required=True, help="Target vocabulary")
+    parser.add_argument('--trainpref', default=None, help="Comma separated train file prefixes")
+    parser.add_argument('--validpref', default=None, help="Comma separated valid file prefixes")
+    parser.add_argument('--testpref', default=None, help="Comma separated test file prefixes")
+    parser.add_argument('--destdir', required=True)
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--codes', '-c', default=None,
+                        help="BPE codes, to segment text that has not been segmented yet")
+    parser.add_argument('--separator', '-s', default=u'@@')
+    parser.add_argument('--cache', default=None, help="BPE word cache, default: codes + '.cache' if it exists")
+    args = parser.parse_args()
+    preprocess(args)
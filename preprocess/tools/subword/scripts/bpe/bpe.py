@@ -13,14 +13,26 @@ Proceedings of the 54th Annual Meeting of the Association for Computational Ling
 from __future__ import unicode_literals, division
 
 from .subword_encoder import SubwordEncoder
+from .bundle import Bundle
+from .bundle import is_bundle
 from .utils import force_to_str_list
 from .utils import to_unicode
 from .utils import PseudoPool
+from .utils import bounded_imap
 from .utils import load_protected_patterns
+import ahocorasick as ahc
 import argparse
 import codecs
+import hashlib
+import heapq
+import io
+import os
 import sys
 import re
+import mmap
+import shutil
+import time
+from collections import Counter
 
 
 class BPE(SubwordEncoder):
@@ -29,6 +41,32 @@ class BPE(SubwordEncoder):
         super(BPE, self).__init__()
 
         assert codes, "codes should be provided."
+        self.codes_path = codes
+        self.separator = separator
+        self.bundle = None
+        if is_bundle(codes):
+            # a model compiled by `bundle.py`, with its vocabulary
+            assert not vocabulary, "the vocabulary of a compiled model is given when compiling it"
+            self.bundle = Bundle(codes)
+            model = self.bundle.model
+            self.vocabulary_path = None
+            self.vocabulary_threshold = model["vocabulary_threshold"]
+            self.version = model["version"]
+            self.bpe_codes = model["bpe_codes"]
+            self.bpe_codes_reverse = model["bpe_codes_reverse"]
+            self.vocab = model["vocab"]
+            self.glossaries = model["glossaries"]
+            self.glossary_matcher = model["glossary_matcher"]
+        else:
+            self._load_text(codes, vocabulary, vocabulary_threshold)
+        # word -> segments, shared with `bpe_encode` for the segments of the words split by glossaries
+        self.cache = {}
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    def _load_text(self, codes, vocabulary, vocabulary_threshold):
+        self.vocabulary_path = vocabulary
+        self.vocabulary_threshold = vocabulary_threshold
         codes = codecs.open(codes, encoding='utf-8')
         # check version information
         firstline = codes.readline()
@@ -43,12 +81,12 @@ class BPE(SubwordEncoder):
         # some hacking to deal with duplicates (only consider first instance)
         self.bpe_codes = dict([(code, i) for (i, code) in reversed(list(enumerate(self.bpe_codes)))])
         self.bpe_codes_reverse = dict([(pair[0] + pair[1], pair) for pair, i in self.bpe_codes.items()])
-        self.separator = separator
         if vocabulary:
             self.vocab = read_vocabulary(codecs.open(vocabulary, encoding="utf-8"), vocabulary_threshold)
         else:
             self.vocab = None
         self.glossaries = load_protected_patterns()
+        self.glossary_matcher = GlossaryMatcher(self.glossaries)
 
     def encode(self, words, return_str=False):
         """segment single sentence (whitespace-tokenized string) with BPE encoding"""
@@ -57,15 +95,23 @@ class BPE(SubwordEncoder):
             if not isinstance(words, list):
                 tokens = words.strip().split()
             output = []
+            cache = self.cache
             for word in tokens:
-                new_word = [out for segment in self._isolate_glossaries(word)
-                            for out in bpe_encode(segment,
-                                                  self.bpe_codes,
-                                                  self.bpe_codes_reverse,
-                                                  self.vocab,
-                                                  self.separator,
-                                                  self.version,
-                                                  self.glossaries)]
+                new_word = cache.get(word)
+                if new_word is None:
+                    self.cache_misses += 1
+                    new_word = [out for segment in self._isolate_glossaries(word)
+                                for out in bpe_encode(segment,
+                                                      self.bpe_codes,
+                                                      self.bpe_codes_reverse,
+                                                      self.vocab,
+                                                      self.separator,
+                                                      self.version,
+                                                      self.glossary_matcher.glossary_set,
+                                                      cache)]
+                    cache[word] = new_word
+                else:
+                    self.cache_hits += 1
 
                 for item in new_word[:-1]:
                     output.append(item + self.separator)
@@ -95,12 +141,94 @@ class BPE(SubwordEncoder):
             return sentence
         return force_to_str_list(sentence)
 
+    def fingerprint(self):
+        """ Identifies the segmentation of this instance: the codes, the vocabulary and its threshold. """
+        md5 = hashlib.md5()
+        if self.bundle is not None:
+            # the bytes of the files it was compiled from
+            for name in ("codes_file", "vocabulary_file"):
+                if self.bundle.source(name) is not None:
+                    md5.update(self.bundle.source(name))
+                md5.update(b"\0")
+        else:
+            for path in (self.codes_path, self.vocabulary_path):
+                if path:
+                    with open(path, "rb") as f:
+                        for chunk in iter(lambda: f.read(1 << 20), b""):
+                            md5.update(chunk)
+                md5.update(b"\0")
+        md5.update("{} {}".format(self.vocabulary_threshold, self.separator).encode("utf-8"))
+        return md5.hexdigest()
+
+    def warm_cache(self, words):
+        """ Segments `words`, e.g. the most frequent types of the corpus, into the cache. """
+        for word in words:
+            if word not in self.cache:
+                self.encode([word])
+
+    def save_cache(self, path):
+        """ Writes the cache as "word<TAB>segments" lines, after the fingerprint of the model. """
+        with codecs.open(path, "w", encoding="utf-8") as f:
+            f.write(u"#fingerprint: {}\n".format(self.fingerprint()))
+            for word, segments in self.cache.items():
+                f.write(u"{}\t{}\n".format(word, u" ".join(segments)))
+
+    def load_cache(self, path):
+        """ Adds the cache saved by `save_cache` (or a types table of `apply_type_first`) with the same model to the
+        cache, returns the number of words. """
+        with codecs.open(path, encoding="utf-8") as f:
+            fingerprint = f.readline().strip().split()[-1]
+            if fingerprint != self.fingerprint():
+                sys.stderr.write("ignore the BPE cache {}, it was built with other codes\n".format(path))
+                return 0
+            count = 0
+            for line in f:
+                word, segments = line.rstrip(u"\n").split(u"\t")[:2]
+                self.cache[word] = segments.split(u" ")
+                count += 1
+        return count
+
     def _isolate_glossaries(self, word):
-        word_segments = [word]
-        for gloss in self.glossaries:
-            word_segments = [out_segments for segment in word_segments
-                             for out_segments in isolate_glossary(segment, gloss)]
-        return word_segments
+        return self.glossary_matcher.isolate(word)
+
+
+class GlossaryMatcher(object):
+    """Isolates the glossaries in a word like `isolate_glossaries_naive`, but first finds the glossaries that occur
+    in the word with one scan of an Aho-Corasick automaton over all of them. Only those are then isolated, in the
+    order of the glossary list: the others cannot occur in any segment, which are substrings of the word, so the
+    segments are the same, and a word without glossaries costs one scan whatever the size of the glossary.
+    """
+
+    def __init__(self, glossaries):
+        # the position of the first occurrence of each glossary in the list; empty glossaries match nothing
+        self.order = {}
+        for gloss in glossaries:
+            if gloss:
+                self.order.setdefault(gloss, len(self.order))
+        self.glossary_set = frozenset(self.order)
+        self.automaton = None
+        if self.order:
+            self.automaton = ahc.Automaton()
+            for gloss, i in self.order.items():
+                self.automaton.add_word(gloss, (i, gloss))
+            self.automaton.make_automaton()
+
+    def isolate(self, word):
+        if self.automaton is None:
+            return [word]
+        found = set(value for _, value in self.automaton.iter(word))
+        if not found:
+            return [word]
+        return isolate_glossaries_naive(word, [gloss for _, gloss in sorted(found)])
+
+
+def isolate_glossaries_naive(word, glossaries):
+    """Isolate each glossary of the list in turn, in all segments of word."""
+    word_segments = [word]
+    for gloss in glossaries:
+        word_segments = [out_segments for segment in word_segments
+                         for out_segments in isolate_glossary(segment, gloss)]
+    return word_segments
 
 
 def get_pairs(word):
@@ -116,10 +244,12 @@ def get_pairs(word):
     return pairs
 
 
-def bpe_encode(orig, bpe_codes, bpe_codes_reverse, vocab, separator, version, glossaries=None, cache={}):
+def bpe_encode(orig, bpe_codes, bpe_codes_reverse, vocab, separator, version, glossaries=None, cache=None):
     """Encode word based on list of BPE merge operations, which are applied consecutively
     """
 
+    if cache is None:
+        cache = {}
     if orig in cache:
         return cache[orig]
 
@@ -134,11 +264,78 @@ def bpe_encode(orig, bpe_codes, bpe_codes_reverse, vocab, separator, version, gl
     else:
         raise NotImplementedError
 
-    pairs = get_pairs(word)
-
-    if not pairs:
+    if len(word) < 2:
         return orig
 
+    word = merge_symbols(word, bpe_codes)
+
+    # don't print end-of-word symbols
+    if word[-1] == '</w>':
+        word = word[:-1]
+    elif word[-1].endswith('</w>'):
+        word = word[:-1] + (word[-1].replace('</w>', ''),)
+
+    if vocab:
+        word = check_vocab_and_split(word, bpe_codes_reverse, vocab, separator)
+
+    cache[orig] = word
+    return word
+
+
+def merge_symbols(word, bpe_codes):
+    """Apply the BPE merges to the symbols of word, a tuple of at least 2 symbols.
+
+    The symbols are a doubly-linked list over their start positions, and the candidate merges a heap of
+    (rank, position, first, second), so that each merge costs O(log n) instead of a scan of the whole word.
+    All occurrences of a pair are merged in one round, left to right, before the pairs they create are pushed:
+    this is the order of `merge_symbols_naive`, so the result is the same.
+    """
+    symbols = list(word)
+    nxt = list(range(1, len(symbols) + 1))
+    nxt[-1] = -1
+    prv = list(range(-1, len(symbols) - 1))
+    get = bpe_codes.get
+    heap = []
+    for i in range(len(symbols) - 1):
+        rank = get((symbols[i], symbols[i + 1]))
+        if rank is not None:
+            heap.append((rank, i, symbols[i], symbols[i + 1]))
+    heapq.heapify(heap)
+    while heap:
+        rank, i, first, second = heapq.heappop(heap)
+        merged = []
+        while True:
+            # skip the candidates that earlier merges invalidated
+            j = nxt[i]
+            if j != -1 and symbols[i] == first and symbols[j] == second:
+                symbols[i] = first + second
+                symbols[j] = None
+                k = nxt[i] = nxt[j]
+                if k != -1:
+                    prv[k] = i
+                merged.append(i)
+            if not heap or heap[0][0] != rank:
+                break
+            _, i, _, _ = heapq.heappop(heap)
+        for i in merged:
+            j = prv[i]
+            if j != -1:
+                pair_rank = get((symbols[j], symbols[i]))
+                if pair_rank is not None:
+                    heapq.heappush(heap, (pair_rank, j, symbols[j], symbols[i]))
+            j = nxt[i]
+            if j != -1:
+                pair_rank = get((symbols[i], symbols[j]))
+                if pair_rank is not None:
+                    heapq.heappush(heap, (pair_rank, i, symbols[i], symbols[j]))
+    return tuple(symbol for symbol in symbols if symbol is not None)
+
+
+def merge_symbols_naive(word, bpe_codes):
+    """Apply the BPE merges to the symbols of word by merging the pair of lowest rank, then looking for the next one
+    in the whole word again. This is the reference of `merge_symbols`, see benchmark.py.
+    """
+    pairs = get_pairs(word)
     while True:
         bigram = min(pairs, key=lambda pair: bpe_codes.get(pair, float('inf')))
         if bigram not in bpe_codes:
@@ -167,17 +364,6 @@ def bpe_encode(orig, bpe_codes, bpe_codes_reverse, vocab, separator, version, gl
             break
         else:
             pairs = get_pairs(word)
-
-    # don't print end-of-word symbols
-    if word[-1] == '</w>':
-        word = word[:-1]
-    elif word[-1].endswith('</w>'):
-        word = word[:-1] + (word[-1].replace('</w>', ''),)
-
-    if vocab:
-        word = check_vocab_and_split(word, bpe_codes_reverse, vocab, separator)
-
-    cache[orig] = word
     return word
 
 
@@ -266,43 +452,225 @@ def isolate_glossary(word, glossary):
         return segments + [splits[-1].strip()] if splits[-1] != '' else segments
 
 
+def cache_path_of(codes):
+    """ The persistent word cache saved next to the codes, see `BPE.save_cache`. A model compiled next to the codes
+    shares their cache, the fingerprints are the same. """
+    if codes.endswith(".bin") and is_bundle(codes):
+        codes = codes[:-len(".bin")]
+    return codes + ".cache"
+
+
+def build_cache(bpe, vocab, cache_size, path=None):
+    """
+    Pre-warm the cache of `bpe` with the `cache_size` most frequent types of `vocab` (a Counter of words) and
+    save it to `path`, next to the codes by default.
+    """
+    bpe.warm_cache(word for word, _ in vocab.most_common(cache_size))
+    bpe.save_cache(path or cache_path_of(bpe.codes_path))
+
+
+# the BPE instance of each worker of `main`, loaded once by `init_worker` instead of being sent with every chunk
+_worker_bpe = None
+
+
+def init_worker(codes, separator, cache_path=None):
+    """ Loads the codes, and the cache at `cache_path` if given, in each worker after the fork. """
+    global _worker_bpe
+    _worker_bpe = BPE(codes, separator=separator)
+    if cache_path:
+        _worker_bpe.load_cache(cache_path)
+
+
 def apply_fn(args):
-    texts, cls_ins, recover_subword = args
+    texts, recover_subword = args
+    cls_ins = _worker_bpe
+    hits, misses = cls_ins.cache_hits, cls_ins.cache_misses
     ret = []
     for text in texts:
         if recover_subword:
             ret.append(cls_ins.decode(to_unicode(text.strip()), return_str=True))
         else:
             ret.append(cls_ins.encode(to_unicode(text.strip()), return_str=True))
-    return ret
+    return ret, cls_ins.cache_hits - hits, cls_ins.cache_misses - misses
 
 
-def main(input, output, codes, recover_subword, n_threads, n_samples_per_thread, separator=u'@@'):
-    bpe = BPE(codes, separator=separator)
+def read_chunks(input, chunk_size, recover_subword):
+    """ Yields the arguments of `apply_fn` for chunks of `chunk_size` lines of `input`. """
+    sentence_list = []
+    for line in input:
+        sentence_list.append(line.strip())
+        if len(sentence_list) >= chunk_size:
+            yield sentence_list, recover_subword
+            sentence_list = []
+    if len(sentence_list) > 0:
+        yield sentence_list, recover_subword
 
-    with PseudoPool(n_threads) as process_pool:
-        sentence_list = []
-        for line in input:
-            sentence_list.append(line.strip())
-            if len(sentence_list) >= n_samples_per_thread * n_threads:
-                arg_list_list = PseudoPool.parse_arg_list(n_threads, sentence_list, bpe, recover_subword)
-                # sys.stderr.write("loading {}...\n".format(len(sentence_list)))
-                processed_list_list = process_pool.map(
-                    apply_fn, arg_list_list)
-                # sys.stderr.write("{} lines processed...\n".format(len(sentence_list)))
-                for processed_list in processed_list_list:
-                    for l in processed_list:
-                        output.write(l + u"\n")
-                del sentence_list[:]
-                sentence_list = []
-        if len(sentence_list) > 0:
-            arg_list_list = PseudoPool.parse_arg_list(n_threads, sentence_list, bpe, recover_subword)
-            processed_list_list = process_pool.map(
-                apply_fn, arg_list_list)
-            for processed_list in processed_list_list:
-                for l in processed_list:
-                    output.write(l + u"\n")
-            del sentence_list[:]
+
+def main(input, output, codes, recover_subword, n_threads, n_samples_per_thread, separator=u'@@', cache_path=None,
+         max_in_flight=None):
+    """
+    Encode (or decode with `recover_subword`) `input` to `output` with `n_threads` workers, that load the codes
+    once. Each worker loads the words of the cache at `cache_path`, if it exists, when it starts.
+
+    The lines are read in chunks of `n_samples_per_thread` as the workers encode and this thread writes the encoded
+    chunks in order. At most `max_in_flight` chunks (2 per thread by default) are read and not yet written, which
+    bounds the memory.
+    """
+    if cache_path and os.path.exists(cache_path) and not recover_subword:
+        sys.stderr.write("loading the BPE cache {} in each worker\n".format(cache_path))
+    else:
+        cache_path = None
+    hits = misses = 0
+
+    with PseudoPool(n_threads, initializer=init_worker, initargs=(codes, separator, cache_path)) as process_pool:
+        chunks = read_chunks(input, n_samples_per_thread, recover_subword)
+        for processed_list, _hits, _misses in bounded_imap(process_pool, apply_fn, chunks,
+                                                           max_in_flight or 2 * n_threads):
+            hits, misses = hits + _hits, misses + _misses
+            for l in processed_list:
+                output.write(l + u"\n")
+    if hits + misses > 0:
+        sys.stderr.write("BPE cache: {} hits, {} misses, hit rate {:.2%}\n".format(
+            hits, misses, hits / (hits + misses)))
+
+
+# the line breaks of a file opened in text mode; the other line boundaries of `str.splitlines` (form feed, \x85,
+# \u2028, ...) can occur inside the lines of a corpus
+NEWLINE = re.compile(r"\r\n|\r|\n")
+
+
+def split_lines(text):
+    """ Splits `text` at the line breaks of a file opened in text mode, without the empty string after the last one. """
+    lines = NEWLINE.split(text)
+    if not lines[-1]:
+        lines.pop()
+    return lines
+
+
+def open_text(path):
+    """ Opens `path` for reading with the line breaks of `split_lines`, as `apply_file` and `apply_type_first` read
+    their inputs; codecs would also break the lines at the unicode line boundaries. """
+    return io.open(path, encoding="utf-8", newline=None)
+
+
+def line_aligned_ranges(path, n_ranges):
+    """ Splits the file at `path` into at most `n_ranges` byte ranges (start, end) that begin after a newline. """
+    size = os.path.getsize(path)
+    bounds = [0]
+    if size > 0:
+        with open(path, "rb") as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            for i in range(1, n_ranges):
+                newline = data.find(b"\n", max(size * i // n_ranges, bounds[-1]))
+                if newline == -1 or newline + 1 >= size:
+                    break
+                bounds.append(newline + 1)
+            data.close()
+    bounds.append(size)
+    return [(start, end) for start, end in zip(bounds[:-1], bounds[1:]) if end > start]
+
+
+def _encode_range(args):
+    input_path, start, end, shard_path, block_size = args
+    bpe = _worker_bpe
+    hits, misses = bpe.cache_hits, bpe.cache_misses
+    with open(input_path, "rb") as f, codecs.open(shard_path, "w", encoding="utf-8") as fout:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            pos = start
+            while pos < end:
+                # blocks of whole lines, so that memory does not grow with the range
+                block_end = data.find(b"\n", min(pos + block_size, end) - 1, end)
+                block_end = end if block_end == -1 else block_end + 1
+                for line in split_lines(data[pos:block_end].decode("utf-8")):
+                    fout.write(bpe.encode(line.strip(), return_str=True) + u"\n")
+                pos = block_end
+        finally:
+            data.close()
+    return shard_path, bpe.cache_hits - hits, bpe.cache_misses - misses
+
+
+def apply_file(input_path, output_path, codes, n_threads, separator=u'@@', cache_path=None, block_size=1 << 24):
+    """
+    Encode the file `input_path` to `output_path` with `n_threads` workers, without going through a pipe or a
+    copy of the input: the file is cut into newline-aligned byte ranges, each worker maps the file and encodes its
+    range into a shard next to the output, and the shards are concatenated in order. The output is the same as
+    with `main`.
+    """
+    if not (cache_path and os.path.exists(cache_path)):
+        cache_path = None
+    ranges = line_aligned_ranges(input_path, n_threads)
+    tasks = [(input_path, start, end, "{}.shard{}".format(output_path, i), block_size)
+             for i, (start, end) in enumerate(ranges)]
+    hits = misses = 0
+    with PseudoPool(n_threads, initializer=init_worker, initargs=(codes, separator, cache_path)) as process_pool, \
+            open(output_path, "wb") as fout:
+        for shard_path, _hits, _misses in process_pool.imap(_encode_range, tasks):
+            hits, misses = hits + _hits, misses + _misses
+            with open(shard_path, "rb") as f:
+                shutil.copyfileobj(f, fout)
+            os.remove(shard_path)
+    if hits + misses > 0:
+        sys.stderr.write("{}: {} ranges, BPE cache hit rate {:.2%}\n".format(
+            input_path, len(ranges), hits / (hits + misses)))
+
+
+def _count_types(args):
+    path, start, end = args
+    with open(path, "rb") as f:
+        f.seek(start)
+        return Counter(f.read(end - start).decode("utf-8").split())
+
+
+def _segment_types(words):
+    return [_worker_bpe.encode([word], return_str=True) for word in words]
+
+
+def apply_type_first(input_paths, output_paths, codes, n_threads, types_path=None, separator=u'@@'):
+    """
+    Apply BPE type by type instead of token by token: count the word types of all `input_paths` in parallel,
+    segment each type once in parallel, then rewrite each input to its output with dictionary lookups. The output
+    is the same as with `main`.
+
+    :param types_path: the types table, "word<TAB>segments<TAB>count" lines of all types by decreasing count. If
+        it exists and was built with the same codes, its types are not segmented again. It is then rewritten
+        with the types of `input_paths`, and can also be given to `main` as a cache.
+    """
+    start_time = time.time()
+    bpe = BPE(codes, separator=separator)
+    if types_path and os.path.exists(types_path):
+        sys.stderr.write("loaded {} types from {}\n".format(bpe.load_cache(types_path), types_path))
+
+    with PseudoPool(n_threads, initializer=init_worker, initargs=(codes, separator)) as process_pool:
+        ranges = [(path, start, end) for path in input_paths for start, end in line_aligned_ranges(path, n_threads)]
+        counts = Counter()
+        for range_counts in process_pool.map(_count_types, ranges):
+            counts.update(range_counts)
+        count_time = time.time()
+
+        new_types = [word for word in counts if word not in bpe.cache]
+        chunk_size = len(new_types) // n_threads + 1
+        chunks = [new_types[i:i + chunk_size] for i in range(0, len(new_types), chunk_size)]
+        table = dict((word, (separator + u" ").join(segments)) for word, segments in bpe.cache.items()
+                     if word in counts)
+        for chunk, segmented in zip(chunks, process_pool.map(_segment_types, chunks)):
+            table.update(zip(chunk, segmented))
+        segment_time = time.time()
+
+    for input_path, output_path in zip(input_paths, output_paths):
+        with open_text(input_path) as fin, codecs.open(output_path, "w", encoding="utf-8") as fout:
+            for line in fin:
+                fout.write(u" ".join([table[word] for word in line.split()]) + u"\n")
+
+    if types_path:
+        with codecs.open(types_path, "w", encoding="utf-8") as f:
+            f.write(u"#fingerprint: {}\n".format(bpe.fingerprint()))
+            for word, count in counts.most_common():
+                f.write(u"{}\t{}\t{}\n".format(word, table[word].replace(separator + u" ", u" "), count))
+    sys.stderr.write("{} tokens, {} types ({} segmented): counted in {:.1f}s, segmented in {:.1f}s, "
+                     "rewritten in {:.1f}s\n".format(sum(counts.values()), len(counts), len(new_types),
+                                                    count_time - start_time, segment_time - count_time,
+                                                    time.time() - segment_time))
 
 
 if __name__ == "__main__":
@@ -314,7 +682,8 @@ if __name__ == "__main__":
     else:
         sys.stderr = codecs.getwriter('UTF-8')(sys.stderr.buffer)
         sys.stdout = codecs.getwriter('UTF-8')(sys.stdout.buffer)
-        sys.stdin = codecs.getreader('UTF-8')(sys.stdin.buffer)
+        # universal newlines, see `open_text`
+        sys.stdin = io.TextIOWrapper(sys.stdin.buffer, encoding='utf-8', newline=None)
 
     parser = argparse.ArgumentParser(
         formatter_class=argparse.RawDescriptionHelpFormatter,
@@ -338,12 +707,41 @@ if __name__ == "__main__":
     parser.add_argument(
         '--sample_per_thread', '-n', type=int, dest="sample_per_thread",
         default=20000, help="Num of samples per threads")
+    parser.add_argument(
+        '--cache', type=str, default=None, metavar='PATH',
+        help="Word cache shared by all threads (default: codes path + '.cache', if it exists)")
+    parser.add_argument(
+        '--byte_ranges', action="store_true", default=False,
+        help="Encode the --input file in newline-aligned byte ranges, one per thread, see apply_file")
+    parser.add_argument(
+        '--type_first', type=str, nargs='+', default=None, metavar='PATH',
+        help="Apply BPE to these files type by type, see apply_type_first, instead of --input")
+    parser.add_argument(
+        '--type_first_output', type=str, nargs='+', default=None, metavar='PATH',
+        help="Output files of --type_first, one per input file")
+    parser.add_argument(
+        '--types', type=str, default=None, metavar='PATH',
+        help="Types table of --type_first, reused if it exists")
 
     args = parser.parse_args()
 
+    if args.type_first:
+        if not args.type_first_output or len(args.type_first) != len(args.type_first_output):
+            parser.error("--type_first_output needs one output file per --type_first input")
+        apply_type_first(args.type_first, args.type_first_output, args.codes, args.threads, args.types)
+        sys.exit(0)
+    if args.byte_ranges:
+        if args.input.name == '<stdin>' or args.output.name == '<stdout>' or args.recover:
+            parser.error("--byte_ranges encodes an --input file to an --output file")
+        args.output.close()
+        apply_file(args.input.name, args.output.name, args.codes, args.threads,
+                   cache_path=args.cache or cache_path_of(args.codes))
+        sys.exit(0)
+
     if args.input.name != '<stdin>':
-        args.input = codecs.open(args.input.name, "r", encoding='utf-8')
+        args.input = open_text(args.input.name)
     if args.output.name != '<stdout>':
         args.output = codecs.open(args.output.name, 'w', encoding='utf-8')
 
-    main(args.input, args.output, args.codes, args.recover, args.threads, args.sample_per_thread)
+    main(args.input, args.output, args.codes, args.recover, args.threads, args.sample_per_thread,
+         cache_path=args.cache or cache_path_of(args.codes))
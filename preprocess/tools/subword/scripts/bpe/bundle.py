@@ -0,0 +1,127 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Compile a BPE model into one versioned binary file, that `BPE` loads instead of the text files: the codes and
+the reverse codes, the glossaries with their automaton, and the vocabulary, ready to use, plus the bytes of the
+codes and vocabulary files, so that the fingerprint (and the word caches and types tables) stays the same.
+
+The file is memory-mapped and each section is unpickled from the map, so the load time is that of building the
+dictionaries, without reading, splitting and ranking the text.
+
+    python -m tools.subword.scripts.bpe.bundle -c codes.bpe.32000 -o codes.bpe.32000.bin [--benchmark 10]
+"""
+from __future__ import unicode_literals, division, print_function
+
+import argparse
+import json
+import mmap
+import os
+import pickle
+import struct
+import time
+from collections import OrderedDict
+
+MAGIC = b"BPEMODEL"
+VERSION = 1
+PICKLE_PROTOCOL = 4
+
+
+def bundle_path_of(codes):
+    """ The compiled model next to the codes. """
+    return codes + ".bin"
+
+
+def is_bundle(path):
+    if not os.path.isfile(path):
+        return False
+    with open(path, "rb") as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def save_bundle(bpe, output_path):
+    """ Writes the model of the `BPE` instance `bpe`, loaded from text files, to `output_path`. """
+    assert bpe.bundle is None, "compile the model from the text files"
+    model = {
+        "version": bpe.version,
+        "bpe_codes": bpe.bpe_codes,
+        "bpe_codes_reverse": bpe.bpe_codes_reverse,
+        "vocab": bpe.vocab,
+        "vocabulary_threshold": bpe.vocabulary_threshold,
+        "glossaries": list(bpe.glossaries),
+        "glossary_matcher": bpe.glossary_matcher,
+    }
+    sections = OrderedDict([("model", pickle.dumps(model, PICKLE_PROTOCOL))])
+    for name, path in (("codes_file", bpe.codes_path), ("vocabulary_file", bpe.vocabulary_path)):
+        if path:
+            with open(path, "rb") as f:
+                sections[name] = f.read()
+    header = {"sections": OrderedDict()}
+    offset = 0
+    for name, data in sections.items():
+        header["sections"][name] = [offset, len(data)]
+        offset += len(data)
+    header_bytes = json.dumps(header).encode("utf-8")
+    with open(output_path, "wb") as fw:
+        fw.write(MAGIC)
+        fw.write(struct.pack("<II", VERSION, len(header_bytes)))
+        fw.write(header_bytes)
+        for data in sections.values():
+            fw.write(data)
+
+
+class Bundle(object):
+    """A compiled BPE model written by `save_bundle`."""
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._mmap[:len(MAGIC)] != MAGIC:
+            raise ValueError("{} is not a compiled BPE model".format(path))
+        version, header_len = struct.unpack_from("<II", self._mmap, len(MAGIC))
+        if version != VERSION:
+            raise ValueError("{} has version {}, expected {}, compile it again".format(path, version, VERSION))
+        data_start = len(MAGIC) + 8 + header_len
+        header = json.loads(self._mmap[len(MAGIC) + 8:data_start].decode("utf-8"))
+        view = memoryview(self._mmap)
+        self._sections = dict((name, view[data_start + offset:data_start + offset + length])
+                              for name, (offset, length) in header["sections"].items())
+        self.model = pickle.loads(self._sections["model"])
+
+    def source(self, name):
+        """ The bytes of the file `name` ("codes_file" or "vocabulary_file") the model was compiled from. """
+        return self._sections.get(name)
+
+
+def benchmark(codes, bundle_path, repeat, vocabulary=None, vocabulary_threshold=None):
+    """ Prints the construction time of `BPE` from the text files and from the bundle. """
+    from .bpe import BPE
+    text_times, bundle_times = [], []
+    for _ in range(repeat):
+        start_time = time.time()
+        text_bpe = BPE(codes, vocabulary=vocabulary, vocabulary_threshold=vocabulary_threshold)
+        text_times.append(time.time() - start_time)
+        start_time = time.time()
+        bundle_bpe = BPE(bundle_path)
+        bundle_times.append(time.time() - start_time)
+    same = (text_bpe.bpe_codes == bundle_bpe.bpe_codes and text_bpe.bpe_codes_reverse == bundle_bpe.bpe_codes_reverse
+            and text_bpe.vocab == bundle_bpe.vocab and text_bpe.glossaries == bundle_bpe.glossaries
+            and text_bpe.fingerprint() == bundle_bpe.fingerprint())
+    print("{} codes, {} glossaries, best of {}: text {:.1f} ms, bundle {:.1f} ms, {:.1f}x, same model: {}".format(
+        len(text_bpe.bpe_codes), len(text_bpe.glossaries), repeat, 1000 * min(text_times),
+        1000 * min(bundle_times), min(text_times) / max(min(bundle_times), 1e-9), same))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="compile a BPE model into one binary file")
+    parser.add_argument('--codes', '-c', required=True, help="BPE codes")
+    parser.add_argument('--output', '-o', default=None, help="Compiled model, default: codes + '.bin'")
+    parser.add_argument('--vocabulary', default=None, help="Vocabulary file")
+    parser.add_argument('--vocabulary-threshold', dest='vocabulary_threshold', type=int, default=None)
+    parser.add_argument('--benchmark', type=int, default=0, metavar='N',
+                        help="Compare the load time of the text files and the compiled model, best of N")
+    args = parser.parse_args()
+
+    from .bpe import BPE
+    output = args.output or bundle_path_of(args.codes)
+    save_bundle(BPE(args.codes, vocabulary=args.vocabulary, vocabulary_threshold=args.vocabulary_threshold), output)
+    if args.benchmark:
+        benchmark(args.codes, output, args.benchmark, args.vocabulary, args.vocabulary_threshold)
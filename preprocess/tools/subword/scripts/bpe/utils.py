@@ -8,7 +8,7 @@ import codecs
 import json
 import multiprocessing
 import ahocorasick as ahc
-from collections import Counter, defaultdict
+from collections import Counter, defaultdict, deque
 
 import six
 
@@ -425,15 +425,18 @@ def get_vocabulary(fobj, is_dict_style=False):
 
 
 class PseudoPool(object):
-    def __init__(self, processes=1):
+    def __init__(self, processes=1, initializer=None, initargs=()):
         """ If processes is 1, then don't create pool.
 
         Args:
             processes:
+            initializer: called with `initargs` once in each worker, or in this process if processes is 1
         """
         self.pool = None
         if processes > 1:
-            self.pool = multiprocessing.Pool(processes=processes)
+            self.pool = multiprocessing.Pool(processes=processes, initializer=initializer, initargs=initargs)
+        elif initializer is not None:
+            initializer(*initargs)
         self.processes = processes
 
     @staticmethod
@@ -461,6 +464,9 @@ class PseudoPool(object):
     def map(self, func, args_list):
         return [func(args) for args in args_list]
 
+    def imap(self, func, args_iter):
+        return (func(args) for args in args_iter)
+
     def __enter__(self):
         if self.processes > 1:
             return self.pool
@@ -471,6 +477,28 @@ class PseudoPool(object):
             self.pool.terminate()
 
 
+def bounded_imap(pool, func, args_iter, max_in_flight):
+    """ `pool.imap(func, args_iter)`, in order, with at most `max_in_flight` tasks submitted and not yet consumed.
+
+    The arguments are read and the tasks submitted by the consuming thread, as the results are consumed, so the
+    memory is bounded and the exception of a task is raised by the iteration, as with `map`.
+
+    Args:
+        pool: the `multiprocessing.Pool`, or the `PseudoPool`, returned by `PseudoPool.__enter__`
+    """
+    if isinstance(pool, PseudoPool):
+        for result in pool.imap(func, args_iter):
+            yield result
+        return
+    pending = deque()
+    for args in args_iter:
+        pending.append(pool.apply_async(func, (args,)))
+        if len(pending) >= max_in_flight:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
 def text_encoders_yaml2json(loader_dict, output_folder, plain_text_extractor):
     with open(PROTECTED_PATTERNS_FILE, "r") as fp:
         protected = [l.strip() for l in fp]
@@ -16,31 +16,67 @@ from __future__ import unicode_literals
 from __future__ import absolute_import
 
 import sys
-import re
 import os
-import copy
+import heapq
 import codecs
 import argparse
 from collections import defaultdict, Counter
 from io import open
 
+from .bpe.bpe import BPE, build_cache, cache_path_of
 from .bpe.bpe import main as encode_file
+from .bpe.bundle import bundle_path_of, save_bundle
 from .bpe.utils import get_vocabulary
 
 argparse.open = open
 
 
-def update_pair_statistics(pair, changed, stats, indices):
+# a pair of symbol ids (first, second) is the integer first << PAIR_SHIFT | second
+PAIR_SHIFT = 32
+PAIR_MASK = (1 << PAIR_SHIFT) - 1
+
+
+class SymbolTable(object):
+    """The symbols of the learner, as integer ids: the words are lists of ids, merged in place, and the pairs are
+    integers. A merge that produces the string of an existing symbol gets its id, as with strings.
+    """
+
+    def __init__(self):
+        self.symbols = []
+        self.ids = {}
+
+    def id(self, symbol):
+        symbol_id = self.ids.get(symbol)
+        if symbol_id is None:
+            symbol_id = self.ids[symbol] = len(self.symbols)
+            self.symbols.append(symbol)
+        return symbol_id
+
+    def word(self, symbols):
+        ids = self.ids
+        return [ids[symbol] if symbol in ids else self.id(symbol) for symbol in symbols]
+
+    def pair(self, key):
+        """ The strings of the pair `key`. """
+        return self.symbols[key >> PAIR_SHIFT], self.symbols[key & PAIR_MASK]
+
+
+def update_pair_statistics(pair, new_symbol, changed, stats, indices, increased=None):
     """Minimally update the indices and frequency of symbol pairs
 
     if we merge a pair of symbols, only pairs that overlap with occurrences
     of this pair are affected, and need to be updated.
+
+    if `increased` is a set, the pairs whose frequency increased or that were added back to `stats` (after pruning)
+    are added to it, to be pushed to the `PairQueue` of `stats`.
     """
+    if increased is None:
+        increased = set()
     stats[pair] = 0
     indices[pair] = defaultdict(int)
-    first, second = pair
-    new_pair = first + second
+    first, second = pair >> PAIR_SHIFT, pair & PAIR_MASK
     for j, word, old_word, freq in changed:
+        old_len, new_len = len(old_word), len(word)
 
         # find all instances of pair, and update frequency/indices around it
         i = 0
@@ -51,17 +87,21 @@ def update_pair_statistics(pair, changed, stats, indices):
             except ValueError:
                 break
             # if first symbol is followed by second symbol, we've found an occurrence of pair (old_word[i:i+2])
-            if i < len(old_word) - 1 and old_word[i + 1] == second:
+            if i < old_len - 1 and old_word[i + 1] == second:
                 # assuming a symbol sequence "A B C", if "B C" is merged, reduce the frequency of "A B"
                 if i:
-                    prev = old_word[i - 1:i + 1]
+                    prev = old_word[i - 1] << PAIR_SHIFT | first
+                    if prev not in stats:
+                        increased.add(prev)
                     stats[prev] -= freq
                     indices[prev][j] -= 1
-                if i < len(old_word) - 2:
+                if i < old_len - 2:
                     # assuming a symbol sequence "A B C B", if "B C" is merged, reduce the frequency of "C B".
                     # however, skip this if the sequence is A B C B C, because the frequency of "C B" will be reduced by the previous code block
-                    if old_word[i + 2] != first or i >= len(old_word) - 3 or old_word[i + 3] != second:
-                        nex = old_word[i + 1:i + 3]
+                    if old_word[i + 2] != first or i >= old_len - 3 or old_word[i + 3] != second:
+                        nex = second << PAIR_SHIFT | old_word[i + 2]
+                        if nex not in stats:
+                            increased.add(nex)
                         stats[nex] -= freq
                         indices[nex][j] -= 1
                 i += 2
@@ -72,20 +112,22 @@ def update_pair_statistics(pair, changed, stats, indices):
         while True:
             try:
                 # find new pair
-                i = word.index(new_pair, i)
+                i = word.index(new_symbol, i)
             except ValueError:
                 break
             # assuming a symbol sequence "A BC D", if "B C" is merged, increase the frequency of "A BC"
             if i:
-                prev = word[i - 1:i + 1]
+                prev = word[i - 1] << PAIR_SHIFT | new_symbol
                 stats[prev] += freq
                 indices[prev][j] += 1
+                increased.add(prev)
             # assuming a symbol sequence "A BC B", if "B C" is merged, increase the frequency of "BC B"
             # however, if the sequence is A BC BC, skip this step because the count of "BC BC" will be incremented by the previous code block
-            if i < len(word) - 1 and word[i + 1] != new_pair:
-                nex = word[i:i + 2]
+            if i < new_len - 1 and word[i + 1] != new_symbol:
+                nex = new_symbol << PAIR_SHIFT | word[i + 1]
                 stats[nex] += freq
                 indices[nex][j] += 1
+                increased.add(nex)
             i += 1
 
 
@@ -101,38 +143,86 @@ def get_pair_statistics(vocab):
     for i, (word, freq) in enumerate(vocab):
         prev_char = word[0]
         for char in word[1:]:
-            stats[prev_char, char] += freq
-            indices[prev_char, char][i] += 1
+            pair = prev_char << PAIR_SHIFT | char
+            stats[pair] += freq
+            indices[pair][i] += 1
             prev_char = char
 
     return stats, indices
 
 
-def replace_pair(pair, vocab, indices):
-    """Replace all occurrences of a symbol pair ('A', 'B') with a new symbol 'AB'"""
-    first, second = pair
-    pair_str = ''.join(pair)
-    pair_str = pair_str.replace('\\', '\\\\')
+def replace_pair(pair, new_symbol, vocab, indices):
+    """Replace all occurrences of a symbol pair (A, B) with the new symbol AB, in place"""
+    first, second = pair >> PAIR_SHIFT, pair & PAIR_MASK
     changes = []
-    pattern = re.compile(r'(?<!\S)' + re.escape(first + ' ' + second) + r'(?!\S)')
-    if sys.version_info < (3, 0):
-        iterator = indices[pair].iteritems()
-    else:
-        iterator = indices[pair].items()
-    for j, freq in iterator:
+    for j, freq in indices[pair].items():
         if freq < 1:
             continue
         word, freq = vocab[j]
-        new_word = ' '.join(word)
-        new_word = pattern.sub(pair_str, new_word)
-        new_word = tuple(new_word.split())
-
-        vocab[j] = (new_word, freq)
-        changes.append((j, new_word, word, freq))
+        old_word = word[:]
+        # leftmost occurrences first, a merged symbol is not matched again
+        i = 0
+        while True:
+            try:
+                i = word.index(first, i)
+            except ValueError:
+                break
+            if i < len(word) - 1 and word[i + 1] == second:
+                word[i] = new_symbol
+                del word[i + 1]
+            i += 1
+        changes.append((j, word, old_word, freq))
 
     return changes
 
 
+class _Descending(object):
+    """Reverses the order of the strings of a pair in the heap of `PairQueue`, so that the largest pair comes first
+    on ties."""
+    __slots__ = ('key', 'pair')
+
+    def __init__(self, key, pair):
+        self.key = key
+        self.pair = pair
+
+    def __lt__(self, other):
+        return self.pair > other.pair
+
+
+class PairQueue(object):
+    """Max-heap of the pairs of `stats` by (frequency, pair), the order of `max(stats, key=lambda x: (stats[x], x))`
+    over the pairs of strings of `table`.
+
+    The entries are invalidated lazily: the frequency of an entry is an upper bound of the frequency of its pair,
+    so a decrease costs nothing, and an entry found above the current frequency of its pair is pushed down when
+    it reaches the top. Increases and pairs added to `stats` must be pushed. Pairs deleted from `stats` (pruned)
+    are dropped when they reach the top.
+    """
+
+    def __init__(self, stats, table):
+        self.stats = stats
+        self.table = table
+        self.heap = [(-freq, _Descending(key, table.pair(key))) for key, freq in stats.items()]
+        heapq.heapify(self.heap)
+
+    def push(self, key):
+        heapq.heappush(self.heap, (-self.stats[key], _Descending(key, self.table.pair(key))))
+
+    def max(self):
+        """ The most frequent pair of `stats`, the largest one on ties. """
+        heap, stats = self.heap, self.stats
+        while heap:
+            neg_freq, item = heap[0]
+            freq = stats.get(item.key)
+            if freq is None:
+                heapq.heappop(heap)
+            elif freq == -neg_freq:
+                return item.key
+            else:
+                heapq.heapreplace(heap, (-freq, item))
+        return None
+
+
 def prune_stats(stats, big_stats, threshold):
     """Prune statistics dict for efficiency of max()
 
@@ -160,20 +250,26 @@ def main(infile, outfile, num_symbols, min_frequency=2, verbose=False):
     vocab = infile
     vocab = dict([(tuple(x[:-1]) + (x[-1] + '</w>',), y) for (x, y) in vocab.items()])
     sorted_vocab = sorted(vocab.items(), key=lambda x: x[1], reverse=True)
+    table = SymbolTable()
+    sorted_vocab = [(table.word(word), freq) for word, freq in sorted_vocab]
 
     stats, indices = get_pair_statistics(sorted_vocab)
-    big_stats = copy.deepcopy(stats)
+    big_stats = defaultdict(int, stats)
+    # the pairs are taken from a heap over `stats` instead of a `max` over it, pruning still decides which counts
+    # are seen: the counts of a pruned pair that is produced again by a merge restart from 0 in `stats`
+    queue = PairQueue(stats, table)
     # threshold is inspired by Zipfian assumption, but should only affect speed
     threshold = max(stats.values()) / 10
     for i in range(num_symbols):
         if stats:
-            most_frequent = max(stats, key=lambda x: (stats[x], x))
+            most_frequent = queue.max()
 
         # we probably missed the best pair because of pruning; go back to full statistics
         if not stats or (i and stats[most_frequent] < threshold):
             prune_stats(stats, big_stats, threshold)
-            stats = copy.deepcopy(big_stats)
-            most_frequent = max(stats, key=lambda x: (stats[x], x))
+            stats = defaultdict(int, big_stats)
+            queue = PairQueue(stats, table)
+            most_frequent = queue.max()
             # threshold is inspired by Zipfian assumption, but should only affect speed
             threshold = stats[most_frequent] * i / (i + 10000.0)
             prune_stats(stats, big_stats, threshold)
@@ -182,14 +278,19 @@ def main(infile, outfile, num_symbols, min_frequency=2, verbose=False):
             sys.stderr.write('no pair has frequency >= {0}. Stopping\n'.format(min_frequency))
             break
 
+        first, second = table.pair(most_frequent)
         if verbose:
             sys.stderr.write(
-                'pair {0}: {1} {2} -> {1}{2} (frequency {3})\n'.format(i, most_frequent[0], most_frequent[1],
-                                                                       stats[most_frequent]))
-        outfile.write('{0} {1}\n'.format(*most_frequent))
-        changes = replace_pair(most_frequent, sorted_vocab, indices)
-        update_pair_statistics(most_frequent, changes, stats, indices)
+                'pair {0}: {1} {2} -> {1}{2} (frequency {3})\n'.format(i, first, second, stats[most_frequent]))
+        outfile.write('{0} {1}\n'.format(first, second))
+        new_symbol = table.id(first + second)
+        changes = replace_pair(most_frequent, new_symbol, sorted_vocab, indices)
+        increased = set()
+        update_pair_statistics(most_frequent, new_symbol, changes, stats, indices, increased)
         stats[most_frequent] = 0
+        increased.add(most_frequent)
+        for pair in increased:
+            queue.push(pair)
         if not i % 100:
             prune_stats(stats, big_stats, threshold)
 
@@ -228,6 +329,10 @@ def create_parser():
     parser.add_argument(
         '--sample_per_thread', '-n', type=int, dest="sample_per_thread",
         default=50000, help="Num of samples per threads")
+    parser.add_argument(
+        '--cache-size', type=int, default=50000, metavar='N', dest='cache_size',
+        help="Pre-segment the N most frequent words once, save them next to the codes and share them with all "
+             "threads when applying BPE, 0 to disable (default: %(default)s))")
     parser.add_argument(
         '--min-frequency', type=int, default=2, metavar='FREQ',
         help='Stop if no symbol pair has frequency >= FREQ (default: %(default)s))')
@@ -273,6 +378,14 @@ if __name__ == '__main__':
     with codecs.open(args.output.name, 'w', encoding='UTF-8') as output:
         main(full_vocab, output, args.symbols, args.min_frequency, args.verbose)
 
+    # the compiled model, loaded by the short-lived BPE processes of the pipeline instead of the codes
+    bpe = BPE(args.output.name, separator=args.separator)
+    save_bundle(bpe, bundle_path_of(args.output.name))
+    cache_path = None
+    if args.cache_size > 0:
+        cache_path = cache_path_of(args.output.name)
+        build_cache(bpe, full_vocab, args.cache_size, cache_path)
+
     os.system('echo "==== 2. Get Subword encoded file ===="')
     
     # apply BPE to each training corpus and get vocabulary
@@ -282,7 +395,7 @@ if __name__ == '__main__':
         train_file.seek(0)
         with codecs.open(bpeoutput_file, "w", encoding="UTF-8") as bpeout:
             encode_file(train_file, bpeout, args.output.name,
-                        False, args.threads, args.sample_per_thread, args.separator)
+                        False, args.threads, args.sample_per_thread, args.separator, cache_path)
 
         tmpin = codecs.open(bpeoutput_file, encoding='UTF-8')
         vocab += get_vocabulary(tmpin)
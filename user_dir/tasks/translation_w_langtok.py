@@ -14,6 +14,7 @@ import numpy as np
 from fairseq import metrics, options, utils
 from fairseq.data import (
     AppendTokenDataset,
+    BaseWrapperDataset,
     ConcatDataset,
     LanguagePairDataset,
     PrependTokenDataset,
@@ -31,6 +32,198 @@ EVAL_BLEU_ORDER = 4
 logger = logging.getLogger(__name__)
 
 
+class RASTable(object):
+    """
+    The candidates of random aligned substitution (RAS) in the id space of a fairseq `Dictionary`.
+
+    A source word is the tuple of ids of its subwords (all but the last end with `@@`), each candidate is the
+    tuple of ids of the subwords of the candidate word. For each source language there are one or several
+    tables {source word: (candidates, cumulative weights)}, one of which is selected for each sentence, as
+    `replace_word.py` selects the target language of each copy.
+    """
+    
+    def __init__(self, dictionary, tables, bpe_symbol="@@"):
+        """
+
+        :param dictionary: the fairseq `Dictionary` of the source side
+        :param tables: {source language: list of {source word ids: (candidate ids, cumulative weights)}}
+        """
+        self.tables = tables
+        # language token id -> language, e.g. LANG_TOK_EN -> en
+        self.lang_toks = dict((i, sym[9:].lower()) for i, sym in enumerate(dictionary.symbols)
+                              if sym.startswith("LANG_TOK_"))
+        self.continued = np.array([sym.endswith(bpe_symbol) for sym in dictionary.symbols], dtype=bool)
+    
+    @staticmethod
+    def _word_ids(words, dictionary, bpe=None):
+        """
+
+        :return: the tuple of ids of each word (or phrase), None for the words with unknown subwords
+        """
+        if bpe is None:
+            # without bpe codes, only the words that are whole tokens of the dictionary can be used
+            tokens = [word.split() for word in words]
+        else:
+            tokens = [bpe.segment_tokens(word.split()) for word in words]
+        word_ids = []
+        for _tokens in tokens:
+            ids = tuple(dictionary.index(token) for token in _tokens)
+            word_ids.append(None if dictionary.unk() in ids else ids)
+        return word_ids
+    
+    @classmethod
+    def _compile(cls, word_dict, dictionary, bpe=None):
+        """
+
+        :param word_dict: {source word: [(candidate word, weight)]}
+        :return: {source word ids: (candidate ids, cumulative weights)}
+        """
+        words = sorted(set(word_dict) | set(w for candidates in word_dict.values() for w, _ in candidates))
+        ids = dict(zip(words, cls._word_ids(words, dictionary, bpe)))
+        table = {}
+        for src_word, candidates in word_dict.items():
+            if ids[src_word] is None:
+                continue
+            candidates = [(ids[word], weight) for word, weight in candidates if ids[word] is not None]
+            if candidates:
+                table[ids[src_word]] = ([c for c, _ in candidates], np.cumsum([w for _, w in candidates]))
+        return table
+    
+    @classmethod
+    def from_muse(cls, dictionary_path, languages, dictionary, vocab_size=2000, bpe=None):
+        """
+        Build the tables of the MUSE en-x dictionaries under `dictionary_path`, one table per x in `languages`,
+        the candidates of a word are equally weighted. The lines are read as by `replace_word.py`, but the words
+        are replaced one by one: the phrases (in tab separated lines) can be candidates, not source words.
+        """
+        tables = []
+        for lang in languages:
+            word_dict = {}
+            with open(os.path.join(dictionary_path, "en-{}.txt".format(lang))) as f:
+                for i, line in enumerate(f):
+                    if i > vocab_size:
+                        # only keep first `vocab_size` word pairs
+                        break
+                    # tab separated lines may contain phrases
+                    bi_text = line.strip().split("\t") if "\t" in line else line.strip().split()
+                    assert len(bi_text) == 2, ("in file en-{}.txt, line index {} has an invalid number of columns {}"
+                                               .format(lang, i, len(bi_text)))
+                    src_word, tgt_word = bi_text
+                    if len(src_word.split()) > 1:
+                        continue
+                    word_dict.setdefault(src_word, []).append((tgt_word, 1))
+            tables.append(cls._compile(word_dict, dictionary, bpe))
+            logger.info("RAS dictionary en-{}: {} words".format(lang, len(tables[-1])))
+        return cls(dictionary, {"en": tables})
+    
+    @classmethod
+    def from_multi_way(cls, dictionary_path, languages, target_languages, dictionary, max_dep=1,
+                       vocab_size=100000000, bpe=None):
+        """
+        Build the tables of the multi-way dictionary `dictionary_path`, one table per language in `languages`.
+        A candidate of depth `dep` has the weight 2 ^ (max_depth - dep), as in `replace_word_w_multi.py`.
+        """
+        word_dicts = {}
+        with open(dictionary_path) as f:
+            for i, line in enumerate(f):
+                line = line.strip().split("\t")
+                src_lang, src_word = line[0][:2].lower(), line[0][4:]
+                if src_lang not in languages:
+                    continue
+                depth_dict = {}
+                for word_str in line[1:]:
+                    depth_dict.setdefault(int(word_str[-1]), []).append((word_str[4:-3], word_str[:2].lower()))
+                _max_depth = min(len(depth_dict), max_dep)
+                # words with smaller depth has larger proba to be selected
+                word_dicts.setdefault(src_lang, {})[src_word] = [
+                    (word, pow(2, _max_depth - dep)) for dep in range(1, _max_depth + 1)
+                    for word, lang in depth_dict.get(dep, []) if lang in target_languages]
+                if i >= vocab_size:
+                    # only keep first `vocab_size` word pairs
+                    break
+        tables = {}
+        for src_lang, word_dict in word_dicts.items():
+            tables[src_lang] = [cls._compile(word_dict, dictionary, bpe)]
+            logger.info("RAS dictionary {}: {} words".format(src_lang, len(tables[src_lang][0])))
+        return cls(dictionary, tables)
+    
+    def replace(self, tokens, replace_prob):
+        """
+        Replace each word of `tokens` that is in the dictionary by one of its candidates with a probability
+        of `replace_prob`, using the global numpy random state.
+
+        :param tokens: 1d LongTensor starting with a language token
+        :return: the replaced tokens, `tokens` itself if nothing is replaced
+        """
+        ids = tokens.tolist()
+        tables = self.tables.get(self.lang_toks.get(ids[0]))
+        if not tables:
+            return tokens
+        table = tables[np.random.randint(len(tables))]
+        # the last subword of each word
+        ends = np.flatnonzero(~self.continued[tokens.numpy()]).tolist()
+        hits = (np.random.random(len(ends)) < replace_prob).tolist()
+        new_ids, start, cnt = ids[:1], 1, 0
+        for end, hit in zip(ends[1:], hits[1:]):
+            word = tuple(ids[start:end + 1])
+            entry = table.get(word) if hit else None
+            if entry is None:
+                new_ids.extend(word)
+            else:
+                candidates, cum_weights = entry
+                i = np.searchsorted(cum_weights, np.random.random() * cum_weights[-1], side="right")
+                new_ids.extend(candidates[i])
+                cnt += 1
+            start = end + 1
+        new_ids.extend(ids[start:])
+        if cnt == 0:
+            return tokens
+        return torch.LongTensor(new_ids)
+
+
+class RASDataset(BaseWrapperDataset):
+    """
+    Apply random aligned substitution to the source sentences at `__getitem__` time, instead of expanding
+    the training corpus on disk. The substitutions only depend on (seed, epoch, index), so each epoch gets a
+    fresh sample.
+    """
+    
+    def __init__(self, dataset, table, replace_prob=0.15, seed=1, max_sizes=None):
+        """
+
+        :param dataset: the source dataset, each sentence starts with a language token
+        :param table: a `RASTable`
+        :param max_sizes: the maximum size of each replaced sentence, the sizes the batches are built from, a
+            longer replaced sentence is left unchanged
+        """
+        super().__init__(dataset)
+        self.table = table
+        self.replace_prob = replace_prob
+        self.seed = seed
+        self.max_sizes = max_sizes
+        self.epoch = 1
+    
+    def set_epoch(self, epoch):
+        super().set_epoch(epoch)
+        self.epoch = epoch
+    
+    def __getitem__(self, index):
+        item = self.dataset[index]
+        with data_utils.numpy_seed(self.seed, self.epoch, index):
+            replaced = self.table.replace(item, self.replace_prob)
+        if self.max_sizes is not None and len(replaced) > self.max_sizes[index]:
+            return item
+        return replaced
+
+
+class RASLanguagePairDataset(LanguagePairDataset):
+    """`LanguagePairDataset` that passes the epoch to its source dataset, see `RASDataset`."""
+    
+    def set_epoch(self, epoch):
+        super().set_epoch(epoch)
+        self.src.set_epoch(epoch)
+
+
 def load_langpair_dataset(
         data_path,
         split,
@@ -52,6 +245,10 @@ def load_langpair_dataset(
         num_buckets=0,
         shuffle=True,
         pad_to_multiple=1,
+        ras_table=None,
+        ras_replace_prob=0.15,
+        ras_extra_tokens=10,
+        seed=1,
 ):
     def split_exists(split, src, tgt, lang, data_path):
         filename = os.path.join(data_path, "{}.{}-{}.{}".format(split, src, tgt, lang))
@@ -144,9 +341,17 @@ def load_langpair_dataset(
             )
     
     tgt_dataset_sizes = tgt_dataset.sizes if tgt_dataset is not None else None
-    return LanguagePairDataset(
+    dataset_cls = LanguagePairDataset
+    src_sizes = src_dataset.sizes
+    if ras_table is not None:
+        # the batches are built from the sizes of the original sentences plus `ras_extra_tokens`, and a replaced
+        # sentence longer than that is left unchanged, so that the batches stay under --max-tokens
+        src_sizes = np.maximum(src_sizes, np.minimum(src_sizes + ras_extra_tokens, max_source_positions))
+        src_dataset = RASDataset(src_dataset, ras_table, ras_replace_prob, seed, src_sizes)
+        dataset_cls = RASLanguagePairDataset
+    return dataset_cls(
         src_dataset,
-        src_dataset.sizes,
+        src_sizes,
         src_dict,
         tgt_dataset,
         tgt_dataset_sizes,
@@ -215,6 +420,30 @@ class TranslationWithLangtokTask(LegacyFairseqTask):
                                  'to minimize the number of compilations')
         parser.add_argument('--lang-prefix-tok', default=None, type=str, help="starting token in decoder")
         
+        # options for random aligned substitution (RAS) of the training data on the fly
+        parser.add_argument('--ras-dict-path', default=None, type=str,
+                            help='root of the MUSE en-x dictionaries, enables RAS on the fly')
+        parser.add_argument('--ras-multi-dict-path', default=None, type=str,
+                            help='the multi-way dictionary, enables RAS on the fly')
+        parser.add_argument('--ras-langs', default=None, type=str,
+                            help='";" separated languages that are replaced, '
+                                 'only used with --ras-multi-dict-path')
+        parser.add_argument('--ras-target-langs', default=None, type=str,
+                            help='";" separated RAS target languages')
+        parser.add_argument('--ras-replace-prob', default=0.15, type=float,
+                            help='probability to replace a word in the dictionary')
+        parser.add_argument('--ras-max-dep', default=1, type=int,
+                            help='maximum depth of the candidates of the multi-way dictionary')
+        parser.add_argument('--ras-vocab-size', default=None, type=int,
+                            help='only use the first N word pairs of the dictionaries, by default 2000 for the '
+                                 'MUSE dictionaries and all of the multi-way dictionary, as in tools.ras')
+        parser.add_argument('--ras-extra-tokens', default=10, type=int,
+                            help='a replaced source sentence can be N tokens longer than the original one, the '
+                                 'batches are built from the original sizes plus N')
+        parser.add_argument('--ras-bpe-codes', default=None, type=str,
+                            help='bpe codes to segment the dictionaries, without them only the words that '
+                                 'are whole tokens of the source dictionary are replaced')
+        
         # options for reporting BLEU during validation
         parser.add_argument('--eval-bleu', action='store_true',
                             help='evaluation with BLEU scores')
@@ -240,6 +469,7 @@ class TranslationWithLangtokTask(LegacyFairseqTask):
         super().__init__(args)
         self.src_dict = src_dict
         self.tgt_dict = tgt_dict
+        self.ras_table = None
     
     @classmethod
     def setup_task(cls, args, **kwargs):
@@ -294,6 +524,10 @@ class TranslationWithLangtokTask(LegacyFairseqTask):
         # infer langcode
         src, tgt = self.args.source_lang, self.args.target_lang
         
+        ras_table = None
+        if split == getattr(self.args, "train_subset", None):
+            ras_table = self.build_ras_table()
+        
         self.datasets[split] = load_langpair_dataset(
             data_path,
             split,
@@ -313,7 +547,38 @@ class TranslationWithLangtokTask(LegacyFairseqTask):
             num_buckets=self.args.num_batch_buckets,
             shuffle=(split != "test"),
             pad_to_multiple=self.args.required_seq_len_multiple,
+            ras_table=ras_table,
+            ras_replace_prob=self.args.ras_replace_prob,
+            ras_extra_tokens=self.args.ras_extra_tokens,
+            seed=self.args.seed,
         )
+        if ras_table is not None:
+            self.datasets[split].set_epoch(epoch)
+    
+    def build_ras_table(self):
+        """Build the `RASTable` of the source dictionary once, None if RAS on the fly is not enabled."""
+        if self.ras_table is not None or (self.args.ras_dict_path is None and self.args.ras_multi_dict_path is None):
+            return self.ras_table
+        bpe = None
+        if self.args.ras_bpe_codes is not None:
+            try:
+                from subword_nmt import apply_bpe
+            except ImportError:
+                raise ImportError("Please install subword_nmt with: pip install subword-nmt")
+            with open(self.args.ras_bpe_codes) as f:
+                bpe = apply_bpe.BPE(f)
+        assert self.args.ras_target_langs is not None, "--ras-target-langs is required by RAS"
+        target_langs = self.args.ras_target_langs.split(";")
+        if self.args.ras_multi_dict_path is not None:
+            langs = self.args.ras_langs.split(";") if self.args.ras_langs else target_langs
+            vocab_size = self.args.ras_vocab_size if self.args.ras_vocab_size is not None else 100000000
+            self.ras_table = RASTable.from_multi_way(self.args.ras_multi_dict_path, langs, target_langs,
+                                                     self.src_dict, self.args.ras_max_dep, vocab_size, bpe)
+        else:
+            vocab_size = self.args.ras_vocab_size if self.args.ras_vocab_size is not None else 2000
+            self.ras_table = RASTable.from_muse(self.args.ras_dict_path, target_langs, self.src_dict,
+                                                vocab_size, bpe)
+        return self.ras_table
     
     def build_dataset_for_inference(self, src_tokens, src_lengths, constraints=None):
         return LanguagePairDataset(